@@ -0,0 +1,392 @@
+"""
+Catalog snapshot: the catalog pages' data in one memory-mapped file.
+
+The home page and the product list show the same small, read-mostly data
+to everyone: categories, and each product's name, slug, price, image, stock
+and flags. Instead of asking the database on every request, or keeping a
+copy as Python objects in every worker, the build_catalog_snapshot command
+writes it to CATALOG_SNAPSHOT_PATH. Every process maps that file read-only,
+so the operating system keeps a single copy in the page cache however many
+workers there are, and a lookup touches only the pages it reads.
+
+The file is columnar. A header and a table of column offsets come first.
+Then come fixed-width arrays with one entry per product or category (ids,
+prices in cents, stock, flags, update times as microseconds, indexes into
+the string table), a few index arrays (products by category, slug and id,
+featured products), and the string table: one offset array and the UTF-8
+bytes. Reading a column is a memoryview cast with no parsing. Only the
+products on the page being shown become model instances.
+
+A new snapshot is written next to the old one and renamed over it, which is
+atomic. Each process checks the file at most every
+CATALOG_SNAPSHOT_CHECK_SECONDS and maps the new one when it has changed.
+Requests in progress keep the old mapping until they finish.
+build_catalog_snapshot --watch follows the change feed (outbox.py) and
+republishes after product and category changes, so the pages lag the
+database by a few seconds. With no snapshot file, the views read the
+database as before.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+
+from .models import Category, Product
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PNCATLG\x00'
+FORMAT = 1
+HEADER = struct.Struct('<8sIIqIIII')  # magic, format, columns, built at (ns), products, categories, featured, strings
+NULL = 0xFFFFFFFF  # string index of a NULL
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+AVAILABLE = 1
+FEATURED = 2
+
+# Product columns in the snapshot, in model field order for from_db()
+PRODUCT_FIELDS = [
+    'id', 'category_id', 'name', 'slug', 'description', 'price', 'stock', 'available', 'image',
+    'updated_at', 'featured',
+]
+
+# name, typecode, rows ('products', 'categories', 'featured', 'strings' + 1,
+# or 'bytes' for the string data). The order is the order in the file.
+COLUMNS = (
+    ('product_id', 'q', 'products'),
+    ('product_category', 'I', 'products'),  # category row
+    ('product_price', 'q', 'products'),  # cents
+    ('product_stock', 'i', 'products'),
+    ('product_flags', 'B', 'products'),
+    ('product_updated', 'q', 'products'),  # microseconds since the epoch
+    ('product_name', 'I', 'products'),
+    ('product_slug', 'I', 'products'),
+    ('product_description', 'I', 'products'),
+    ('product_image', 'I', 'products'),
+    ('category_id', 'q', 'categories'),
+    ('category_name', 'I', 'categories'),
+    ('category_slug', 'I', 'categories'),
+    ('category_description', 'I', 'categories'),
+    ('category_start', 'I', 'categories'),  # first entry in by_category
+    ('category_count', 'I', 'categories'),
+    ('category_updated', 'q', 'categories'),
+    ('by_category', 'I', 'products'),  # product rows grouped by category, in catalog order
+    ('by_slug', 'I', 'products'),  # product rows in slug order
+    ('by_id', 'I', 'products'),  # product rows in id order
+    ('category_by_slug', 'I', 'categories'),
+    ('featured', 'I', 'featured'),  # featured product rows, in catalog order
+    ('string_offsets', 'I', 'strings'),
+    ('string_data', 'B', 'bytes'),
+)
+_OFFSETS = struct.Struct(f'<{len(COLUMNS)}Q')
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+class _Strings:
+    def __init__(self):
+        self.index = {}
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+
+    def add(self, value):
+        if value is None:
+            return NULL
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.offsets) - 1
+            self.data += value.encode()
+            self.offsets.append(len(self.data))
+        return i
+
+
+def build(path=None):
+    """Write the snapshot from the database and publish it. Returns (products, categories, bytes)."""
+    path = str(path or settings.CATALOG_SNAPSHOT_PATH)
+    strings = _Strings()
+    columns = {name: array(typecode) for name, typecode, _ in COLUMNS if name not in ('string_offsets', 'string_data')}
+
+    category_rows = {}
+    category_slugs = []
+    for category_id, name, slug, description in Category.objects.order_by('id').values_list(
+        'id', 'name', 'slug', 'description'
+    ):
+        category_rows[category_id] = len(category_rows)
+        category_slugs.append(slug)
+        columns['category_id'].append(category_id)
+        columns['category_name'].append(strings.add(name))
+        columns['category_slug'].append(strings.add(slug))
+        columns['category_description'].append(strings.add(description))
+
+    members = [[] for _ in category_rows]
+    updated = [0] * len(category_rows)
+    ids, slugs = [], []
+    products = Product.objects.order_by('-created_at', '-id').values_list(
+        'id', 'category_id', 'price', 'stock', 'available', 'featured', 'updated_at',
+        'name', 'slug', 'description', 'image',
+    )
+    for (product_id, category_id, price, stock, available, featured, updated_at,
+         name, slug, description, image) in products.iterator(chunk_size=2000):
+        category = category_rows.get(category_id)
+        if category is None:
+            # Added since the categories were read; the next build has it
+            continue
+        row = len(ids)
+        micros = _micros(updated_at)
+        columns['product_id'].append(product_id)
+        columns['product_category'].append(category)
+        columns['product_price'].append(int(price * 100))
+        columns['product_stock'].append(stock)
+        columns['product_flags'].append((AVAILABLE if available else 0) | (FEATURED if featured else 0))
+        columns['product_updated'].append(micros)
+        columns['product_name'].append(strings.add(name))
+        columns['product_slug'].append(strings.add(slug))
+        columns['product_description'].append(strings.add(description))
+        columns['product_image'].append(strings.add(image))
+        members[category].append(row)
+        updated[category] = max(updated[category], micros)
+        ids.append(product_id)
+        slugs.append(slug)
+        if featured:
+            columns['featured'].append(row)
+
+    for rows, latest in zip(members, updated):
+        columns['category_start'].append(len(columns['by_category']))
+        columns['category_count'].append(len(rows))
+        columns['category_updated'].append(latest)
+        columns['by_category'].extend(rows)
+    columns['by_slug'].extend(sorted(range(len(slugs)), key=slugs.__getitem__))
+    columns['by_id'].extend(sorted(range(len(ids)), key=ids.__getitem__))
+    columns['category_by_slug'].extend(sorted(range(len(category_slugs)), key=category_slugs.__getitem__))
+    columns['string_offsets'] = strings.offsets
+    columns['string_data'] = array('B', strings.data)
+
+    header = HEADER.pack(
+        MAGIC, FORMAT, len(COLUMNS), time.time_ns(),
+        len(ids), len(category_rows), len(columns['featured']), len(strings.offsets) - 1,
+    )
+    position = _align(HEADER.size + _OFFSETS.size)
+    offsets = []
+    for name, _, _ in COLUMNS:
+        offsets.append(position)
+        position = _align(position + len(columns[name]) * columns[name].itemsize)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header + _OFFSETS.pack(*offsets))
+        for offset, (name, _, _) in zip(offsets, COLUMNS):
+            f.seek(offset)
+            columns[name].tofile(f)
+        f.truncate(position)
+        f.flush()
+        os.fsync(f.fileno())
+    # Processes that have the old file mapped keep reading it until they
+    # notice the new one
+    os.replace(tmp, path)
+    return len(ids), len(category_rows), position
+
+
+class CatalogSnapshot:
+    """A published snapshot, mapped read-only."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, version, column_count, self.built_at, products, categories, featured, strings = HEADER.unpack_from(view)
+        if magic != MAGIC or version != FORMAT or column_count != len(COLUMNS):
+            raise ValueError(f'{path} is not a catalog snapshot this version can read')
+        self.token = f'{self.built_at:x}'
+        rows = {'products': products, 'categories': categories, 'featured': featured, 'strings': strings + 1}
+        offsets = _OFFSETS.unpack_from(view, HEADER.size)
+        for (name, typecode, count), offset in zip(COLUMNS, offsets):
+            if count == 'bytes':
+                count = self.string_offsets[-1]
+            else:
+                count = rows[count]
+            size = struct.calcsize(typecode)
+            setattr(self, name, view[offset:offset + count * size].cast(typecode))
+        self._categories = None
+
+    def string(self, i):
+        if i == NULL:
+            return None
+        return str(self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]], 'utf-8')
+
+    def _find(self, rows, column, value):
+        i = bisect.bisect_left(rows, value, key=lambda row: self.string(column[row]))
+        if i < len(rows) and self.string(column[rows[i]]) == value:
+            return rows[i]
+        return None
+
+    def _updated(self, micros):
+        return EPOCH + timedelta(microseconds=micros)
+
+    # Categories
+
+    def categories(self):
+        """All categories, in id order. They are few, so they're built once per snapshot."""
+        if self._categories is None:
+            self._categories = [self._category(row) for row in range(len(self.category_id))]
+        return self._categories
+
+    def _category(self, row):
+        return Category.from_db('default', ['id', 'name', 'slug', 'description'], [
+            self.category_id[row],
+            self.string(self.category_name[row]),
+            self.string(self.category_slug[row]),
+            self.string(self.category_description[row]),
+        ])
+
+    def _category_row(self, slug):
+        return self._find(self.category_by_slug, self.category_slug, slug)
+
+    def category(self, slug):
+        row = self._category_row(slug)
+        return None if row is None else self.categories()[row]
+
+    # Products
+
+    def product(self, row):
+        """
+        The product in `row` as a Product with the snapshot's fields loaded,
+        like one from .only(); other fields are read from the database on
+        access.
+        """
+        flags = self.product_flags[row]
+        product = Product.from_db('default', PRODUCT_FIELDS, [
+            self.product_id[row],
+            self.category_id[self.product_category[row]],
+            self.string(self.product_name[row]),
+            self.string(self.product_slug[row]),
+            self.string(self.product_description[row]),
+            Decimal(self.product_price[row]).scaleb(-2),
+            self.product_stock[row],
+            bool(flags & AVAILABLE),
+            self.string(self.product_image[row]),
+            self._updated(self.product_updated[row]),
+            bool(flags & FEATURED),
+        ])
+        product.category = self.categories()[self.product_category[row]]
+        return product
+
+    def products(self, category_slug=None):
+        """The products of a category, or all of them, in catalog order; a sequence Paginator can page through."""
+        if category_slug is None:
+            return SnapshotProducts(self, None, 0, len(self.product_id))
+        row = self._category_row(category_slug)
+        if row is None:
+            return SnapshotProducts(self, None, 0, 0)
+        return SnapshotProducts(self, self.by_category, self.category_start[row], self.category_count[row])
+
+    def featured_products(self, limit):
+        return [self.product(row) for row in self.featured[:limit]]
+
+    def products_by_id(self, ids):
+        """{id: product} for the ids in the snapshot."""
+        found = {}
+        for product_id in ids:
+            i = bisect.bisect_left(self.by_id, product_id, key=self.product_id.__getitem__)
+            if i < len(self.by_id) and self.product_id[self.by_id[i]] == product_id:
+                found[product_id] = self.product(self.by_id[i])
+        return found
+
+    def product_by_slug(self, slug):
+        row = self._find(self.by_slug, self.product_slug, slug)
+        return None if row is None else self.product(row)
+
+    def list_state(self, category_slug=None):
+        """The product part of views.catalog_list_validators(): {'last_modified', 'total'}."""
+        if category_slug is None:
+            updated = self.category_updated
+            total = len(self.product_id)
+        else:
+            row = self._category_row(category_slug)
+            updated = self.category_updated[row:row + 1] if row is not None else ()
+            total = self.category_count[row] if row is not None else 0
+        latest = max(updated, default=0)
+        return {'last_modified': self._updated(latest) if total else None, 'total': total}
+
+
+class SnapshotProducts:
+    """A range of a snapshot's products; only the slice asked for becomes Products."""
+
+    def __init__(self, snapshot, rows, start, count):
+        self.snapshot = snapshot
+        self.rows = rows
+        self.start = start
+        self.total = count
+
+    def count(self):
+        return self.total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError('SnapshotProducts only supports simple slices')
+        start, stop, _ = index.indices(self.total)
+        rows = range(self.start + start, self.start + max(start, stop))
+        if self.rows is not None:
+            rows = self.rows[rows.start:rows.stop]
+        return [self.snapshot.product(row) for row in rows]
+
+
+_state = {'snapshot': None, 'stat': None, 'checked_at': None}
+_state_lock = threading.Lock()
+
+
+def current():
+    """The published snapshot, or None if there isn't one."""
+    now = time.monotonic()
+    if _state['checked_at'] is not None and now - _state['checked_at'] < settings.CATALOG_SNAPSHOT_CHECK_SECONDS:
+        return _state['snapshot']
+    with _state_lock:
+        if _state['checked_at'] is None or now - _state['checked_at'] >= settings.CATALOG_SNAPSHOT_CHECK_SECONDS:
+            _state.update(_reload(), checked_at=now)
+    return _state['snapshot']
+
+
+def _reload():
+    path = settings.CATALOG_SNAPSHOT_PATH
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, TypeError):
+        return {'snapshot': None, 'stat': None}
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if key == _state['stat']:
+        return {}
+    try:
+        snapshot = CatalogSnapshot(path)
+    except (OSError, ValueError, struct.error):
+        logger.exception('Could not map the catalog snapshot %s', path)
+        return {'snapshot': None, 'stat': key}
+    # The old mapping is unmapped once the last request using it lets go
+    return {'snapshot': snapshot, 'stat': key}
+
+
+def for_category(category_slug=None):
+    """
+    The snapshot for a catalog page, or None if the page should read the
+    database: there is no snapshot, or the category is newer than it.
+    """
+    snapshot = current()
+    if snapshot is not None and category_slug and snapshot.category(category_slug) is None:
+        return None
+    return snapshot
@@ -0,0 +1,57 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from store import catalog_snapshot, outbox
+from store.sharding import DEFAULT_DB
+
+CONSUMER = 'catalog_snapshot'
+TOPICS = ['store.product', 'store.category']
+
+
+class Command(BaseCommand):
+    help = 'Write the memory-mapped catalog snapshot the catalog pages read from, and optionally keep it current'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true', help='Keep running and republish after catalog changes')
+        parser.add_argument(
+            '--interval', type=float, default=settings.CATALOG_SNAPSHOT_WATCH_SECONDS,
+            help='Seconds between checks of the change feed with --watch',
+        )
+
+    def publish(self):
+        start = time.perf_counter()
+        products, categories, size = catalog_snapshot.build()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Catalog snapshot {settings.CATALOG_SNAPSHOT_PATH}: {products} product(s), {categories} '
+            f'categor{"y" if categories == 1 else "ies"}, {size / 1024:.0f} KiB in {elapsed:.2f}s.'
+        ))
+
+    def handle(self, *args, **options):
+        if not options['watch']:
+            self.publish()
+            return
+
+        # Follow the feed from before the first build, so nothing committed
+        # during it is missed
+        outbox.reset(CONSUMER)
+        self.publish()
+        try:
+            while True:
+                time.sleep(options['interval'])
+                changed = []
+                try:
+                    # Every topic, so the checkpoint keeps up with order
+                    # events too and compaction isn't held back
+                    outbox.consume(CONSUMER, lambda events: changed.extend(
+                        event for event in events if event.topic in TOPICS
+                    ), using=DEFAULT_DB)
+                except outbox.OutboxGap:
+                    outbox.reset(CONSUMER)
+                    changed = True
+                if changed:
+                    self.publish()
+                close_old_connections()
+        except KeyboardInterrupt:
+            pass
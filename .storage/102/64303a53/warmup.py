@@ -0,0 +1,176 @@
+"""
+Worker warm-up.
+
+A fresh worker has a lot to do on its first requests. It imports the URLconf
+and with it stripe and the payment modules, compiles templates, connects to
+each database, maps the catalog snapshot and builds the typeahead index,
+and renders the catalog pages and their product cards. After a deploy or a
+scale-out, every worker does all of this at once, just as traffic arrives.
+warm_up() does it at boot instead, before the worker takes its first
+request:
+
+- imports: the URLconf, WARMUP_IMPORTS and the payment provider client
+- templates: compiles the base and store templates into the cached loader
+- connections: connects to every database (to the pool, with POSTGRES_POOL)
+- caches: the catalog snapshot and version, and the typeahead index
+- pages: the home page, the product list and each category's first page,
+  rendered into the card cache, and the page cache when it's shared, for
+  WARMUP_BASE_URL's host
+
+plant_nursery/asgi.py runs it when WARMUP_ON_BOOT is set. python manage.py
+warm_up runs it by hand and prints the timings. Each phase is timed. The
+timings are logged (store.warmup, INFO) and kept for api/v1/warmup/, so
+cold starts can be tracked from deploy to deploy. If a phase fails, it is
+logged and skipped; warm-up never stops a worker from starting.
+"""
+import asyncio
+import importlib
+import io
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.template import engines
+from django.template.loader import get_template
+from django.urls import get_resolver, resolve, reverse
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIRS = ('base', 'store')
+
+# The last warm-up in this process, for api/v1/warmup/
+state = {'pid': None, 'finished_at': None, 'total': None, 'phases': {}}
+
+
+def import_modules():
+    # The URLconf imports every view, and with them stripe and the payment
+    # modules; reversing a URL fills the resolver's lookup tables
+    get_resolver().url_patterns
+    reverse('store-home')
+    for name in settings.WARMUP_IMPORTS:
+        importlib.import_module(name)
+    from . import payments
+    payments.get_client()
+    return len(settings.WARMUP_IMPORTS)
+
+
+def compile_templates():
+    names = set()
+    for directory in engines['django'].template_dirs:
+        for prefix in TEMPLATE_DIRS:
+            for root, _, files in os.walk(os.path.join(directory, prefix)):
+                for file in files:
+                    names.add(os.path.relpath(os.path.join(root, file), directory).replace(os.sep, '/'))
+    for name in sorted(names):
+        # Kept compiled by the cached template loader
+        get_template(name)
+    return len(names)
+
+
+def open_connections():
+    from .sharding import all_shards
+    databases = all_shards()
+    for alias in databases:
+        connections[alias].ensure_connection()
+    return len(databases)
+
+
+def fill_caches():
+    from . import catalog_snapshot, typeahead
+    from .catalog import catalog_version
+    catalog_version()
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None:
+        snapshot.categories()
+    return typeahead.build()
+
+
+def _request(path):
+    url = urlsplit(settings.WARMUP_BASE_URL)
+    secure = url.scheme == 'https'
+    request = WSGIRequest({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'HTTP_HOST': url.netloc,
+        'SERVER_NAME': url.hostname,
+        'SERVER_PORT': str(url.port or (443 if secure else 80)),
+        'wsgi.url_scheme': url.scheme,
+        'wsgi.input': io.BytesIO(),
+    })
+    request.user = AnonymousUser()
+    return request
+
+
+def render_pages():
+    from . import catalog_snapshot
+    from .models import Category
+    snapshot = catalog_snapshot.current()
+    categories = snapshot.categories() if snapshot is not None else Category.objects.all()
+    paths = [reverse('store-home'), reverse('product-list')]
+    paths += [reverse('category-products', args=[category.slug]) for category in categories]
+    for path in paths:
+        match = resolve(path)
+        view = async_to_sync(match.func) if iscoroutinefunction(match.func) else match.func
+        # Through the full-page cache wrapper, which stores the page
+        view(_request(path), *match.args, **match.kwargs)
+    return len(paths)
+
+
+PHASES = (
+    ('imports', import_modules),
+    ('templates', compile_templates),
+    ('connections', open_connections),
+    ('caches', fill_caches),
+    ('pages', render_pages),
+)
+
+
+def _warm_up():
+    phases = {}
+    start = time.perf_counter()
+    for name, func in PHASES:
+        phase_start = time.perf_counter()
+        try:
+            count = func()
+        except Exception:
+            logger.exception('Warm-up phase %s failed', name)
+            count = None
+        phases[name] = {'seconds': round(time.perf_counter() - phase_start, 4), 'count': count}
+    total = time.perf_counter() - start
+    state.update(pid=os.getpid(), finished_at=time.time(), total=round(total, 4), phases=phases)
+    logger.info(
+        'Worker %s warmed up in %.2fs: %s', os.getpid(), total,
+        ', '.join(f"{name} {phase['seconds']:.2f}s" for name, phase in phases.items()),
+    )
+    return state
+
+
+def warm_up():
+    """Run every phase, timing each. Returns {'pid', 'finished_at', 'total', 'phases'}."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return _warm_up()
+
+    # ASGI servers import the application inside their event loop, where
+    # Django won't run queries. Warm up in a thread and wait: the worker
+    # isn't serving yet, so blocking the loop costs nothing
+    def run():
+        try:
+            _warm_up()
+        finally:
+            # The thread's own connections; pooled ones go back to the pool
+            connections.close_all()
+
+    thread = threading.Thread(target=run, name='warm-up')
+    thread.start()
+    thread.join()
+    return state
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from store import warmup
+
+
+class Command(BaseCommand):
+    help = 'Run the worker warm-up in this process and show how long each phase takes'
+    # The checks import the URLconf, which would hide the cost of the imports phase
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        state = warmup.warm_up()
+        for name, phase in state['phases'].items():
+            count = 'failed' if phase['count'] is None else phase['count']
+            self.stdout.write(f"{name:<12} {phase['seconds']:8.3f}s  ({count})")
+        self.stdout.write(self.style.SUCCESS(f"Warmed up in {state['total']:.2f}s."))
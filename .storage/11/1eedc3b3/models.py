@@ -1,13 +1,21 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 from users.models import Wishlist
+from .outbox import OutboxManager, OutboxMixin, OutboxQuerySet
+from .sharding import UserShardedManager
 
 
-class Category(models.Model):
+class Category(OutboxMixin, models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True)
     description = models.TextField(blank=True, null=True)
+    low_stock_threshold = models.PositiveIntegerField(
+        blank=True, null=True, help_text='For products without their own; LOW_STOCK_THRESHOLD when empty'
+    )
+    
+    objects = OutboxManager()
     
     class Meta:
         verbose_name_plural = 'Categories'
@@ -16,7 +24,7 @@ class Category(models.Model):
         return self.name
 
 
-class Product(models.Model):
+class Product(OutboxMixin, models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     name = models.CharField(max_length=200)
     slug = models.SlugField(unique=True)
@@ -29,9 +37,21 @@ class Product(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     featured = models.BooleanField(default=False)
     wishlist = models.ManyToManyField(Wishlist, related_name='products', blank=True)
+    low_stock_threshold = models.PositiveIntegerField(
+        blank=True, null=True, help_text="Alert when stock falls to this; the category's threshold when empty"
+    )
+    # Set when the low-stock alert goes out, cleared once stock is back above
+    # the threshold (see stock_alerts.py)
+    low_stock_alerted = models.BooleanField(default=False, editable=False)
+    
+    objects = OutboxManager()
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['updated_at']),
+            models.Index(fields=['category', 'updated_at']),
+        ]
     
     def __str__(self):
         return self.name
@@ -39,14 +59,47 @@ class Product(models.Model):
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('product-detail', kwargs={'slug': self.slug})
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Whether it could be bought as loaded, so a save can tell it's been restocked
+        if 'stock' in field_names and 'available' in field_names:
+            instance._loaded_in_stock = instance.in_stock
+        return instance
+    
+    @property
+    def in_stock(self):
+        return self.available and self.stock > 0
+    
+    def get_low_stock_threshold(self):
+        if self.low_stock_threshold is not None:
+            return self.low_stock_threshold
+        if self.category.low_stock_threshold is not None:
+            return self.category.low_stock_threshold
+        return settings.LOW_STOCK_THRESHOLD
+
+
+# Carts and orders are sharded by user (see sharding.py). Users and products
+# stay in the default database, so the foreign keys to them have no database
+# constraint and deletes are cascaded by the receivers in sharding.py.
 
 
 class CartItem(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False)
     quantity = models.IntegerField(default=1)
     date_added = models.DateTimeField(auto_now_add=True)
     
+    objects = UserShardedManager()
+    
+    class Meta:
+        indexes = [
+            # Cart expiry: old rows, and whether a user has any recent ones
+            models.Index(fields=['date_added']),
+            models.Index(fields=['user', 'date_added']),
+        ]
+    
     @property
     def total_price(self):
         return self.product.price * self.quantity
@@ -55,7 +108,12 @@ class CartItem(models.Model):
         return f"{self.quantity} x {self.product.name}"
 
 
-class Order(models.Model):
+# Paid orders that haven't been cancelled count towards sales
+SALE = models.Q(payment_status=True) & ~models.Q(status='cancelled')
+ROLLUP_PENDING = (models.Q(counted_in_sales=False) & SALE) | (models.Q(counted_in_sales=True) & ~SALE)
+
+
+class Order(OutboxMixin, models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
         ('processing', 'Processing'),
@@ -63,8 +121,16 @@ class Order(models.Model):
         ('delivered', 'Delivered'),
         ('cancelled', 'Cancelled'),
     )
+    # The statuses an order may move on to from each status
+    STATUS_TRANSITIONS = {
+        'pending': ('processing', 'cancelled'),
+        'processing': ('shipped', 'cancelled'),
+        'shipped': ('delivered',),
+        'delivered': (),
+        'cancelled': (),
+    }
     
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
     full_name = models.CharField(max_length=100)
     email = models.EmailField()
     address = models.TextField()
@@ -76,16 +142,82 @@ class Order(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
-    payment_id = models.CharField(max_length=100, blank=True, null=True)
+    payment_id = models.CharField(max_length=100, blank=True, null=True, unique=True)
     payment_status = models.BooleanField(default=False)
+    # Whether this order's totals are currently included in the sales rollups
+    counted_in_sales = models.BooleanField(default=False, editable=False)
+    
+    objects = UserShardedManager.from_queryset(OutboxQuerySet)()
+    
+    class Meta:
+        indexes = [
+            # Only orders whose rollup contribution is out of date, so the
+            # rollup job finds them without scanning the table
+            models.Index(fields=['id'], condition=ROLLUP_PENDING, name='order_rollup_pending'),
+            models.Index(fields=['status', 'updated_at']),
+        ]
     
     def __str__(self):
         return f"Order {self.id} - {self.user.username}"
+    
+    @property
+    def counts_as_sale(self):
+        return self.payment_status and self.status != 'cancelled'
 
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.IntegerField(default=1)
+    
+    @property
+    def total_price(self):
+        return self.price * self.quantity
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.product.name}"
+
+
+class ArchivedOrder(models.Model):
+    # Same columns as Order; ids are kept so order links keep working
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='archived_orders')
+    full_name = models.CharField(max_length=100)
+    email = models.EmailField()
+    address = models.TextField()
+    city = models.CharField(max_length=100)
+    state = models.CharField(max_length=100)
+    zip_code = models.CharField(max_length=20)
+    phone = models.CharField(max_length=20)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    payment_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    payment_status = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(default=timezone.now)
+    
+    objects = UserShardedManager()
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+        ]
+    
+    def __str__(self):
+        return f"Order {self.id} - {self.user.username} (archived)"
+    
+    @property
+    def counts_as_sale(self):
+        return self.payment_status and self.status != 'cancelled'
+
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity = models.IntegerField(default=1)
     
@@ -106,4 +238,242 @@ class WishlistItem(models.Model):
         unique_together = ('wishlist', 'product')
     
     def __str__(self):
-        return f"{self.product.name} in {self.wishlist.user.username}'s wishlist"
\ No newline at end of file
+        return f"{self.product.name} in {self.wishlist.user.username}'s wishlist"
+
+
+class RestockRequest(models.Model):
+    # "Notify me when it's back": one email, then the request is deleted
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='restock_requests')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='restock_requests')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('product', 'user')
+    
+    def __str__(self):
+        return f"{self.user.username} waiting for {self.product.name}"
+
+
+class ProductRecommendation(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_for')
+    score = models.FloatField()
+    computed_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['product', '-score']
+        unique_together = ('product', 'recommended')
+        indexes = [
+            models.Index(fields=['product', '-score']),
+        ]
+    
+    def __str__(self):
+        return f"{self.recommended.name} for {self.product.name} ({self.score:.3f})"
+
+
+class RecommendationBuild(models.Model):
+    # The last build of ProductRecommendation (see recommendations.py).
+    # Incremental builds refresh products with activity since started_at.
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(default=timezone.now)
+    incremental = models.BooleanField(default=False)
+    products = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"Recommendations built {self.started_at:%Y-%m-%d %H:%M} ({self.products} products)"
+
+
+class PaymentEvent(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    
+    event_id = models.CharField(max_length=100, unique=True)
+    event_type = models.CharField(max_length=100)
+    payment_id = models.CharField(max_length=100, blank=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['received_at']
+        constraints = [
+            # One event of each type per payment, however often it is delivered
+            models.UniqueConstraint(
+                fields=['payment_id', 'event_type'],
+                condition=~models.Q(payment_id=''),
+                name='unique_payment_event',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'received_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} ({self.status})"
+
+class CheckoutIntent(models.Model):
+    STATUS_CHOICES = (
+        ('open', 'Open'),
+        ('completed', 'Completed'),
+        ('superseded', 'Superseded'),
+        ('canceling', 'Canceling'),
+    )
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='checkout_intents')
+    payment_id = models.CharField(max_length=100, unique=True)
+    client_secret = models.CharField(max_length=255)
+    cart_fingerprint = models.CharField(max_length=64)
+    amount = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='open')
+    hits = models.PositiveIntegerField(default=0)
+    updates = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-updated_at']
+        constraints = [
+            # At most one reusable PaymentIntent per shopper
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=models.Q(status='open'),
+                name='one_open_checkout_intent',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.payment_id} for {self.user.username} ({self.status})"
+
+
+class Task(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    
+    name = models.CharField(max_length=100)
+    queue = models.CharField(max_length=50, default='default')
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['run_at']
+        indexes = [
+            models.Index(fields=['queue', 'status', 'run_at']),
+            models.Index(fields=['status', 'claimed_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
+
+
+class TaskQueue(models.Model):
+    # Counts batches in flight so workers on any number of processes or
+    # hosts respect the queue's concurrency limit
+    name = models.CharField(max_length=50, unique=True)
+    concurrency = models.PositiveIntegerField(default=1)
+    running = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.name} ({self.running}/{self.concurrency})"
+
+
+class DailySales(models.Model):
+    day = models.DateField(unique=True)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-day']
+        verbose_name_plural = 'daily sales'
+    
+    def __str__(self):
+        return f"{self.day}: ${self.revenue} from {self.orders} orders"
+
+
+class ProductSales(models.Model):
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    # Category at the time of the sale, so category reports don't need a join
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-day']
+        verbose_name_plural = 'product sales'
+        unique_together = ('day', 'product')
+        indexes = [
+            models.Index(fields=['category', 'day']),
+        ]
+    
+    def __str__(self):
+        return f"{self.product.name} on {self.day}: {self.units} units"
+
+
+class UserShard(models.Model):
+    # Directory of the database holding each user's carts and orders
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    shard = models.CharField(max_length=100, db_index=True)
+    
+    def __str__(self):
+        return f"{self.user_id} -> {self.shard}"
+
+
+class OutboxEvent(models.Model):
+    # Change feed of the outbox models (see outbox.py). Every database has
+    # one, for the changes made on it.
+    topic = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=64)
+    action = models.CharField(max_length=10)
+    fields = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sequence = models.BigIntegerField(blank=True, null=True, unique=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(sequence__isnull=True), name='outbox_unsequenced'),
+            models.Index(fields=['created_at']),
+        ]
+    
+    def __str__(self):
+        return f"#{self.sequence} {self.topic} {self.object_id} {self.action}"
+
+
+class OutboxConsumer(models.Model):
+    # How far a consumer has read each database's feed
+    name = models.CharField(max_length=100)
+    database = models.CharField(max_length=100)
+    position = models.BigIntegerField(default=0)
+    missed_events = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        unique_together = ('name', 'database')
+    
+    def __str__(self):
+        return f"{self.name} on {self.database} at {self.position}"
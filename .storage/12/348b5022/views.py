@@ -2,22 +2,35 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
+from django.template.loader import render_to_string
 from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.http import http_date
 from django.views.generic import ListView, DetailView
-from django.db.models import Q
-from .models import Product, Category, CartItem, Order, OrderItem, WishlistItem
+from django.db.models import Max, Count
+from .models import Product, Category, CartItem, ProductRecommendation, RestockRequest, WishlistItem
+from .api import category_state, make_etag, not_modified
+from .cards import render_cards
+from . import catalog_snapshot
+from .archive import get_order_or_404, user_orders
+from . import payments
+from .checkout import checkout_payment_intent
+from .orders import SHIPPING_FIELDS, place_order, shipping_metadata, stock_problem
+from .search import SearchResults
 from users.models import Wishlist
-import stripe
 import json
 
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
-
 def home(request):
-    featured_products = Product.objects.filter(featured=True)[:6]
-    categories = Category.objects.all()[:6]
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None:
+        featured_products = snapshot.featured_products(6)
+        categories = snapshot.categories()[:6]
+    else:
+        featured_products = Product.objects.filter(featured=True)[:6]
+        categories = Category.objects.all()[:6]
     context = {
         'featured_products': featured_products,
         'categories': categories,
@@ -26,37 +39,155 @@ def home(request):
     return render(request, 'store/home.html', context)
 
 
-class ProductListView(ListView):
+def catalog_etag(request, view_name, etag_parts):
+    # Catalog pages are the same for every visitor; the user-specific parts
+    # are filled in separately (see page_cache.py)
+    return make_etag(view_name, request.get_full_path(), *etag_parts)
+
+
+def set_catalog_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def catalog_list_validators(category_slug, snapshot=None):
+    """
+    {'last_modified', 'total', 'categories'} for a product list page. The
+    page lists every category too, and renaming one doesn't touch the
+    products, so 'categories' stands for the category rows.
+    """
+    if snapshot is not None:
+        # A category change publishes a new snapshot
+        return dict(snapshot.list_state(category_slug), categories=snapshot.token)
+    queryset = Product.objects.all()
+    if category_slug:
+        queryset = queryset.filter(category__slug=category_slug)
+    # Served by the (category, updated_at) index
+    state = queryset.aggregate(last_modified=Max('updated_at'), total=Count('id'))
+    state['categories'] = make_etag(*category_state('name'))
+    return state
+
+
+def product_detail_validators(slug):
+    """(etag_parts, last_modified) for a product page, or None if there is no such product."""
+    # The page shows the product, its category and its related products
+    product = Product.objects.filter(slug=slug).values(
+        'id', 'updated_at', 'category_id', 'category__name', 'category__slug'
+    ).first()
+    if product is None:
+        return None
+    recommended = ProductRecommendation.objects.filter(product_id=product['id']).aggregate(
+        computed_at=Max('computed_at'), updated_at=Max('recommended__updated_at'), total=Count('id')
+    )
+    # Related products are padded from the same category
+    same_category = Product.objects.filter(category_id=product['category_id']).aggregate(
+        updated_at=Max('updated_at'), total=Count('id')
+    )
+    etag_parts = (
+        product['updated_at'], product['category__name'], product['category__slug'],
+        recommended['computed_at'], recommended['updated_at'], recommended['total'],
+        same_category['updated_at'], same_category['total'],
+    )
+    last_modified = max(filter(None, (
+        product['updated_at'], recommended['computed_at'], recommended['updated_at'], same_category['updated_at']
+    )))
+    return etag_parts, last_modified
+
+
+def related_products_for(product, limit=4):
+    # Precomputed by the build_recommendations command
+    related_products = list(
+        Product.objects.filter(recommended_for__product=product)
+        .order_by('-recommended_for__score')[:limit]
+    )
+    # Cold start: pad with products from the same category
+    if len(related_products) < limit:
+        related_products += Product.objects.filter(
+            category=product.category
+        ).exclude(
+            id__in=[product.id] + [p.id for p in related_products]
+        )[:limit - len(related_products)]
+    return related_products
+
+
+class ConditionalGetMixin:
+    # Answers conditional GETs with a 304 before the view fetches its objects
+    # or renders its template. get_validators() returns (etag_parts,
+    # last_modified), or None to skip validation.
+
+    def get_validators(self):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+
+        etag_parts, last_modified = validators
+        etag = catalog_etag(request, self.__class__.__name__, etag_parts)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        response = super().get(request, *args, **kwargs)
+        return set_catalog_validators(response, etag, last_modified)
+
+
+class ProductListView(ConditionalGetMixin, ListView):
     model = Product
     template_name = 'store/product_list.html'
     context_object_name = 'products'
     paginate_by = 12
     
+    @cached_property
+    def snapshot(self):
+        # Lists, counts and categories come from the catalog snapshot when there is one
+        return catalog_snapshot.for_category(self.kwargs.get('category_slug'))
+    
     def get_queryset(self):
-        queryset = super().get_queryset()
         category_slug = self.kwargs.get('category_slug')
         search_query = self.request.GET.get('q')
+        category = None
+        
+        if self.snapshot is not None:
+            if category_slug:
+                category = self.snapshot.category(category_slug)
+            if search_query:
+                return SearchResults(search_query, category)
+            return self.snapshot.products(category_slug)
         
+        queryset = super().get_queryset()
         if category_slug:
             category = get_object_or_404(Category, slug=category_slug)
             queryset = queryset.filter(category=category)
         
         if search_query:
-            queryset = queryset.filter(
-                Q(name__icontains=search_query) | 
-                Q(description__icontains=search_query) |
-                Q(category__name__icontains=search_query)
-            )
+            # Counts and page ids come from the search result cache
+            return SearchResults(search_query, category)
         
         return queryset
     
+    def get_validators(self):
+        # Search results run an expensive icontains scan; don't do it twice
+        if self.request.GET.get('q'):
+            return None
+        
+        state = catalog_list_validators(self.kwargs.get('category_slug'), self.snapshot)
+        return (state['last_modified'], state['total'], state['categories']), state['last_modified']
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
-        
         category_slug = self.kwargs.get('category_slug')
-        if category_slug:
-            context['current_category'] = get_object_or_404(Category, slug=category_slug)
+        if self.snapshot is not None:
+            context['categories'] = self.snapshot.categories()
+            if category_slug:
+                context['current_category'] = self.snapshot.category(category_slug)
+        else:
+            context['categories'] = Category.objects.all()
+            if category_slug:
+                context['current_category'] = get_object_or_404(Category, slug=category_slug)
         
         search_query = self.request.GET.get('q')
         if search_query:
@@ -65,41 +196,33 @@ class ProductListView(ListView):
         return context
 
 
-class ProductDetailView(DetailView):
+class ProductDetailView(ConditionalGetMixin, DetailView):
     model = Product
     template_name = 'store/product_detail.html'
     context_object_name = 'product'
     
+    def get_validators(self):
+        return product_detail_validators(self.kwargs.get('slug'))
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        product = self.get_object()
-        context['related_products'] = Product.objects.filter(
-            category=product.category
-        ).exclude(id=product.id)[:4]
-        
-        # Check if product is in wishlist
-        if self.request.user.is_authenticated:
-            try:
-                wishlist = Wishlist.objects.get(user=self.request.user)
-                context['in_wishlist'] = WishlistItem.objects.filter(
-                    wishlist=wishlist, 
-                    product=product
-                ).exists()
-            except Wishlist.DoesNotExist:
-                context['in_wishlist'] = False
+        product = self.object
+        context['related_products'] = related_products_for(product)
         return context
 
 
 @login_required
 def add_to_cart(request, product_id):
     product = get_object_or_404(Product, id=product_id)
-    cart_item, created = CartItem.objects.get_or_create(
+    cart_item, created = CartItem.objects.for_user(request.user).get_or_create(
         user=request.user,
         product=product
     )
     
     if not created:
         cart_item.quantity += 1
+        # Adding again counts as activity for cart expiry
+        cart_item.date_added = timezone.now()
         cart_item.save()
     
     messages.success(request, f"{product.name} added to your cart.")
@@ -108,7 +231,7 @@ def add_to_cart(request, product_id):
 
 @login_required
 def cart(request):
-    cart_items = CartItem.objects.filter(user=request.user)
+    cart_items = CartItem.objects.for_user(request.user).prefetch_related('product')
     total = sum(item.total_price for item in cart_items)
     
     context = {
@@ -122,7 +245,7 @@ def cart(request):
 @login_required
 def update_cart(request, item_id):
     if request.method == 'POST':
-        cart_item = get_object_or_404(CartItem, id=item_id, user=request.user)
+        cart_item = get_object_or_404(CartItem.objects.for_user(request.user), id=item_id)
         action = request.POST.get('action')
         
         if action == 'increase':
@@ -143,7 +266,7 @@ def update_cart(request, item_id):
 
 @login_required
 def remove_from_cart(request, item_id):
-    cart_item = get_object_or_404(CartItem, id=item_id, user=request.user)
+    cart_item = get_object_or_404(CartItem.objects.for_user(request.user), id=item_id)
     cart_item.delete()
     messages.success(request, f"{cart_item.product.name} removed from your cart.")
     return redirect('cart')
@@ -185,20 +308,51 @@ def remove_from_wishlist(request, item_id):
 def wishlist(request):
     try:
         user_wishlist = Wishlist.objects.get(user=request.user)
-        wishlist_items = WishlistItem.objects.filter(wishlist=user_wishlist)
+        wishlist_items = list(WishlistItem.objects.filter(wishlist=user_wishlist).select_related('product'))
     except Wishlist.DoesNotExist:
         wishlist_items = []
     
+    # Cards come from the card cache; only the remove buttons are the user's
+    remove_buttons = {
+        item.product_id: render_to_string('store/fragments/wishlist_remove.html', {'item': item}, request=request)
+        for item in wishlist_items
+    }
     context = {
-        'wishlist_items': wishlist_items,
+        'wishlist_cards': render_cards([item.product for item in wishlist_items], 'wishlist', request, remove_buttons),
+        'restock_requests': RestockRequest.objects.filter(user=request.user).select_related('product'),
         'title': 'My Wishlist'
     }
     return render(request, 'store/wishlist.html', context)
 
 
+@login_required
+def add_restock_request(request, product_id):
+    product = get_object_or_404(Product, id=product_id)
+    if product.in_stock:
+        messages.info(request, f"{product.name} is in stock now.")
+    else:
+        RestockRequest.objects.get_or_create(user=request.user, product=product)
+        messages.success(request, f"We'll email you when {product.name} is back in stock.")
+    
+    if request.META.get('HTTP_REFERER'):
+        return redirect(request.META.get('HTTP_REFERER'))
+    return redirect('product-detail', slug=product.slug)
+
+
+@login_required
+def cancel_restock_request(request, product_id):
+    product = get_object_or_404(Product, id=product_id)
+    RestockRequest.objects.filter(user=request.user, product=product).delete()
+    messages.success(request, f"You won't be emailed about {product.name}.")
+    
+    if request.META.get('HTTP_REFERER'):
+        return redirect(request.META.get('HTTP_REFERER'))
+    return redirect('product-detail', slug=product.slug)
+
+
 @login_required
 def checkout(request):
-    cart_items = CartItem.objects.filter(user=request.user)
+    cart_items = CartItem.objects.for_user(request.user).prefetch_related('product')
     
     if not cart_items:
         messages.warning(request, "Your cart is empty. Add some products before checkout.")
@@ -219,27 +373,39 @@ def checkout(request):
 def create_payment(request):
     if request.method == 'POST':
         data = json.loads(request.body)
-        cart_items = CartItem.objects.filter(user=request.user)
+        # Products are in another database than a sharded cart, so no join
+        cart_items = CartItem.objects.for_user(request.user).prefetch_related('product')
         
         if not cart_items:
             return JsonResponse({'error': 'Your cart is empty'}, status=400)
         
+        # Turn shoppers away before they pay for what has already sold out
+        problem = stock_problem(cart_items)
+        if problem:
+            return JsonResponse({'error': problem}, status=409)
+        
         total_amount = int(sum(item.total_price for item in cart_items) * 100)  # Convert to cents for Stripe
         
         try:
-            # Create payment intent with Stripe
-            intent = stripe.PaymentIntent.create(
-                amount=total_amount,
-                currency='usd',
+            # Reuses the shopper's open PaymentIntent when the cart hasn't
+            # changed. Shipping details travel with the payment so the webhook
+            # worker can place the order if the browser never comes back
+            client_secret, _ = checkout_payment_intent(
+                request.user,
+                cart_items,
+                total_amount,
                 metadata={
-                    'user_id': request.user.id
+                    'user_id': request.user.id,
+                    **shipping_metadata(data.get('shipping') or {})
                 }
             )
             
             return JsonResponse({
-                'clientSecret': intent['client_secret']
+                'clientSecret': client_secret
             })
             
+        except payments.PaymentProviderBusy as e:
+            return JsonResponse({'error': str(e)}, status=503)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
     
@@ -250,55 +416,21 @@ def create_payment(request):
 def payment_success(request):
     if request.method == 'POST':
         payment_intent_id = request.POST.get('payment_intent_id')
-        shipping_data = {
-            'full_name': request.POST.get('full_name'),
-            'email': request.POST.get('email'),
-            'address': request.POST.get('address'),
-            'city': request.POST.get('city'),
-            'state': request.POST.get('state'),
-            'zip_code': request.POST.get('zip_code'),
-            'phone': request.POST.get('phone')
-        }
-        
-        cart_items = CartItem.objects.filter(user=request.user)
-        total_amount = sum(item.total_price for item in cart_items)
-        
-        # Create order
-        order = Order.objects.create(
-            user=request.user,
-            full_name=shipping_data['full_name'],
-            email=shipping_data['email'],
-            address=shipping_data['address'],
-            city=shipping_data['city'],
-            state=shipping_data['state'],
-            zip_code=shipping_data['zip_code'],
-            phone=shipping_data['phone'],
-            total_amount=total_amount,
-            payment_id=payment_intent_id,
-            payment_status=True,
-            status='processing'
-        )
+        shipping_data = {field: request.POST.get(field) for field in SHIPPING_FIELDS}
         
-        # Create order items
-        for cart_item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                price=cart_item.product.price,
-                quantity=cart_item.quantity
-            )
-            
-            # Update product stock
-            product = cart_item.product
-            product.stock -= cart_item.quantity
-            if product.stock <= 0:
-                product.available = False
-            product.save()
+        # Idempotent on the payment id, so a refresh or the webhook worker
+        # getting there first doesn't create a second order
+        order, created = place_order(request.user, payment_intent_id, shipping_data)
         
-        # Clear the cart
-        cart_items.delete()
+        if order is None:
+            messages.warning(request, "Your cart is empty. Add some products before checkout.")
+            return redirect('cart')
         
-        messages.success(request, "Your order has been placed successfully!")
+        if created and order.status == 'cancelled':
+            messages.error(request, "Sorry, part of your order sold out while you were paying. Your payment will be refunded.")
+            return redirect('cart')
+        if created:
+            messages.success(request, "Your order has been placed successfully!")
         return redirect('order-complete', order_id=order.id)
     
     return redirect('checkout')
@@ -306,8 +438,8 @@ def payment_success(request):
 
 @login_required
 def order_complete(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
-    order_items = OrderItem.objects.filter(order=order)
+    order = get_order_or_404(order_id, request.user)
+    order_items = order.items.prefetch_related('product')
     
     context = {
         'order': order,
@@ -319,10 +451,8 @@ def order_complete(request, order_id):
 
 @login_required
 def orders(request):
-    user_orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    
     context = {
-        'orders': user_orders,
+        'orders': user_orders(request.user),
         'title': 'My Orders'
     }
     return render(request, 'store/orders.html', context)
@@ -330,8 +460,9 @@ def orders(request):
 
 @login_required
 def order_detail(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
-    order_items = OrderItem.objects.filter(order=order)
+    # Older orders may have moved to the archive tables
+    order = get_order_or_404(order_id, request.user)
+    order_items = order.items.prefetch_related('product')
     
     context = {
         'order': order,
@@ -1,11 +1,33 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, api, async_views, page_cache, webhooks
+
+# Under ASGI the catalog and payment views run natively async
+if settings.ASYNC_VIEWS:
+    home = async_views.home
+    product_list = async_views.product_list
+    product_detail = async_views.product_detail
+    create_payment = async_views.create_payment
+else:
+    home = views.home
+    product_list = views.ProductListView.as_view()
+    product_detail = views.ProductDetailView.as_view()
+    create_payment = views.create_payment
+
+# Catalog pages are the same for every visitor and served from the page cache
+home = page_cache.full_page_cache(home)
+product_list = page_cache.full_page_cache(product_list)
+product_detail = page_cache.full_page_cache(product_detail)
 
 urlpatterns = [
-    path('', views.home, name='store-home'),
-    path('products/', views.ProductListView.as_view(), name='product-list'),
-    path('products/category/<slug:category_slug>/', views.ProductListView.as_view(), name='category-products'),
-    path('product/<slug:slug>/', views.ProductDetailView.as_view(), name='product-detail'),
+    path('', home, name='store-home'),
+    path('products/', product_list, name='product-list'),
+    path('products/category/<slug:category_slug>/', product_list, name='category-products'),
+    path('product/<slug:slug>/', product_detail, name='product-detail'),
+    
+    # User-specific parts of cached pages
+    path('fragments/', page_cache.fragments, name='page-fragments'),
+    path('fragments/<slug:name>/', page_cache.fragment, name='page-fragment'),
     
     # Cart URLs
     path('cart/', views.cart, name='cart'),
@@ -17,14 +39,25 @@ urlpatterns = [
     path('wishlist/', views.wishlist, name='wishlist'),
     path('add-to-wishlist/<int:product_id>/', views.add_to_wishlist, name='add-to-wishlist'),
     path('remove-from-wishlist/<int:item_id>/', views.remove_from_wishlist, name='remove-from-wishlist'),
+    path('notify-restock/<int:product_id>/', views.add_restock_request, name='add-restock-request'),
+    path('cancel-restock/<int:product_id>/', views.cancel_restock_request, name='cancel-restock-request'),
     
     # Checkout URLs
     path('checkout/', views.checkout, name='checkout'),
-    path('create-payment/', views.create_payment, name='create-payment'),
+    path('create-payment/', create_payment, name='create-payment'),
     path('payment-success/', views.payment_success, name='payment-success'),
     path('order-complete/<int:order_id>/', views.order_complete, name='order-complete'),
+    path('webhooks/stripe/', webhooks.stripe_webhook, name='stripe-webhook'),
     
     # Order URLs
     path('orders/', views.orders, name='orders'),
     path('order/<int:order_id>/', views.order_detail, name='order-detail'),
+    
+    # Catalog API URLs
+    path('api/v1/categories/', api.category_list, name='api-category-list'),
+    path('api/v1/products/', api.product_list, name='api-product-list'),
+    path('api/v1/products/<slug:slug>/', api.product_detail, name='api-product-detail'),
+    path('api/v1/suggest/', api.suggest, name='api-suggest'),
+    path('api/v1/search-cache/', api.search_cache_stats, name='api-search-cache-stats'),
+    path('api/v1/warmup/', api.warmup_stats, name='api-warmup-stats'),
 ]
\ No newline at end of file
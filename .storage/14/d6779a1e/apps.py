@@ -3,4 +3,9 @@ from django.apps import AppConfig
 
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'store'
\ No newline at end of file
+    name = 'store'
+
+    def ready(self):
+        # Keep the catalog version and the typeahead index in step with
+        # catalog edits, and check stock alerts when a product is saved
+        from . import catalog, stock_alerts, typeahead  # noqa: F401
@@ -1,8 +1,94 @@
-from django.contrib import admin
-from .models import Category, Product, CartItem, Order, OrderItem, WishlistItem
+import itertools
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.models import User
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.db.models import Q
+from django.http import QueryDict
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
+from . import order_status, sales, sharding
+from .tasks import enqueue
+from .models import Category, Product, CartItem, Order, OrderItem, WishlistItem, RestockRequest, PaymentEvent, CheckoutIntent, Task, TaskQueue, DailySales, ArchivedOrder, ArchivedOrderItem
+
+# Carts and orders are sharded (see sharding.py). Their admin pages show one
+# shard at a time, picked with the shard filter; change pages keep it in
+# _changelist_filters. Users and products are in the default database, so
+# they are prefetched and searched separately rather than joined.
+
+def admin_shard(request):
+    shard = request.GET.get('shard') or QueryDict(request.GET.get('_changelist_filters', '')).get('shard')
+    return shard if shard in sharding.all_shards() else sharding.all_shards()[0]
+
+class ShardFilter(admin.SimpleListFilter):
+    title = 'shard'
+    parameter_name = 'shard'
+    
+    def lookups(self, request, model_admin):
+        return [(db, db) for db in sharding.all_shards()]
+    
+    def has_output(self):
+        return len(self.lookup_choices) > 1
+    
+    def choices(self, changelist):
+        # No "All": the list is always of one shard
+        current = self.value() or sharding.all_shards()[0]
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': current == lookup,
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
+    
+    def queryset(self, request, queryset):
+        # ShardedAdmin.get_queryset has already picked the database
+        return queryset
+
+class ShardedChangeList(ChangeList):
+    def apply_select_related(self, qs):
+        related = []
+        for name in self.list_display:
+            try:
+                field = self.lookup_opts.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.many_to_one:
+                related.append(name)
+        return qs.prefetch_related(*related)
+
+class ShardedAdmin(admin.ModelAdmin):
+    # {foreign key: (model, field)} searched in the default database first
+    related_search_fields = {}
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(admin_shard(request))
+    
+    def get_list_filter(self, request):
+        return (ShardFilter, *super().get_list_filter(request))
+    
+    def get_changelist(self, request, **kwargs):
+        return ShardedChangeList
+    
+    def get_search_results(self, request, queryset, search_term):
+        searched, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if not search_term or not self.related_search_fields:
+            return searched, may_have_duplicates
+        matches = Q(pk__in=searched.values('pk'))
+        for field, (model, lookup) in self.related_search_fields.items():
+            ids = model._default_manager.filter(**{f'{lookup}__icontains': search_term}).values_list('pk', flat=True)
+            matches |= Q(**{f'{field}__in': list(ids[:1000])})
+        return queryset.filter(matches), may_have_duplicates
+
+class ShardedInline(admin.TabularInline):
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(admin_shard(request))
 
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ('name', 'slug')
+    list_display = ('name', 'slug', 'low_stock_threshold')
     prepopulated_fields = {'slug': ('name',)}
 
 class ProductAdmin(admin.ModelAdmin):
@@ -12,30 +98,197 @@ class ProductAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ('name', 'description')
 
-class CartItemAdmin(admin.ModelAdmin):
+class CartItemAdmin(ShardedAdmin):
     list_display = ('user', 'product', 'quantity', 'date_added')
     list_filter = ('date_added',)
-    search_fields = ('user__username', 'product__name')
+    search_fields = ('id__exact',)
+    related_search_fields = {'user': (User, 'username'), 'product': (Product, 'name')}
 
-class OrderItemInline(admin.TabularInline):
+class OrderItemInline(ShardedInline):
     model = OrderItem
     raw_id_fields = ['product']
     extra = 0
 
-class OrderAdmin(admin.ModelAdmin):
+def status_action(status, label):
+    """Admin action moving the selected orders to status (see order_status.py)."""
+    def action(modeladmin, request, queryset):
+        moved, skipped = order_status.transition(queryset, status)
+        modeladmin.message_user(request, f'{moved} order(s) marked as {label.lower()}.')
+        if skipped:
+            modeladmin.message_user(request, order_status.describe_skipped(skipped, status) + '.', messages.WARNING)
+    action.__name__ = f'mark_{status}'
+    return admin.action(action, permissions=['change'], description=f'Mark selected orders as {label.lower()}')
+
+class OrderAdmin(ShardedAdmin):
     list_display = ('id', 'user', 'full_name', 'total_amount', 'status', 'created_at', 'payment_status')
     list_filter = ('status', 'created_at', 'payment_status')
-    search_fields = ('user__username', 'full_name', 'email', 'payment_id')
+    search_fields = ('id__exact', 'full_name', 'email', 'payment_id')
+    related_search_fields = {'user': (User, 'username')}
     inlines = [OrderItemInline]
+    actions = [status_action(status, label) for status, label in Order.STATUS_CHOICES if status != 'pending']
+    all_shards_page_size = 100
+    
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and {'status', 'payment_status'} & set(form.changed_data):
+            enqueue('update_sales_rollups')
+    
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        order = form.instance
+        edited = 'total_amount' in form.changed_data or any(formset.has_changed() for formset in formsets)
+        if change and edited and (order.counted_in_sales or order.counts_as_sale):
+            enqueue('recount_sales_days', {'day': timezone.localdate(order.created_at).isoformat()})
+    
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        # Old order links keep working after the order has been archived
+        shard = admin_shard(request)
+        if (not Order.objects.using(shard).filter(pk=object_id).exists()
+                and ArchivedOrder.objects.using(shard).filter(pk=object_id).exists()):
+            response = redirect('admin:store_archivedorder_change', object_id)
+            response['Location'] += '?' + urlencode({'_changelist_filters': urlencode({'shard': shard})})
+            return response
+        return super().change_view(request, object_id, form_url, extra_context)
+    
+    def get_urls(self):
+        return [
+            path('all-shards/', self.admin_site.admin_view(self.all_shards_view), name='store_order_all_shards'),
+            *super().get_urls(),
+        ]
+    
+    def all_shards_view(self, request):
+        """Newest orders from every shard, merged (scatter-gather), with a date cursor."""
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        orders = Order.objects.order_by('-created_at', '-id')
+        status = request.GET.get('status', '')
+        if status:
+            orders = orders.filter(status=status)
+        query = request.GET.get('q', '').strip()
+        if query:
+            orders = orders.filter(Q(full_name__icontains=query) | Q(email__icontains=query) | Q(payment_id=query))
+        before, before_id = parse_datetime(request.GET.get('before', '')), request.GET.get('before_id', '')
+        if before and before_id.isdigit():
+            orders = orders.filter(Q(created_at__lt=before) | Q(created_at=before, id__lt=int(before_id)))
+        
+        # Each shard returns at most a page, so the merge reads a page from each
+        size = self.all_shards_page_size
+        merged = sharding.merged(orders[:size + 1], key=lambda order: (order.created_at, order.id), reverse=True)
+        page = list(itertools.islice(merged, size + 1))
+        more = len(page) > size
+        page = page[:size]
+        users = User.objects.in_bulk({order.user_id for order in page})
+        next_query = None
+        if more:
+            next_query = request.GET.copy()
+            next_query['before'] = page[-1].created_at.isoformat()
+            next_query['before_id'] = page[-1].id
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Orders on all shards',
+            'rows': [(order, order._state.db, users.get(order.user_id)) for order in page],
+            'shards': sharding.all_shards(),
+            'status': status,
+            'status_choices': Order.STATUS_CHOICES,
+            'query': query,
+            'next_query': next_query.urlencode() if next_query else None,
+        }
+        return TemplateResponse(request, 'admin/store/order_shards.html', context)
+
+class ArchivedOrderItemInline(ShardedInline):
+    model = ArchivedOrderItem
+    extra = 0
+
+class ArchivedOrderAdmin(ShardedAdmin):
+    # Archived orders are history: viewable, not editable
+    list_display = ('id', 'user', 'full_name', 'total_amount', 'status', 'created_at', 'archived_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('id__exact', 'full_name', 'email', 'payment_id')
+    related_search_fields = {'user': (User, 'username')}
+    inlines = [ArchivedOrderItemInline]
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 class WishlistItemAdmin(admin.ModelAdmin):
     list_display = ('wishlist', 'product', 'date_added')
     list_filter = ('date_added',)
     search_fields = ('wishlist__user__username', 'product__name')
 
+class RestockRequestAdmin(admin.ModelAdmin):
+    list_display = ('product', 'user', 'created_at')
+    raw_id_fields = ('product', 'user')
+    search_fields = ('product__name', 'user__username')
+
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'payment_id', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'event_type')
+    search_fields = ('event_id', 'payment_id')
+    readonly_fields = ('payload',)
+
+class CheckoutIntentAdmin(admin.ModelAdmin):
+    list_display = ('payment_id', 'user', 'amount', 'status', 'hits', 'updates', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('payment_id', 'user__username')
+    exclude = ('client_secret',)
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'queue', 'status', 'attempts', 'run_at', 'finished_at')
+    list_filter = ('status', 'queue', 'name')
+    search_fields = ('name', 'last_error')
+    readonly_fields = ('payload', 'last_error', 'claimed_by', 'claimed_at')
+
+class TaskQueueAdmin(admin.ModelAdmin):
+    list_display = ('name', 'concurrency', 'running')
+
+class DailySalesAdmin(admin.ModelAdmin):
+    # The changelist is the sales dashboard, built from the rollup tables only
+    DAY_OPTIONS = (7, 30, 90, 365)
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        if days not in self.DAY_OPTIONS:
+            days = 30
+        context = {
+            **self.admin_site.each_context(request),
+            **sales.dashboard(days),
+            'opts': self.model._meta,
+            'title': 'Sales dashboard',
+            'day_options': self.DAY_OPTIONS,
+        }
+        return TemplateResponse(request, 'admin/store/sales_dashboard.html', context)
+
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(CartItem, CartItemAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(OrderItem)
-admin.site.register(WishlistItem, WishlistItemAdmin)
\ No newline at end of file
+admin.site.register(ArchivedOrder, ArchivedOrderAdmin)
+admin.site.register(OrderItem, ShardedAdmin)
+admin.site.register(WishlistItem, WishlistItemAdmin)
+admin.site.register(RestockRequest, RestockRequestAdmin)
+admin.site.register(PaymentEvent, PaymentEventAdmin)
+admin.site.register(CheckoutIntent, CheckoutIntentAdmin)
+admin.site.register(Task, TaskAdmin)
+admin.site.register(TaskQueue, TaskQueueAdmin)
+admin.site.register(DailySales, DailySalesAdmin)
\ No newline at end of file
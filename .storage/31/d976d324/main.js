@@ -2,13 +2,43 @@
 
 document.addEventListener('DOMContentLoaded', function() {
     // Auto-hide alerts after 5 seconds
-    const alerts = document.querySelectorAll('.alert');
-    alerts.forEach(function(alert) {
-        setTimeout(function() {
-            const bsAlert = new bootstrap.Alert(alert);
-            bsAlert.close();
-        }, 5000);
-    });
+    const autoHideAlerts = function(root) {
+        root.querySelectorAll('.alert').forEach(function(alert) {
+            setTimeout(function() {
+                const bsAlert = new bootstrap.Alert(alert);
+                bsAlert.close();
+            }, 5000);
+        });
+    };
+    autoHideAlerts(document);
+
+    // Cached pages ship the anonymous version of user-specific regions
+    // ("holes") and blank CSRF tokens; fetch this visitor's versions
+    const holes = document.querySelectorAll('[data-hole]');
+    const csrfHoles = document.querySelectorAll('[data-csrf-hole]');
+    if (holes.length || csrfHoles.length) {
+        const params = new URLSearchParams();
+        holes.forEach(function(hole) {
+            params.append('hole', hole.dataset.hole);
+            new URLSearchParams(hole.dataset.holeParams).forEach(function(value, key) {
+                params.set(key, value);
+            });
+        });
+        fetch(document.body.dataset.fragmentsUrl + '?' + params.toString(), {credentials: 'same-origin'})
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                holes.forEach(function(hole) {
+                    const html = data.holes[hole.dataset.hole];
+                    if (html !== undefined) {
+                        hole.innerHTML = html;
+                        autoHideAlerts(hole);
+                    }
+                });
+                csrfHoles.forEach(function(input) {
+                    input.value = data.csrf_token;
+                });
+            });
+    }
 
     // Add animation to cards
     const cards = document.querySelectorAll('.card');
@@ -76,4 +106,68 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         });
     }
+
+    // Search suggestions
+    const searchInput = document.querySelector('input[data-suggest-url]');
+    const suggestionMenu = document.getElementById('search-suggestions');
+    if (searchInput && suggestionMenu) {
+        let debounceTimer = null;
+        let lastQuery = '';
+
+        const hideSuggestions = function() {
+            suggestionMenu.classList.remove('show');
+        };
+
+        const showSuggestions = function(results) {
+            suggestionMenu.innerHTML = '';
+            results.forEach(function(result) {
+                const link = document.createElement('a');
+                link.className = 'dropdown-item';
+                link.href = result.url;
+                link.textContent = result.name;
+                if (result.type === 'category') {
+                    const label = document.createElement('small');
+                    label.className = 'text-muted ml-2';
+                    label.textContent = 'Category';
+                    link.appendChild(label);
+                }
+                suggestionMenu.appendChild(link);
+            });
+            suggestionMenu.classList.toggle('show', results.length > 0);
+        };
+
+        searchInput.addEventListener('input', function() {
+            clearTimeout(debounceTimer);
+            const query = searchInput.value.trim();
+            if (!query) {
+                lastQuery = '';
+                hideSuggestions();
+                return;
+            }
+            debounceTimer = setTimeout(function() {
+                lastQuery = query;
+                fetch(searchInput.dataset.suggestUrl + '?q=' + encodeURIComponent(query))
+                    .then(function(response) { return response.json(); })
+                    .then(function(data) {
+                        // Ignore responses that arrive after the user kept typing
+                        if (data.query === lastQuery) {
+                            showSuggestions(data.results);
+                        }
+                    })
+                    .catch(hideSuggestions);
+            }, 100);
+        });
+
+        searchInput.addEventListener('keydown', function(event) {
+            if (event.key === 'Escape') {
+                hideSuggestions();
+            }
+        });
+
+        document.addEventListener('click', function(event) {
+            if (!searchInput.contains(event.target) && !suggestionMenu.contains(event.target)) {
+                hideSuggestions();
+            }
+        });
+    }
 });
\ No newline at end of file
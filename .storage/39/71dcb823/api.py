@@ -0,0 +1,267 @@
+"""
+Read-only catalog JSON API (v1).
+
+Rows are read with values() and encoded directly, so no model instances are
+built on the hot path. List and detail responses carry a strong ETag and a
+Last-Modified header derived from Product.updated_at and the category rows
+the payload shows (categories have no timestamp of their own), and
+conditional requests are answered with 304 before any rows are serialized.
+"""
+import base64
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from . import search, typeahead, warmup
+from .models import Category, Product
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+
+API_VERSION = 'v1'
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+# Public field name -> values() lookup
+PRODUCT_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'slug': 'slug',
+    'price': 'price',
+    'stock': 'stock',
+    'available': 'available',
+    'featured': 'featured',
+    'image': 'image',
+    'category': 'category__slug',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+}
+PRODUCT_DETAIL_FIELDS = dict(PRODUCT_FIELDS, description='description', category_name='category__name')
+DEFAULT_PRODUCT_FIELDS = ('id', 'name', 'slug', 'price', 'available', 'image', 'category')
+DEFAULT_SUGGESTIONS = 8
+
+
+def _encode_default(value):
+    # Decimal prices are sent as strings so clients never see float rounding
+    return str(value)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=_encode_default)
+    return json.dumps(data, default=_encode_default, separators=(',', ':')).encode()
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    return response
+
+
+def json_response(data, etag, last_modified):
+    response = HttpResponse(dumps(data), content_type='application/json')
+    return set_validators(response, etag, last_modified)
+
+
+def not_modified(request, etag, last_modified):
+    # Returns a 304 (or 412) response when the client's validators still match
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified and int(last_modified.timestamp()),
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def error_response(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def make_etag(*parts):
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def selected_fields(request, allowed, default):
+    requested = request.GET.get('fields')
+    if not requested:
+        return list(default)
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    return names
+
+
+def encode_cursor(created_at, pk):
+    raw = f'{created_at.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        created_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def serialize_row(row, fields, lookups):
+    item = {}
+    for name in fields:
+        value = row[lookups[name]]
+        if name == 'image':
+            value = f'{settings.MEDIA_URL}{value}' if value else None
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        item[name] = value
+    return item
+
+
+def category_state(*fields):
+    # Renaming a category changes product payloads without touching
+    # Product.updated_at, so their ETags include the category rows too
+    rows = Category.objects.order_by('id').values_list('id', 'slug', *fields)
+    return [':'.join(str(value) for value in row) for row in rows]
+
+
+@require_safe
+def category_list(request):
+    # Product counts change when a product is added, deleted (total) or moved
+    # to another category (updated_at)
+    state = Product.objects.aggregate(last_modified=Max('updated_at'), total=Count('id'))
+    last_modified = state['last_modified']
+    etag = make_etag(API_VERSION, 'categories', last_modified, state['total'],
+                     *category_state('name', 'description'))
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    categories = Category.objects.order_by('name').values('id', 'name', 'slug', 'description')
+    categories = list(categories.annotate(product_count=Count('products')))
+    return json_response({'results': categories}, etag=etag, last_modified=last_modified)
+
+
+@require_safe
+def product_list(request):
+    try:
+        fields = selected_fields(request, PRODUCT_FIELDS, DEFAULT_PRODUCT_FIELDS)
+        limit = min(int(request.GET.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        after = request.GET.get('after')
+        cursor = decode_cursor(after) if after else None
+    except ValueError as e:
+        return error_response(str(e))
+    if limit < 1:
+        return error_response('limit must be positive')
+
+    queryset = Product.objects.all()
+    category_slug = request.GET.get('category')
+    if category_slug:
+        queryset = queryset.filter(category__slug=category_slug)
+    if request.GET.get('available') == '1':
+        queryset = queryset.filter(available=True)
+
+    # One aggregate over the filtered set decides whether the page can have changed
+    state = queryset.aggregate(last_modified=Max('updated_at'), total=Count('id'))
+    last_modified = state['last_modified']
+    etag = make_etag(API_VERSION, 'products', request.GET.urlencode(), last_modified, state['total'],
+                     *category_state())
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    # Keyset pagination on the default (-created_at, -id) ordering
+    if cursor:
+        created_at, pk = cursor
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    lookups = {name: PRODUCT_FIELDS[name] for name in fields}
+    columns = set(lookups.values()) | {'id', 'created_at'}
+    rows = list(queryset.order_by('-created_at', '-id').values(*columns)[:limit + 1])
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None
+
+    data = {
+        'count': state['total'],
+        'next': next_cursor,
+        'results': [serialize_row(row, fields, lookups) for row in rows],
+    }
+    return json_response(data, etag=etag, last_modified=last_modified)
+
+
+@require_safe
+def product_detail(request, slug):
+    try:
+        fields = selected_fields(request, PRODUCT_DETAIL_FIELDS, PRODUCT_DETAIL_FIELDS)
+    except ValueError as e:
+        return error_response(str(e))
+
+    lookups = {name: PRODUCT_DETAIL_FIELDS[name] for name in fields}
+    columns = set(lookups.values()) | {'id', 'updated_at', 'category__name', 'category__slug'}
+    row = Product.objects.filter(slug=slug).values(*columns).first()
+    if row is None:
+        return error_response('No product found matching the query', status=404)
+
+    last_modified = row['updated_at']
+    etag = make_etag(API_VERSION, 'product', row['id'], last_modified.isoformat(), ','.join(fields),
+                     row['category__name'], row['category__slug'])
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    return json_response(serialize_row(row, fields, lookups), etag=etag, last_modified=last_modified)
+
+
+@require_safe
+def suggest(request):
+    # Answered from the in-process typeahead index, without database queries
+    query = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_SUGGESTIONS)), typeahead.MAX_RESULTS)
+    except ValueError:
+        return error_response('limit must be an integer')
+    if limit < 1:
+        return error_response('limit must be positive')
+
+    response = HttpResponse(
+        dumps({'query': query, 'results': typeahead.suggest(query, limit)}),
+        content_type='application/json',
+    )
+    response['Cache-Control'] = f'public, max-age={settings.TYPEAHEAD_CACHE_SECONDS}'
+    return response
+
+
+@require_safe
+def search_cache_stats(request):
+    # Stats of the search result cache in the process serving the request
+    if not request.user.is_staff:
+        return error_response('Staff only', status=403)
+    response = HttpResponse(dumps(search.cache_stats()), content_type='application/json')
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@require_safe
+def warmup_stats(request):
+    # How long the process serving the request took to warm up (store/warmup.py)
+    if not request.user.is_staff:
+        return error_response('Staff only', status=403)
+    response = HttpResponse(dumps(warmup.state), content_type='application/json')
+    response['Cache-Control'] = 'private, no-store'
+    return response
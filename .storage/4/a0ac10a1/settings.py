@@ -59,6 +59,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'plant_nursery.wsgi.application'
+ASGI_APPLICATION = 'plant_nursery.asgi.application'
+
+# Serve the async catalog and payment views (set by plant_nursery/asgi.py)
+ASYNC_VIEWS = os.environ.get('DJANGO_ASYNC_VIEWS') == '1'
 
 # Database
 DATABASES = {
@@ -68,6 +72,54 @@ DATABASES = {
     }
 }
 
+# PostgreSQL instead of SQLite when POSTGRES_DB is set (needs psycopg), e.g. to
+# run bench_checkout.py against both
+if os.environ.get('POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['POSTGRES_DB'],
+        'USER': os.environ.get('POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', ''),
+        'PORT': os.environ.get('POSTGRES_PORT', ''),
+    }
+    # A connection pool per process (needs psycopg[pool]); warm-up fills it at boot
+    if os.environ.get('POSTGRES_POOL') == '1':
+        DATABASES['default']['OPTIONS'] = {'pool': True}
+
+# Cache
+# Without CACHE_URL every process gets its own in-memory cache, which is only
+# right for a single process. Point it at Redis (redis://..., needs redis) or
+# Memcached (memcached://host:port, needs pymemcache) to share one cache
+# between workers.
+CACHE_URL = os.environ.get('CACHE_URL', '')
+if CACHE_URL.startswith(('redis://', 'rediss://')):
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': CACHE_URL}}
+elif CACHE_URL.startswith('memcached://'):
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': CACHE_URL.removeprefix('memcached://'),
+    }}
+SHARED_CACHE = bool(CACHE_URL)
+
+# Sessions and messages
+# SESSION_BACKEND_PROFILE selects how sessions and flash messages are stored:
+#   'db'             - Django defaults (every session write hits django_session)
+#   'cached_db'      - sessions read through the cache, unchanged sessions are
+#                      never re-saved, messages kept in a signed cookie. The
+#                      default with a shared cache; with a per-process one a
+#                      logout wouldn't reach the copies in other workers
+#   'signed_cookies' - no server-side session storage at all; sessions can't be
+#                      revoked server-side and are limited to ~4 KB
+SESSION_BACKEND_PROFILE = os.environ.get('SESSION_BACKEND_PROFILE', 'cached_db' if SHARED_CACHE else 'db')
+
+if SESSION_BACKEND_PROFILE == 'cached_db':
+    SESSION_ENGINE = 'users.sessions'
+    MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+elif SESSION_BACKEND_PROFILE == 'signed_cookies':
+    SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+    MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -101,6 +153,21 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are stored under content-addressed names (store/media.py)
+STORAGES = {
+    'default': {'BACKEND': 'store.media.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# How MEDIA_URL is served:
+#   'file'       - by Django, sent with sendfile() where the WSGI server supports it
+#   'x-accel'    - handed to nginx with X-Accel-Redirect to MEDIA_ACCEL_REDIRECT_LOCATION
+#   'x-sendfile' - handed to Apache/lighttpd with X-Sendfile
+#   'off'        - not served by Django (except by django.views.static in DEBUG)
+MEDIA_SERVE_MODE = os.environ.get('MEDIA_SERVE_MODE', 'file')
+MEDIA_ACCEL_REDIRECT_LOCATION = '/protected-media/'
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24  # seconds, for files without a content hash in their name
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -114,4 +181,99 @@ LOGIN_URL = 'login'
 # Stripe Settings
 STRIPE_PUBLIC_KEY = 'your_stripe_public_key'
 STRIPE_SECRET_KEY = 'your_stripe_secret_key'
-STRIPE_WEBHOOK_SECRET = 'your_stripe_webhook_secret'
\ No newline at end of file
+STRIPE_WEBHOOK_SECRET = 'your_stripe_webhook_secret'
+# Point at a local fake provider (python fake_payment_server.py) for benchmarks
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE', '')
+
+# Payment provider calls
+PAYMENT_TIMEOUT = 10  # seconds to wait for a response
+PAYMENT_CONNECT_TIMEOUT = 3
+PAYMENT_MAX_CONCURRENCY = 20  # in-flight provider calls per process
+PAYMENT_QUEUE_TIMEOUT = 5  # seconds to wait for a free slot before giving up
+PAYMENT_MAX_RETRIES = 1
+PAYMENT_INTENT_ABANDON_AFTER = 60 * 60 * 24  # seconds before an unpaid checkout intent is canceled
+
+# Email
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 25))
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'Plant Nursery <orders@plantnursery.example>')
+
+# Background tasks (python manage.py run_tasks)
+TASK_QUEUES = {  # queue name: batches in flight across all workers
+    'default': 4,
+    'email': 2,
+    'maintenance': 1,
+    'rollups': 1,  # rollup updates must not run concurrently
+}
+TASK_RETRY_BASE_DELAY = 10  # seconds, doubled on every attempt
+TASK_RETRY_MAX_DELAY = 60 * 60
+TASK_STALE_AFTER = 60 * 15  # seconds before a claimed task is assumed lost
+
+# Stock alerts. The threshold is for products and categories without their
+# own; staff users' addresses are used when STOCK_ALERT_EMAILS is empty.
+LOW_STOCK_THRESHOLD = 5
+STOCK_ALERT_EMAILS = [email for email in os.environ.get('STOCK_ALERT_EMAILS', '').split(',') if email]
+# Low-stock alerts raised within this many seconds share one digest email
+STOCK_ALERT_DIGEST_DELAY = 300
+# Restock emails sent (and requests cleared) per batch
+RESTOCK_NOTIFY_CHUNK = 500
+
+# Delivered/cancelled orders untouched this long move to the archive tables
+# (python manage.py archive_orders)
+ORDER_ARCHIVE_AFTER_DAYS = 365
+
+# Carts with no item added for this long are deleted by purge_carts
+CART_TTL_DAYS = 30
+
+# Typeahead suggestions (api/v1/suggest/)
+TYPEAHEAD_SYNC_SECONDS = 30  # how often each process picks up products changed elsewhere
+TYPEAHEAD_REBUILD_SECONDS = 60 * 15  # full rebuild: deletions and popularity
+TYPEAHEAD_CACHE_SECONDS = 60  # Cache-Control max-age on suggestion responses
+
+# Search result cache, per process (api/v1/search-cache/ shows its stats)
+SEARCH_CACHE_MAX_ENTRIES = 5000
+SEARCH_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# Full-page cache for the catalog pages (store/page_cache.py)
+PAGE_CACHE_TIMEOUT = 60 * 60  # seconds in Django's cache; catalog edits invalidate sooner
+PAGE_CACHE_SHARED_MAX_AGE = 60  # s-maxage for a caching reverse proxy
+PAGE_CACHE_ESI = os.environ.get('PAGE_CACHE_ESI') == '1'  # the proxy fills the holes with edge-side includes
+
+# Product cards, cached per product version (store/cards.py)
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Memory-mapped catalog snapshot the catalog pages read (store/catalog_snapshot.py),
+# written by python manage.py build_catalog_snapshot [--watch]; without the
+# file the pages read the database
+CATALOG_SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT_PATH', BASE_DIR / 'catalog.snapshot')
+CATALOG_SNAPSHOT_CHECK_SECONDS = 2  # how often each process looks for a newly published snapshot
+CATALOG_SNAPSHOT_WATCH_SECONDS = 5  # how often --watch reads the change feed
+
+# Sitemaps (python manage.py build_sitemaps); the index is served at /sitemap.xml
+SITEMAP_ROOT = BASE_DIR / 'sitemaps'
+SITEMAP_URL = '/sitemaps/'
+SITEMAP_BASE_URL = os.environ.get('SITEMAP_BASE_URL', 'http://localhost:8000')  # scheme and host for <loc>
+SITEMAP_SHARD_SIZE = 50000  # product ids per file; the protocol allows up to 50,000 URLs
+
+# Cart and order data sharded by user (store/sharding.py). 'default' is shard
+# 0; SHARD_COUNT > 1 adds SQLite databases db-shard-<n>.sqlite3 for the rest.
+# Migrate each new shard with migrate --database=shard_<n>, then run
+# rebalance_shards. Only append to SHARD_DATABASES: its order sets id ranges
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+DATABASES.update({
+    f'shard_{n}': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / f'db-shard-{n}.sqlite3'}
+    for n in range(1, SHARD_COUNT)
+})
+SHARD_DATABASES = ['default'] + [f'shard_{n}' for n in range(1, SHARD_COUNT)]
+DATABASE_ROUTERS = ['store.sharding.ShardRouter']
+SHARD_DIRECTORY_TIMEOUT = 60  # seconds a user's shard stays cached in each process
+
+# Change feed of products, categories and orders (store/outbox.py); events
+# older than this are compacted even if a consumer hasn't read them
+OUTBOX_RETENTION = 60 * 60 * 24 * 7
+
+# Worker warm-up at boot (store/warmup.py), run by plant_nursery/asgi.py
+WARMUP_ON_BOOT = os.environ.get('WARMUP_ON_BOOT', '1') == '1'
+WARMUP_BASE_URL = os.environ.get('WARMUP_BASE_URL', SITEMAP_BASE_URL)  # scheme and host the pages are cached for
+# Modules the URLconf doesn't import, which requests would otherwise import on first use
+WARMUP_IMPORTS = ['store.async_views', 'store.tasks', 'store.order_status', 'django.core.mail.backends.smtp']
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.models import create_missing_profiles
+
+
+class Command(BaseCommand):
+    help = 'Create missing Profile and Wishlist rows in bulk (e.g. after User.objects.bulk_create)'
+
+    def handle(self, *args, **options):
+        created = create_missing_profiles()
+        self.stdout.write(self.style.SUCCESS(f'Created {created} missing profile(s).'))
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import django
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plant_nursery.settings')
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+# Registration and login throughput benchmark.
+#
+#   python bench_auth.py [iterations]
+#
+# Uses the MD5 hasher so the numbers measure request and database cost rather
+# than PBKDF2. Users created by the run are deleted afterwards.
+
+PREFIX = 'bench_auth_'
+PASSWORD = 'Bench-pass-123'
+
+
+def count_writes(queries):
+    writes = 0
+    for query in queries:
+        sql = query['sql'].lstrip().upper()
+        if sql.startswith(('INSERT', 'UPDATE', 'DELETE')):
+            writes += 1
+    return writes
+
+
+def run(label, requests):
+    start = time.perf_counter()
+    total_queries = total_writes = 0
+    for make_request in requests:
+        with CaptureQueriesContext(connection) as queries:
+            response = make_request()
+        assert response.status_code == 302, response.status_code
+        total_queries += len(queries)
+        total_writes += count_writes(queries.captured_queries)
+    elapsed = time.perf_counter() - start
+    n = len(requests)
+    print(f"{label:<14} {n / elapsed:8.1f} req/s   "
+          f"{total_queries / n:5.1f} queries/req   {total_writes / n:5.1f} writes/req")
+
+
+def bench(iterations):
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+    client = Client()
+    usernames = [f'{PREFIX}{i}' for i in range(iterations)]
+
+    def register(username):
+        return lambda: client.post('/register/', {
+            'username': username,
+            'email': f'{username}@example.com',
+            'password1': PASSWORD,
+            'password2': PASSWORD,
+        })
+
+    def login(username):
+        def make_request():
+            response = client.post('/login/', {'username': username, 'password': PASSWORD})
+            client.cookies.clear()
+            return response
+        return make_request
+
+    run('register', [register(username) for username in usernames])
+    run('login', [login(username) for username in usernames])
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    User.objects.filter(username__startswith=PREFIX).delete()
+    try:
+        with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+            bench(iterations)
+    finally:
+        User.objects.filter(username__startswith=PREFIX).delete()
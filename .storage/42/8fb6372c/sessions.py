@@ -0,0 +1,34 @@
+"""
+Session backend that skips writes when the session data hasn't changed.
+"""
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+
+
+class SessionStore(CachedDBStore):
+    """
+    cached_db sessions that remember what was loaded and turn save() into a
+    no-op when the data is unchanged. Re-assigning the same value, or code
+    that marks the session modified without changing it, no longer costs an
+    UPDATE on django_session.
+    """
+
+    _loaded_snapshot = None
+
+    def _snapshot(self, data):
+        return self.serializer().dumps(data)
+
+    def load(self):
+        data = super().load()
+        self._loaded_snapshot = self._snapshot(data)
+        return data
+
+    def save(self, must_create=False):
+        if (
+            not must_create
+            and self.session_key is not None
+            and self._loaded_snapshot is not None
+            and self._snapshot(self._get_session(no_load=True)) == self._loaded_snapshot
+        ):
+            return
+        super().save(must_create)
+        self._loaded_snapshot = self._snapshot(self._session)
@@ -0,0 +1,39 @@
+import time
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Delete expired sessions in small batches so the session table is never locked for long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Sessions deleted per statement (default 1000)')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches (default 0.1)')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches; the next run resumes')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        now = timezone.now()
+        purged = batches = 0
+
+        while options['max_batches'] is None or batches < options['max_batches']:
+            # Select a bounded set of keys first; deleting by primary key keeps
+            # each statement short and avoids a range lock over expire_date
+            keys = list(
+                Session.objects.filter(expire_date__lt=now)
+                .values_list('session_key', flat=True)[:batch_size]
+            )
+            if not keys:
+                break
+            deleted, _ = Session.objects.filter(session_key__in=keys).delete()
+            purged += deleted
+            batches += 1
+            if len(keys) < batch_size:
+                break
+            time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} expired session(s) in {batches} batch(es).'))
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import django
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plant_nursery.settings')
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from store.models import Product, CartItem
+
+# Database writes per request for a typical logged-in shopping session.
+#
+#   SESSION_BACKEND_PROFILE=db python bench_sessions.py [rounds]
+#   SESSION_BACKEND_PROFILE=cached_db python bench_sessions.py [rounds]
+#   SESSION_BACKEND_PROFILE=signed_cookies python bench_sessions.py [rounds]
+#
+# Needs the sample data (python sample_data.py).
+
+USERNAME = 'bench_sessions'
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def cart_item_id():
+    return CartItem.objects.for_user(User.objects.get(username=USERNAME)).values_list('id', flat=True).get()
+
+
+def shopping_flow(product):
+    # Each step returns (method, url, data); urls are resolved outside the
+    # measured request so the bench's own lookups aren't counted
+    return [
+        lambda: ('get', '/', None),
+        lambda: ('get', '/products/', None),
+        lambda: ('get', product.get_absolute_url(), None),
+        lambda: ('post', f'/add-to-cart/{product.id}/', None),
+        lambda: ('get', '/cart/', None),
+        lambda: ('post', f'/update-cart/{cart_item_id()}/', {'action': 'increase'}),
+        lambda: ('post', f'/add-to-wishlist/{product.id}/', None),
+        lambda: ('get', '/wishlist/', None),
+        lambda: ('post', f'/remove-from-cart/{cart_item_id()}/', None),
+        lambda: ('get', '/cart/', None),
+    ]
+
+
+def bench(rounds):
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+    user, created = User.objects.get_or_create(username=USERNAME)
+    product = Product.objects.filter(available=True, stock__gt=5).first()
+    client = Client()
+    client.force_login(user)
+
+    requests = queries = writes = session_reads = session_writes = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for step in shopping_flow(product):
+            method, url, data = step()
+            with CaptureQueriesContext(connection) as captured:
+                getattr(client, method)(url, data)
+            requests += 1
+            for query in captured.captured_queries:
+                sql = query['sql'].lstrip().upper()
+                queries += 1
+                is_write = sql.startswith(WRITE_PREFIXES)
+                writes += is_write
+                if 'DJANGO_SESSION' in sql:
+                    session_writes += is_write
+                    session_reads += not is_write
+    elapsed = time.perf_counter() - start
+
+    print(f"profile: {settings.SESSION_BACKEND_PROFILE}  ({settings.SESSION_ENGINE})")
+    print(f"requests:               {requests} in {elapsed:.2f}s")
+    print(f"queries per request:    {queries / requests:.2f}")
+    print(f"writes per request:     {writes / requests:.2f}")
+    print(f"session reads/request:  {session_reads / requests:.2f}")
+    print(f"session writes/request: {session_writes / requests:.2f}")
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    try:
+        bench(rounds)
+    finally:
+        User.objects.filter(username=USERNAME).delete()
@@ -0,0 +1,173 @@
+"""
+Item-to-item recommendations from order and wishlist co-occurrence.
+
+Purchases (paid orders that weren't cancelled, archived or not) and
+wishlist saves form a sparse user x product matrix X. Products
+that appear together for the same users get a high cosine similarity in
+X.T @ X, and the top K neighbours of each product are written to
+ProductRecommendation for the product detail page to read.
+
+This module is only used by the build_recommendations command, so web workers
+never import NumPy or SciPy.
+"""
+import numpy as np
+from scipy import sparse
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedOrderItem, OrderItem, WishlistItem, ProductRecommendation, RecommendationBuild
+from .sharding import all_shards
+
+ORDER_WEIGHT = 1.0
+WISHLIST_WEIGHT = 0.5
+DEFAULT_TOP_K = 10
+
+
+def _purchases(item_model, using):
+    # Only what was actually bought: refunded (payment_status cleared) and
+    # cancelled orders don't count
+    return item_model.objects.using(using).filter(order__payment_status=True).exclude(order__status='cancelled')
+
+
+def _binary_matrix(pairs, user_index, product_index, shape):
+    users = np.fromiter((user_index[u] for u, p in pairs), dtype=np.int64, count=len(pairs))
+    products = np.fromiter((product_index[p] for u, p in pairs), dtype=np.int64, count=len(pairs))
+    matrix = sparse.csr_matrix((np.ones(len(pairs)), (users, products)), shape=shape)
+    # Repeat purchases of the same product count once
+    matrix.data[:] = 1.0
+    return matrix
+
+
+def interaction_matrix():
+    """
+    Return (X, product_ids) where X is a CSR users x products matrix of
+    weighted interactions and product_ids maps columns back to Product ids.
+    """
+    order_pairs = list({
+        pair
+        for db in all_shards()
+        for item_model in (OrderItem, ArchivedOrderItem)
+        for pair in _purchases(item_model, db).values_list('order__user_id', 'product_id').distinct()
+    })
+    wishlist_pairs = list(WishlistItem.objects.values_list('wishlist__user_id', 'product_id').distinct())
+    pairs = order_pairs + wishlist_pairs
+    if not pairs:
+        return sparse.csr_matrix((0, 0)), np.array([], dtype=np.int64)
+
+    user_ids, product_ids = np.unique([u for u, p in pairs]), np.unique([p for u, p in pairs])
+    user_index = {u: i for i, u in enumerate(user_ids.tolist())}
+    product_index = {p: i for i, p in enumerate(product_ids.tolist())}
+    shape = (len(user_ids), len(product_ids))
+
+    X = ORDER_WEIGHT * _binary_matrix(order_pairs, user_index, product_index, shape)
+    if wishlist_pairs:
+        X = X + WISHLIST_WEIGHT * _binary_matrix(wishlist_pairs, user_index, product_index, shape)
+    return X.tocsr(), product_ids
+
+
+def column_norms(X):
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).ravel())
+    norms[norms == 0] = 1.0
+    return norms
+
+
+def top_k_similar(X, norms, columns, top_k):
+    """
+    Cosine similarity between the given product columns and every product.
+    X must be in CSC format and norms come from column_norms(X).
+
+    Returns {column: [(other_column, score), ...]} holding the top_k
+    neighbours of each column, best first.
+    """
+    # Co-occurrence of the selected columns with all columns: |columns| x products
+    cooc = (X[:, columns].T @ X).tocsr()
+    # Cosine normalisation: divide each entry by both column norms
+    cooc = sparse.diags(1.0 / norms[columns]) @ cooc @ sparse.diags(1.0 / norms)
+    cooc = cooc.tocsr()
+
+    neighbours = {}
+    for row, column in enumerate(columns):
+        start, end = cooc.indptr[row], cooc.indptr[row + 1]
+        others, scores = cooc.indices[start:end], cooc.data[start:end]
+        keep = others != column
+        others, scores = others[keep], scores[keep]
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+            others, scores = others[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        neighbours[column] = list(zip(others[order].tolist(), scores[order].tolist()))
+    return neighbours
+
+
+def changed_products(since, product_ids):
+    """
+    Columns of the products that were ordered or wishlisted after `since`,
+    or are in an order that was since paid, cancelled or refunded.
+    Archiving doesn't change an order's items, so archived ones never count.
+    """
+    touched = {
+        product_id
+        for db in all_shards()
+        for product_id in OrderItem.objects.using(db).filter(order__updated_at__gt=since).values_list(
+            'product_id', flat=True
+        )
+    }
+    touched |= set(WishlistItem.objects.filter(date_added__gt=since).values_list('product_id', flat=True))
+    column_of = {p: i for i, p in enumerate(product_ids.tolist())}
+    return sorted(column_of[p] for p in touched if p in column_of)
+
+
+def _record_build(started, incremental, products):
+    # Every build counts, even one that rewrote nothing: the next incremental
+    # build only needs to look at activity since this one started
+    RecommendationBuild.objects.create(started_at=started, incremental=incremental, products=products)
+    RecommendationBuild.objects.filter(started_at__lt=started).delete()
+    return products
+
+
+def build(top_k=DEFAULT_TOP_K, incremental=False, batch_size=1000):
+    """
+    Recompute ProductRecommendation rows. With incremental=True only products
+    affected by activity since the last build started are refreshed. Returns
+    the number of products whose recommendations were rewritten.
+    """
+    started = timezone.now()
+    X, product_ids = interaction_matrix()
+    if X.shape[1] == 0:
+        return _record_build(started, incremental, 0)
+    X = X.tocsc()
+    norms = column_norms(X)
+
+    if incremental:
+        last_build = RecommendationBuild.objects.order_by('-started_at').values_list('started_at', flat=True).first()
+        if last_build is None:
+            columns = list(range(X.shape[1]))
+        else:
+            changed = changed_products(last_build, product_ids)
+            if not changed:
+                return _record_build(started, incremental, 0)
+            # Neighbours of a changed product see a changed similarity too
+            related = (X[:, changed].T @ X).tocsr()
+            columns = sorted(set(changed) | set(related.indices.tolist()))
+    else:
+        columns = list(range(X.shape[1]))
+
+    recommendations = []
+    for start in range(0, len(columns), batch_size):
+        neighbours = top_k_similar(X, norms, columns[start:start + batch_size], top_k)
+        for column, similar in neighbours.items():
+            for other, score in similar:
+                recommendations.append(ProductRecommendation(
+                    product_id=int(product_ids[column]),
+                    recommended_id=int(product_ids[other]),
+                    score=score,
+                    computed_at=started,
+                ))
+
+    refreshed = [int(product_ids[column]) for column in columns]
+    with transaction.atomic():
+        if incremental:
+            ProductRecommendation.objects.filter(product_id__in=refreshed).delete()
+        else:
+            ProductRecommendation.objects.all().delete()
+        ProductRecommendation.objects.bulk_create(recommendations, batch_size=batch_size)
+        return _record_build(started, incremental, len(refreshed))
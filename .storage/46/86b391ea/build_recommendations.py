@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from store import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the "related products" table from order and wishlist co-occurrence'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=recommendations.DEFAULT_TOP_K,
+                            help='Recommendations stored per product')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only refresh products affected by orders and wishlist saves since the last build')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Products scored per matrix multiplication')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        refreshed = recommendations.build(
+            top_k=options['top_k'],
+            incremental=options['incremental'],
+            batch_size=options['batch_size'],
+        )
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed recommendations for {refreshed} product(s) in {elapsed:.2f}s.'
+        ))
@@ -0,0 +1,166 @@
+"""
+Payment provider client.
+
+All calls to Stripe go through one process-wide StripeClient backed by a
+pooled, keep-alive httpx client with explicit timeouts. In-flight provider
+calls are capped per process (PAYMENT_MAX_CONCURRENCY), so a slow provider
+makes extra checkouts fail fast with PaymentProviderBusy instead of tying up
+every worker.
+"""
+import asyncio
+import ssl
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+import stripe
+from django.conf import settings
+
+
+class PaymentProviderBusy(Exception):
+    pass
+
+
+class PooledHTTPXClient(stripe.HTTPXClient):
+    """
+    stripe.HTTPXClient with bounded connection pools for both the sync and
+    the async client.
+    """
+
+    def __init__(self, timeout, max_connections, max_keepalive_connections, **kwargs):
+        super().__init__(timeout=timeout, allow_sync_methods=True, **kwargs)
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=30,
+        )
+        verify = ssl.create_default_context(cafile=stripe.ca_bundle_path) if self._verify_ssl_certs else False
+        self._client_async = httpx.AsyncClient(limits=limits, verify=verify)
+        self._client = httpx.Client(limits=limits, verify=verify)
+
+
+_client = None
+_client_lock = threading.Lock()
+_sync_slots = None
+_async_slots = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    global _client, _sync_slots
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                timeout = httpx.Timeout(
+                    settings.PAYMENT_TIMEOUT,
+                    connect=settings.PAYMENT_CONNECT_TIMEOUT,
+                )
+                http_client = PooledHTTPXClient(
+                    timeout=timeout,
+                    max_connections=settings.PAYMENT_MAX_CONCURRENCY,
+                    max_keepalive_connections=settings.PAYMENT_MAX_CONCURRENCY,
+                )
+                base_addresses = {'api': settings.STRIPE_API_BASE} if settings.STRIPE_API_BASE else {}
+                _sync_slots = threading.BoundedSemaphore(settings.PAYMENT_MAX_CONCURRENCY)
+                _client = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    http_client=http_client,
+                    base_addresses=base_addresses,
+                    max_network_retries=settings.PAYMENT_MAX_RETRIES,
+                )
+    return _client
+
+
+def string_metadata(metadata):
+    # Stripe stores metadata values as strings
+    return {key: str(value) for key, value in metadata.items()}
+
+
+def _payment_intent_params(amount, currency=None, metadata=None):
+    params = {
+        'amount': amount,
+        'metadata': string_metadata(metadata or {}),
+    }
+    if currency:
+        params['currency'] = currency
+    return params
+
+
+@contextmanager
+def _provider_slot():
+    get_client()
+    if not _sync_slots.acquire(timeout=settings.PAYMENT_QUEUE_TIMEOUT):
+        raise PaymentProviderBusy('Payment provider is busy, please try again.')
+    try:
+        yield
+    finally:
+        _sync_slots.release()
+
+
+def create_payment_intent(amount, currency='usd', metadata=None):
+    with _provider_slot():
+        return get_client().payment_intents.create(params=_payment_intent_params(amount, currency, metadata))
+
+
+def update_payment_intent(payment_id, amount, metadata=None):
+    with _provider_slot():
+        return get_client().payment_intents.update(payment_id, params=_payment_intent_params(amount, metadata=metadata))
+
+
+def cancel_payment_intent(payment_id):
+    with _provider_slot():
+        return get_client().payment_intents.cancel(payment_id)
+
+
+def refund_payment(payment_id):
+    """
+    Give the money for a payment back: refund it if it went through, cancel
+    it if it hasn't yet. Returns the refund, the canceled intent, or None
+    when there is nothing left to give back.
+    """
+    client = get_client()
+    with _provider_slot():
+        try:
+            return client.refunds.create(params={'payment_intent': payment_id})
+        except stripe.InvalidRequestError:
+            # Not captured (or already refunded)
+            pass
+        try:
+            return client.payment_intents.cancel(payment_id)
+        except stripe.InvalidRequestError:
+            # Already canceled or refunded
+            return None
+
+
+def _async_semaphore():
+    # asyncio primitives are bound to the loop that first uses them
+    loop = asyncio.get_running_loop()
+    semaphore = _async_slots.get(loop)
+    if semaphore is None:
+        semaphore = _async_slots[loop] = asyncio.Semaphore(settings.PAYMENT_MAX_CONCURRENCY)
+    return semaphore
+
+
+@asynccontextmanager
+async def _aprovider_slot():
+    semaphore = _async_semaphore()
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=settings.PAYMENT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PaymentProviderBusy('Payment provider is busy, please try again.')
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+async def acreate_payment_intent(amount, currency='usd', metadata=None):
+    client = get_client()
+    async with _aprovider_slot():
+        return await client.payment_intents.create_async(params=_payment_intent_params(amount, currency, metadata))
+
+
+async def aupdate_payment_intent(payment_id, amount, metadata=None):
+    client = get_client()
+    async with _aprovider_slot():
+        return await client.payment_intents.update_async(payment_id, params=_payment_intent_params(amount, metadata=metadata))
@@ -0,0 +1,179 @@
+"""
+Async versions of the catalog and payment views, used when the site runs
+under ASGI (see plant_nursery/asgi.py). They behave like their counterparts
+in views.py; the difference is that create_payment awaits the payment
+provider instead of blocking a worker thread for the whole round trip.
+"""
+import json
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator, InvalidPage
+from django.http import Http404, JsonResponse
+from django.shortcuts import aget_object_or_404, render
+from .models import Product, Category, CartItem
+from .api import not_modified
+from . import catalog_snapshot, payments
+from .checkout import acheckout_payment_intent
+from .orders import shipping_metadata, stock_problem
+from .search import SearchResults
+from .views import (
+    ProductListView, ProductDetailView, catalog_etag,
+    set_catalog_validators, catalog_list_validators, product_detail_validators, related_products_for,
+)
+
+
+arender = sync_to_async(render)
+
+
+async def home(request):
+    snapshot = catalog_snapshot.current()
+    if snapshot is not None:
+        featured_products = snapshot.featured_products(6)
+        categories = snapshot.categories()[:6]
+    else:
+        featured_products = [p async for p in Product.objects.filter(featured=True)[:6]]
+        categories = [c async for c in Category.objects.all()[:6]]
+    context = {
+        'featured_products': featured_products,
+        'categories': categories,
+        'title': 'Home'
+    }
+    return await arender(request, 'store/home.html', context)
+
+
+async def product_list(request, category_slug=None):
+    search_query = request.GET.get('q')
+    # Reading the snapshot is a few memory accesses, fine on the event loop
+    snapshot = catalog_snapshot.for_category(category_slug)
+
+    etag = last_modified = None
+    if not search_query:
+        if snapshot is not None:
+            state = catalog_list_validators(category_slug, snapshot)
+        else:
+            state = await sync_to_async(catalog_list_validators)(category_slug)
+        last_modified = state['last_modified']
+        etag = catalog_etag(request, ProductListView.__name__, (last_modified, state['total'], state['categories']))
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+    queryset = Product.objects.all()
+    current_category = None
+    if snapshot is not None:
+        categories = snapshot.categories()
+        if category_slug:
+            current_category = snapshot.category(category_slug)
+        queryset = snapshot.products(category_slug)
+    else:
+        categories = [c async for c in Category.objects.all()]
+        if category_slug:
+            current_category = await aget_object_or_404(Category, slug=category_slug)
+            queryset = queryset.filter(category=current_category)
+
+    results = None
+    if search_query:
+        results = SearchResults(search_query, current_category)
+        count = await sync_to_async(results.count)()
+    elif snapshot is not None:
+        count = queryset.count()
+    else:
+        count = await queryset.acount()
+
+    # Let Paginator do the page arithmetic on a stand-in sequence of the
+    # right length, then fetch just the page
+    paginator = Paginator(range(count), ProductListView.paginate_by)
+    try:
+        page = paginator.page(request.GET.get('page') or 1)
+    except InvalidPage as e:
+        raise Http404(str(e))
+    if not paginator.count:
+        page.object_list = []
+    elif results is not None:
+        page.object_list = await sync_to_async(results.__getitem__)(slice(page.start_index() - 1, page.end_index()))
+    elif snapshot is not None:
+        page.object_list = queryset[page.start_index() - 1:page.end_index()]
+    else:
+        page.object_list = [p async for p in queryset[page.start_index() - 1:page.end_index()]]
+
+    context = {
+        'products': page.object_list,
+        'object_list': page.object_list,
+        'paginator': paginator,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
+        'categories': categories,
+    }
+    if current_category:
+        context['current_category'] = current_category
+    if search_query:
+        context['search_query'] = search_query
+
+    response = await arender(request, ProductListView.template_name, context)
+    if etag:
+        set_catalog_validators(response, etag, last_modified)
+    return response
+
+
+async def product_detail(request, slug):
+    etag = last_modified = None
+    validators = await sync_to_async(product_detail_validators)(slug)
+    if validators is not None:
+        etag_parts, last_modified = validators
+        etag = catalog_etag(request, ProductDetailView.__name__, etag_parts)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+    product = await aget_object_or_404(Product.objects.select_related('category'), slug=slug)
+    context = {
+        'object': product,
+        'product': product,
+        'related_products': await sync_to_async(related_products_for)(product),
+    }
+
+    response = await arender(request, ProductDetailView.template_name, context)
+    if etag:
+        set_catalog_validators(response, etag, last_modified)
+    return response
+
+
+@login_required
+async def create_payment(request):
+    if request.method == 'POST':
+        user = await request.auser()
+        data = json.loads(request.body)
+        # The shard lookup may hit the database, so it runs in a thread
+        cart = await sync_to_async(CartItem.objects.for_user)(user)
+        cart_items = [item async for item in cart.prefetch_related('product')]
+
+        if not cart_items:
+            return JsonResponse({'error': 'Your cart is empty'}, status=400)
+
+        problem = stock_problem(cart_items)
+        if problem:
+            return JsonResponse({'error': problem}, status=409)
+
+        total_amount = int(sum(item.total_price for item in cart_items) * 100)  # Convert to cents for Stripe
+
+        try:
+            client_secret, _ = await acheckout_payment_intent(
+                user,
+                cart_items,
+                total_amount,
+                metadata={
+                    'user_id': user.id,
+                    **shipping_metadata(data.get('shipping') or {})
+                }
+            )
+
+            return JsonResponse({
+                'clientSecret': client_secret
+            })
+
+        except payments.PaymentProviderBusy as e:
+            return JsonResponse({'error': str(e)}, status=503)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'error': 'Invalid request'}, status=400)
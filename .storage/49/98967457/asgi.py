@@ -0,0 +1,25 @@
+"""
+ASGI config for plant_nursery project.
+
+Serve with an ASGI server, e.g.:
+
+    uvicorn plant_nursery.asgi:application --workers 4
+
+Under ASGI the catalog views and create_payment are served by their async
+versions in store/async_views.py. Each worker warms up (store/warmup.py)
+before it serves, unless WARMUP_ON_BOOT=0.
+"""
+
+import os
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plant_nursery.settings')
+os.environ.setdefault('DJANGO_ASYNC_VIEWS', '1')
+
+application = get_asgi_application()
+
+if settings.WARMUP_ON_BOOT:
+    from store.warmup import warm_up
+    warm_up()
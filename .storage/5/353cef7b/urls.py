@@ -1,10 +1,13 @@
 """
 Plant Nursery URL Configuration
 """
+import re
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from django.views.static import serve as static_serve
+from store import media
 from users import views as user_views
 from django.contrib.auth import views as auth_views
 
@@ -15,7 +18,16 @@ urlpatterns = [
     path('profile/', user_views.profile, name='profile'),
     path('login/', auth_views.LoginView.as_view(template_name='users/login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(template_name='users/logout.html'), name='logout'),
+    
+    # Written by the build_sitemaps command; the front server may serve these directly
+    path('sitemap.xml', static_serve, {'path': 'sitemap.xml', 'document_root': settings.SITEMAP_ROOT}, name='sitemap'),
+    re_path(r'^%s(?P<path>[\w-]+\.xml\.gz)$' % re.escape(settings.SITEMAP_URL.lstrip('/')), static_serve,
+            {'document_root': settings.SITEMAP_ROOT}),
 ]
 
-if settings.DEBUG:
+if settings.MEDIA_SERVE_MODE != 'off':
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), media.serve, name='media'),
+    ]
+elif settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -0,0 +1,141 @@
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# Local stand-in for the Stripe PaymentIntents API with injectable latency.
+#
+#   python fake_payment_server.py --port 12111 --latency 300 --jitter 50
+#   STRIPE_API_BASE=http://127.0.0.1:12111 python manage.py runserver
+#
+# Implements create, retrieve, update and cancel for /v1/payment_intents and
+# create for /v1/refunds, keeping intents in memory. Connections are HTTP/1.1 keep-alive.
+
+intents = {}
+intents_lock = threading.Lock()
+
+
+def new_intent(params):
+    intent_id = 'pi_' + secrets.token_hex(12)
+    return {
+        'id': intent_id,
+        'object': 'payment_intent',
+        'amount': int(params.get('amount', 0)),
+        'currency': params.get('currency', 'usd'),
+        'client_secret': f'{intent_id}_secret_{secrets.token_hex(12)}',
+        'metadata': {key[9:-1]: value for key, value in params.items() if key.startswith('metadata[')},
+        'status': 'requires_payment_method',
+        'created': int(time.time()),
+        'livemode': False,
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Request-Id', 'req_' + secrets.token_hex(8))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = dict(parse_qsl(self.rfile.read(length).decode())) if length else {}
+        self.delay()
+
+        if random.random() < self.error_rate:
+            return self.send_json(500, {'error': {'type': 'api_error', 'message': 'Injected failure'}})
+
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if parts == ['v1', 'refunds'] and method == 'POST':
+            return self.refund(params)
+        if parts[:2] != ['v1', 'payment_intents']:
+            return self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path'}})
+
+        with intents_lock:
+            if len(parts) == 2 and method == 'POST':
+                intent = new_intent(params)
+                intents[intent['id']] = intent
+                return self.send_json(200, intent)
+
+            intent = intents.get(parts[2]) if len(parts) > 2 else None
+            if intent is None:
+                return self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'No such payment_intent'}})
+            if len(parts) == 4 and parts[3] == 'cancel' and method == 'POST':
+                if intent['status'] in ('succeeded', 'canceled'):
+                    return self.send_json(400, {'error': {
+                        'type': 'invalid_request_error', 'message': f"PaymentIntent {intent['id']} can't be canceled",
+                    }})
+                intent['status'] = 'canceled'
+            elif len(parts) == 3 and method == 'POST':
+                if 'amount' in params:
+                    intent['amount'] = int(params['amount'])
+                intent['metadata'].update(
+                    {key[9:-1]: value for key, value in params.items() if key.startswith('metadata[')}
+                )
+            return self.send_json(200, intent)
+
+    def refund(self, params):
+        with intents_lock:
+            intent = intents.get(params.get('payment_intent'))
+            if intent is None:
+                return self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'No such payment_intent'}})
+            if intent['status'] != 'succeeded' or intent.get('refunded'):
+                return self.send_json(400, {'error': {
+                    'type': 'invalid_request_error', 'message': f"PaymentIntent {intent['id']} can't be refunded",
+                }})
+            intent['refunded'] = True
+        return self.send_json(200, {
+            'id': 're_' + secrets.token_hex(12),
+            'object': 'refund',
+            'amount': intent['amount'],
+            'currency': intent['currency'],
+            'payment_intent': intent['id'],
+            'status': 'succeeded',
+            'created': int(time.time()),
+        })
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake payment provider for local benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=200, help='Response latency in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='Random +/- latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with 500')
+    args = parser.parse_args()
+
+    Handler.latency = args.latency / 1000
+    Handler.jitter = args.jitter / 1000
+    Handler.error_rate = args.error_rate
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f'Fake payment server on http://{args.host}:{args.port} (latency {args.latency:.0f}ms)')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
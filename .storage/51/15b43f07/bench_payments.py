@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import django
+
+# Payment-call throughput under injected provider latency.
+#
+#   python bench_payments.py --requests 200 --latency 300 --workers 8
+#
+# Starts fake_payment_server.py in a background thread (unless STRIPE_API_BASE
+# is already set) and compares:
+#   sync:  N worker threads, each blocked for the whole provider round trip,
+#          like a WSGI deployment with N workers
+#   async: one event loop awaiting all calls, capped by PAYMENT_MAX_CONCURRENCY,
+#          like one ASGI worker
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--requests', type=int, default=200)
+parser.add_argument('--latency', type=float, default=300, help='Provider latency in ms')
+parser.add_argument('--workers', type=int, default=8, help='Threads for the sync run')
+parser.add_argument('--port', type=int, default=12111)
+args = parser.parse_args()
+
+if 'STRIPE_API_BASE' not in os.environ:
+    import fake_payment_server
+    from http.server import ThreadingHTTPServer
+    fake_payment_server.Handler.latency = args.latency / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), fake_payment_server.Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['STRIPE_API_BASE'] = f'http://127.0.0.1:{args.port}'
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plant_nursery.settings')
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+django.setup()
+
+from django.conf import settings
+from store import payments
+
+
+def report(label, latencies, elapsed):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    print(f"{label:<6} {len(latencies) / elapsed:8.1f} req/s   p50 {p50:7.1f} ms   p95 {p95:7.1f} ms")
+
+
+def timed_sync_call(i):
+    start = time.perf_counter()
+    payments.create_payment_intent(amount=1000 + i, metadata={'user_id': i})
+    return time.perf_counter() - start
+
+
+async def timed_async_call(i):
+    start = time.perf_counter()
+    await payments.acreate_payment_intent(amount=1000 + i, metadata={'user_id': i})
+    return time.perf_counter() - start
+
+
+async def run_async(n):
+    return await asyncio.gather(*(timed_async_call(i) for i in range(n)))
+
+
+def main():
+    print(f"provider {settings.STRIPE_API_BASE}  latency {args.latency:.0f} ms  "
+          f"max concurrency {settings.PAYMENT_MAX_CONCURRENCY}")
+    # Warm up the connection pool
+    payments.create_payment_intent(amount=100)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        latencies = list(executor.map(timed_sync_call, range(args.requests)))
+    report('sync', latencies, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run_async(args.requests))
+    report('async', latencies, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
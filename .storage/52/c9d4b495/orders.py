@@ -0,0 +1,180 @@
+"""
+Order placement shared by the payment_success view and the payment webhook
+worker. Side effects of a new order are queued as background tasks (see
+tasks.py).
+
+create_payment turns shoppers away once their cart asks for more than is in
+stock, but shoppers who were already paying can still lose the race for the
+last units. place_order only takes stock that is there: if a line can't be
+covered, the order is recorded as cancelled, no stock is taken and the
+payment is refunded in the background.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from .catalog import bump_catalog_version
+from .checkout import complete_checkout_intent
+from .models import CartItem, Order, OrderItem, Product
+from .sharding import locked_shard_for_user
+from .stock_alerts import stock_changed
+from .tasks import enqueue, enqueue_order_tasks
+
+SHIPPING_FIELDS = ('full_name', 'email', 'address', 'city', 'state', 'zip_code', 'phone')
+METADATA_PREFIX = 'shipping_'
+
+
+def shipping_metadata(shipping_data):
+    # Stripe metadata values are limited to 500 characters
+    return {
+        f'{METADATA_PREFIX}{field}': str(shipping_data.get(field) or '')[:500]
+        for field in SHIPPING_FIELDS
+    }
+
+
+def shipping_from_metadata(metadata):
+    return {field: metadata.get(f'{METADATA_PREFIX}{field}') or '' for field in SHIPPING_FIELDS}
+
+
+def stock_problem(cart_items):
+    """A message for the first cart line that asks for more than is in stock, or None."""
+    for item in cart_items:
+        product = item.product
+        if not product.available or product.stock <= 0:
+            return f'{product.name} is sold out.'
+        if item.quantity > product.stock:
+            return f'Only {product.stock} of {product.name} left.'
+    return None
+
+
+class SoldOut(Exception):
+    pass
+
+
+class AmountMismatch(Exception):
+    """The provider reports a different amount paid than the order costs."""
+
+
+def take_stock(cart_items):
+    """
+    Decrement stock for every cart line, or for none of them. Raises SoldOut
+    when a line asks for more than is left.
+    """
+    # Decrement in the database, not on the copies read with the cart, so
+    # concurrent orders for the same product can't overwrite each other's
+    # update, and only where enough is left. Products are locked in id order
+    # to avoid deadlocks.
+    now = timezone.now()
+    with transaction.atomic():
+        for cart_item in sorted(cart_items, key=lambda item: item.product_id):
+            taken = Product.objects.filter(
+                id=cart_item.product_id, available=True, stock__gte=cart_item.quantity
+            ).update(stock=F('stock') - cart_item.quantity, updated_at=now)
+            if not taken:
+                # Rolls back the lines already taken
+                raise SoldOut(cart_item.product.name)
+    product_ids = [item.product_id for item in cart_items]
+    Product.objects.filter(id__in=product_ids, stock__lte=0, available=True).update(available=False, updated_at=now)
+    stock_changed(list(Product.objects.filter(id__in=product_ids).select_related('category')))
+    # update() sends no post_save, which is what normally does this
+    transaction.on_commit(bump_catalog_version)
+
+
+def check_amount(paid_amount, total_amount):
+    # In cents, as create_payment charges it
+    expected = int(total_amount * 100)
+    if int(paid_amount) != expected:
+        raise AmountMismatch(f'Paid {paid_amount} cents for an order of {expected} cents')
+
+
+def place_order(user, payment_id, shipping_data, paid_amount=None):
+    """
+    Turn the user's cart into a paid order. Idempotent on payment_id: a
+    second call for the same payment (page refresh, webhook after the browser
+    already posted) returns the existing order.
+
+    paid_amount is the amount in cents the provider reported as paid, passed
+    by the webhook worker. Only then is an existing order that a failed
+    payment event marked unpaid marked paid again; the browser's word is not
+    enough for that. Raises AmountMismatch when it doesn't cover the cart
+    (or the existing order), e.g. the cart changed after the payment.
+
+    Returns (order, created). order is None when there is no existing order
+    and the cart is empty. A new order that stock ran out for comes back
+    cancelled and unpaid, with the cart left as it was and a refund queued.
+    """
+    # The user's cart and orders are on their shard, products and tasks in
+    # the default database. The shard commits first, so queued tasks never
+    # point at an order that isn't there. The shard comes from the directory,
+    # not a cached entry that may predate a rebalance, and the user can't be
+    # moved until the order is placed.
+    with transaction.atomic():
+        shard = locked_shard_for_user(user.id)
+        with transaction.atomic(using=shard):
+            orders = Order.objects.using(shard).filter(user=user)
+            complete_checkout_intent(payment_id)
+            if payment_id:
+                order = orders.select_for_update().filter(payment_id=payment_id).first()
+                if order is not None:
+                    if paid_amount is not None and not order.payment_status and order.status != 'cancelled':
+                        check_amount(paid_amount, order.total_amount)
+                        order.payment_status = True
+                        order.save(update_fields=['payment_status', 'updated_at'])
+                        enqueue('update_sales_rollups')
+                    return order, False
+
+            cart_items = list(CartItem.objects.using(shard).filter(user=user).select_for_update().prefetch_related('product'))
+            if not cart_items:
+                return None, False
+
+            total_amount = sum(item.total_price for item in cart_items)
+            if paid_amount is not None:
+                check_amount(paid_amount, total_amount)
+
+            try:
+                with transaction.atomic(using=shard):
+                    order = Order.objects.using(shard).create(
+                        user=user,
+                        full_name=shipping_data.get('full_name') or '',
+                        email=shipping_data.get('email') or user.email,
+                        address=shipping_data.get('address') or '',
+                        city=shipping_data.get('city') or '',
+                        state=shipping_data.get('state') or '',
+                        zip_code=shipping_data.get('zip_code') or '',
+                        phone=shipping_data.get('phone') or '',
+                        total_amount=total_amount,
+                        payment_id=payment_id,
+                        payment_status=True,
+                        status='processing'
+                    )
+            except IntegrityError:
+                # Another request placed the order for this payment first
+                return orders.get(payment_id=payment_id), False
+
+            OrderItem.objects.using(shard).bulk_create([
+                OrderItem(
+                    order=order,
+                    product=cart_item.product,
+                    price=cart_item.product.price,
+                    quantity=cart_item.quantity
+                )
+                for cart_item in cart_items
+            ])
+
+            try:
+                take_stock(cart_items)
+            except SoldOut:
+                order.status = 'cancelled'
+                order.payment_status = False
+                order.save(update_fields=['status', 'payment_status', 'updated_at'])
+                if payment_id:
+                    enqueue('refund_payment', {'payment_id': payment_id})
+                return order, True
+
+            # Clear the cart
+            CartItem.objects.using(shard).filter(id__in=[item.id for item in cart_items]).delete()
+
+            # Confirmation email, stock alerts etc. run in the background once
+            # this transaction commits
+            enqueue_order_tasks(order)
+
+    return order, True
@@ -0,0 +1,160 @@
+"""
+Stripe webhook ingestion.
+
+The endpoint only verifies the signature and stores the event, so Stripe gets
+its 200 immediately. The process_payment_events command drains the table in
+batches and creates or reconciles orders. Events are stored once per event id
+and once per (payment_id, type), so redeliveries and replays are harmless.
+"""
+import logging
+import uuid
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .models import Order, PaymentEvent
+from .orders import AmountMismatch, place_order, shipping_from_metadata
+from .sharding import all_shards
+from .tasks import enqueue
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+STALE_CLAIM_AFTER = timedelta(minutes=10)
+
+
+class EventRejected(Exception):
+    """The event can never be processed; don't retry it."""
+
+
+def event_row(event):
+    data_object = event.get('data', {}).get('object', {})
+    payment_id = data_object.get('id', '') if data_object.get('object') == 'payment_intent' else ''
+    return PaymentEvent(
+        event_id=event['id'],
+        event_type=event['type'],
+        payment_id=payment_id,
+        payload=event,
+    )
+
+
+def ingest_events(events):
+    """Store events that haven't been seen before. Returns the number of new events."""
+    rows = [event_row(event) for event in events]
+    before = PaymentEvent.objects.count()
+    PaymentEvent.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+    return PaymentEvent.objects.count() - before
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body,
+            request.headers.get('Stripe-Signature', ''),
+            settings.STRIPE_WEBHOOK_SECRET,
+        )
+    except (ValueError, stripe.SignatureVerificationError):
+        return HttpResponse(status=400)
+
+    PaymentEvent.objects.bulk_create([event_row(event.to_dict())], ignore_conflicts=True)
+    return HttpResponse(status=200)
+
+
+def handle_payment_succeeded(intent):
+    metadata = intent.get('metadata') or {}
+    user = User.objects.filter(id=metadata.get('user_id')).first()
+    if user is None:
+        raise EventRejected(f"Unknown user {metadata.get('user_id')!r}")
+    try:
+        order, created = place_order(user, intent['id'], shipping_from_metadata(metadata), paid_amount=intent['amount'])
+    except AmountMismatch as e:
+        # Left as a failed event for someone to review rather than placing
+        # an order for what wasn't paid for
+        logger.warning('Payment %s not turned into an order: %s', intent['id'], e)
+        raise EventRejected(str(e))
+    if order is None:
+        raise EventRejected('No order for this payment and the cart is empty')
+
+
+def handle_payment_failed(intent):
+    updated = sum(
+        Order.objects.using(db).filter(payment_id=intent['id'], payment_status=True).update(
+            payment_status=False, updated_at=timezone.now()
+        )
+        for db in all_shards()
+    )
+    if updated:
+        enqueue('update_sales_rollups')
+
+
+EVENT_HANDLERS = {
+    'payment_intent.succeeded': handle_payment_succeeded,
+    'payment_intent.payment_failed': handle_payment_failed,
+    'payment_intent.canceled': handle_payment_failed,
+}
+
+
+def release_stale_claims():
+    # Events claimed by a worker that died mid-batch go back in the queue
+    return PaymentEvent.objects.filter(
+        status='processing', claimed_at__lt=timezone.now() - STALE_CLAIM_AFTER
+    ).update(status='pending', claimed_by='')
+
+
+def claim_batch(batch_size, worker_id=None):
+    """
+    Atomically mark up to batch_size pending events as ours and return them.
+    The conditional UPDATE makes this safe across processes without relying
+    on SELECT ... FOR UPDATE SKIP LOCKED, so it also works on SQLite.
+    """
+    worker_id = worker_id or uuid.uuid4().hex
+    candidates = list(
+        PaymentEvent.objects.filter(status='pending')
+        .order_by('received_at')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not candidates:
+        return []
+    PaymentEvent.objects.filter(id__in=candidates, status='pending').update(
+        status='processing', claimed_by=worker_id, claimed_at=timezone.now(), attempts=F('attempts') + 1
+    )
+    return list(PaymentEvent.objects.filter(claimed_by=worker_id, status='processing').order_by('received_at'))
+
+
+def process_event(event):
+    handler = EVENT_HANDLERS.get(event.event_type)
+    try:
+        if handler is not None:
+            with transaction.atomic():
+                handler(event.payload['data']['object'])
+    except EventRejected as e:
+        event.status, event.last_error = 'failed', str(e)
+    except Exception as e:
+        logger.exception('Processing payment event %s failed', event.event_id)
+        event.last_error = f'{type(e).__name__}: {e}'
+        event.status = 'failed' if event.attempts >= MAX_ATTEMPTS else 'pending'
+    else:
+        event.status, event.last_error = 'done', ''
+    event.claimed_by = ''
+    event.processed_at = timezone.now()
+    event.save(update_fields=['status', 'last_error', 'claimed_by', 'processed_at'])
+    return event.status
+
+
+def process_batch(batch_size=50, worker_id=None):
+    """Claim and process one batch. Returns {status: count}."""
+    results = {}
+    for event in claim_batch(batch_size, worker_id):
+        status = process_event(event)
+        results[status] = results.get(status, 0) + 1
+    return results
@@ -0,0 +1,58 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from store import webhooks
+from store.models import PaymentEvent
+
+
+class Command(BaseCommand):
+    help = 'Drain stored payment webhook events in batches and create or reconcile orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker threads (default 4)')
+        parser.add_argument('--batch-size', type=int, default=50, help='Events claimed per batch (default 50)')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new events instead of exiting when the queue is empty')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls with --loop (default 1)')
+
+    def work(self, batch_size):
+        worker_id = uuid.uuid4().hex
+        totals = {}
+        try:
+            while True:
+                results = webhooks.process_batch(batch_size, worker_id)
+                if not results:
+                    return totals
+                for status, count in results.items():
+                    totals[status] = totals.get(status, 0) + count
+        finally:
+            close_old_connections()
+
+    def handle(self, *args, **options):
+        while True:
+            released = webhooks.release_stale_claims()
+            if released:
+                self.stdout.write(f'Released {released} stale claim(s).')
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(self.work, options['batch_size']) for _ in range(options['workers'])]
+                totals = {}
+                for future in futures:
+                    for status, count in future.result().items():
+                        totals[status] = totals.get(status, 0) + count
+
+            processed = sum(totals.values())
+            if processed:
+                elapsed = time.perf_counter() - start
+                summary = ', '.join(f'{count} {status}' for status, count in sorted(totals.items()))
+                self.stdout.write(self.style.SUCCESS(
+                    f'Processed {processed} event(s) in {elapsed:.2f}s ({summary}).'
+                ))
+            if not options['loop']:
+                pending = PaymentEvent.objects.filter(status='pending').count()
+                if pending:
+                    self.stdout.write(f'{pending} event(s) left pending for retry.')
+                return
+            time.sleep(options['interval'])
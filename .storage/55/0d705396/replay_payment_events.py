@@ -0,0 +1,28 @@
+import json
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from store import webhooks
+
+
+class Command(BaseCommand):
+    help = 'Ingest Stripe events from a JSON file (a list of events, or {"data": [...]}) as if delivered by the webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON file of Stripe event objects')
+        parser.add_argument('--process', action='store_true', help='Run process_payment_events afterwards')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path']) as f:
+                events = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Can't read events from {options['path']}: {e}")
+        if isinstance(events, dict):
+            events = events.get('data', [])
+
+        created = webhooks.ingest_events(events)
+        self.stdout.write(self.style.SUCCESS(
+            f'Ingested {created} new event(s), {len(events) - created} already seen.'
+        ))
+        if options['process']:
+            call_command('process_payment_events', stdout=self.stdout)
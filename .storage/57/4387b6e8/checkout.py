@@ -0,0 +1,206 @@
+"""
+PaymentIntent reuse for checkout.
+
+Each shopper has at most one open PaymentIntent, stored with a fingerprint of
+the cart and shipping details it was created for. Reloading checkout or
+retrying with the same cart reuses its client secret without calling the
+provider; a changed cart updates the existing intent instead of creating a
+new one. Paid intents are marked completed by place_order(), and the
+sweep_payment_intents command cancels abandoned ones and clears out the rest.
+"""
+import hashlib
+import json
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from . import payments
+from .models import CheckoutIntent
+
+
+def cart_fingerprint(cart_items, metadata):
+    rows = sorted([item.product_id, item.quantity, str(item.product.price)] for item in cart_items)
+    payload = json.dumps([rows, sorted(metadata.items())])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _open_intent(user):
+    return CheckoutIntent.objects.filter(user=user, status='open').first()
+
+
+def _touch(record, **fields):
+    # Only while still open: the sweep may have claimed it in the meantime
+    return CheckoutIntent.objects.filter(pk=record.pk, status='open').update(
+        updated_at=timezone.now(), **fields
+    ) == 1
+
+
+def _supersede(record):
+    CheckoutIntent.objects.filter(pk=record.pk, status='open').update(
+        status='superseded', updated_at=timezone.now()
+    )
+
+
+SAVE_ATTEMPTS = 3
+
+
+def _save_new(user, intent, fingerprint, amount):
+    """Store a freshly created intent. Returns the client secret to hand out."""
+    record = CheckoutIntent(
+        user=user,
+        payment_id=intent['id'],
+        client_secret=intent['client_secret'],
+        cart_fingerprint=fingerprint,
+        amount=amount,
+    )
+    for _ in range(SAVE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                record.save()
+            return record.client_secret
+        except IntegrityError:
+            # A concurrent request (double click) stored one first: hand out
+            # that one and leave ours for the sweep to cancel
+            winner = _open_intent(user)
+            if winner is not None:
+                break
+            # It was completed or superseded in the meantime; try again
+    record.status = 'canceling'
+    record.save()
+    if winner is None:
+        raise IntegrityError(f'Could not store payment intent {record.payment_id}')
+    return winner.client_secret
+
+
+def checkout_payment_intent(user, cart_items, amount, metadata):
+    """
+    Return (client_secret, outcome) for the user's cart, where outcome is
+    'hit', 'updated' or 'created'.
+    """
+    metadata = payments.string_metadata(metadata)
+    fingerprint = cart_fingerprint(cart_items, metadata)
+
+    record = _open_intent(user)
+    if record is not None:
+        if record.cart_fingerprint == fingerprint:
+            if _touch(record, hits=F('hits') + 1):
+                return record.client_secret, 'hit'
+        else:
+            try:
+                payments.update_payment_intent(record.payment_id, amount, metadata)
+            except stripe.InvalidRequestError:
+                # Already paid, processing or canceled; start a new one
+                _supersede(record)
+            else:
+                if _touch(record, updates=F('updates') + 1, cart_fingerprint=fingerprint, amount=amount):
+                    return record.client_secret, 'updated'
+
+    intent = payments.create_payment_intent(amount, 'usd', metadata)
+    return _save_new(user, intent, fingerprint, amount), 'created'
+
+
+async def acheckout_payment_intent(user, cart_items, amount, metadata):
+    metadata = payments.string_metadata(metadata)
+    fingerprint = cart_fingerprint(cart_items, metadata)
+
+    record = await sync_to_async(_open_intent)(user)
+    if record is not None:
+        if record.cart_fingerprint == fingerprint:
+            if await sync_to_async(_touch)(record, hits=F('hits') + 1):
+                return record.client_secret, 'hit'
+        else:
+            try:
+                await payments.aupdate_payment_intent(record.payment_id, amount, metadata)
+            except stripe.InvalidRequestError:
+                await sync_to_async(_supersede)(record)
+            else:
+                if await sync_to_async(_touch)(record, updates=F('updates') + 1, cart_fingerprint=fingerprint, amount=amount):
+                    return record.client_secret, 'updated'
+
+    intent = await payments.acreate_payment_intent(amount, 'usd', metadata)
+    return await sync_to_async(_save_new)(user, intent, fingerprint, amount), 'created'
+
+
+def complete_checkout_intent(payment_id):
+    if payment_id:
+        CheckoutIntent.objects.filter(payment_id=payment_id).update(
+            status='completed', updated_at=timezone.now()
+        )
+
+
+def reuse_stats():
+    """
+    Checkout requests served for the intents still stored: every stored
+    intent was created once, then reused `hits` times and updated `updates`
+    times. The sweep deletes finished and abandoned intents, and their
+    requests with them; open ones are kept, so their counts span sweeps.
+    """
+    totals = CheckoutIntent.objects.aggregate(created=Count('id'), hits=Sum('hits'), updates=Sum('updates'))
+    created, hits, updates = totals['created'], totals['hits'] or 0, totals['updates'] or 0
+    requests = created + hits + updates
+    return {
+        'requests': requests,
+        'hits': hits,
+        'updates': updates,
+        'created': created,
+        'hit_rate': hits / requests if requests else 0.0,
+    }
+
+
+def sweep(abandon_after, batch_size=100):
+    """
+    Cancel open intents untouched for abandon_after and delete finished rows,
+    batch_size at a time. Returns {'canceled', 'deleted', 'failed'} counts.
+    """
+    counts = {'canceled': 0, 'deleted': 0, 'failed': 0}
+
+    cutoff = timezone.now() - abandon_after
+    while True:
+        ids = list(
+            CheckoutIntent.objects.filter(status='open', updated_at__lt=cutoff)
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        # Claim before calling the provider so a concurrent checkout stops
+        # reusing them
+        CheckoutIntent.objects.filter(id__in=ids, status='open', updated_at__lt=cutoff).update(status='canceling')
+
+    failed_ids = []
+    while True:
+        batch = list(
+            CheckoutIntent.objects.filter(status='canceling').exclude(id__in=failed_ids)
+            .values_list('id', 'payment_id')[:batch_size]
+        )
+        if not batch:
+            break
+        done = []
+        for record_id, payment_id in batch:
+            try:
+                payments.cancel_payment_intent(payment_id)
+            except stripe.InvalidRequestError:
+                # Already paid or canceled at the provider
+                pass
+            except (stripe.StripeError, payments.PaymentProviderBusy):
+                failed_ids.append(record_id)
+                counts['failed'] += 1
+                continue
+            else:
+                counts['canceled'] += 1
+            done.append(record_id)
+        counts['deleted'] += CheckoutIntent.objects.filter(id__in=done).delete()[0]
+
+    while True:
+        ids = list(
+            CheckoutIntent.objects.filter(status__in=['completed', 'superseded'])
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        counts['deleted'] += CheckoutIntent.objects.filter(id__in=ids).delete()[0]
+
+    return counts
+
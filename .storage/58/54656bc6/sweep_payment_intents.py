@@ -0,0 +1,40 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from store import checkout
+
+
+class Command(BaseCommand):
+    help = 'Cancel abandoned checkout PaymentIntents, clear finished ones and report the reuse hit rate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Rows handled per batch (default 100)')
+        parser.add_argument(
+            '--abandon-after', type=float, default=None,
+            help='Hours without activity before an open intent is canceled (default PAYMENT_INTENT_ABANDON_AFTER)',
+        )
+        parser.add_argument('--stats', action='store_true', help='Only report the hit rate, sweep nothing')
+
+    def handle(self, *args, **options):
+        stats = checkout.reuse_stats()
+        self.stdout.write(
+            f"Checkout requests for stored intents: {stats['requests']} "
+            f"({stats['hits']} reused, {stats['updates']} updated, {stats['created']} created), "
+            f"hit rate {stats['hit_rate']:.1%}"
+        )
+        if options['stats']:
+            return
+
+        if options['abandon_after'] is not None:
+            abandon_after = timedelta(hours=options['abandon_after'])
+        else:
+            abandon_after = timedelta(seconds=settings.PAYMENT_INTENT_ABANDON_AFTER)
+
+        counts = checkout.sweep(abandon_after, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Canceled {counts['canceled']} abandoned intent(s), deleted {counts['deleted']} row(s)."
+        ))
+        if counts['failed']:
+            self.stdout.write(self.style.WARNING(
+                f"{counts['failed']} intent(s) could not be canceled and will be retried on the next run."
+            ))
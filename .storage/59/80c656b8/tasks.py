@@ -0,0 +1,368 @@
+"""
+Database-backed background tasks.
+
+Tasks are rows in the Task table, so enqueueing inside a transaction (as
+place_order() does) only makes them visible once the order is committed.
+The run_tasks command claims them with a conditional UPDATE, like the
+payment event worker.
+
+- Retries: a failed task goes back to pending with an exponential backoff
+  until max_attempts is reached.
+- Batching: tasks registered with batch=True are claimed up to batch_size
+  at a time and handed to the handler together, e.g. so confirmation emails
+  share one SMTP connection.
+- Concurrency: each queue in settings.TASK_QUEUES allows that many batches
+  in flight across all workers.
+
+Register a task with @task and enqueue it with enqueue(name, payload).
+"""
+import logging
+import random
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import Order, Product, RestockRequest, Task, TaskQueue
+from .sharding import all_shards
+
+logger = logging.getLogger(__name__)
+
+
+class TaskSpec:
+    def __init__(self, name, func, queue, batch, batch_size, max_attempts):
+        self.name = name
+        self.func = func
+        self.queue = queue
+        self.batch = batch
+        self.batch_size = batch_size if batch else 1
+        self.max_attempts = max_attempts
+
+
+registry = {}
+
+
+def task(name=None, queue='default', batch=False, batch_size=50, max_attempts=5):
+    """
+    Register a task handler.
+
+    A plain handler is called once per task with the payload as keyword
+    arguments. A batch handler is called with a list of Task rows of the same
+    name and returns {task_id: error} for the ones that failed (or None).
+    Raising from either fails every task in the call.
+    """
+    def decorator(func):
+        task_name = name or func.__name__
+        registry[task_name] = TaskSpec(task_name, func, queue, batch, batch_size, max_attempts)
+        return func
+    return decorator
+
+
+def _task_row(name, payload=None, delay=None, queue=None):
+    if name not in registry:
+        raise ValueError(f'Unknown task {name!r}')
+    spec = registry[name]
+    return Task(
+        name=name,
+        queue=queue or spec.queue,
+        payload=payload or {},
+        max_attempts=spec.max_attempts,
+        run_at=timezone.now() + (delay or timedelta()),
+    )
+
+
+def enqueue(name, payload=None, delay=None, queue=None):
+    row = _task_row(name, payload, delay, queue)
+    row.save()
+    return row
+
+
+def enqueue_many(name, payloads, delay=None, queue=None):
+    return Task.objects.bulk_create([_task_row(name, payload, delay, queue) for payload in payloads])
+
+
+def retry_delay(attempts):
+    # Exponential backoff with jitter so failed batches don't retry in lockstep
+    delay = min(settings.TASK_RETRY_MAX_DELAY, settings.TASK_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def sync_queues():
+    """Create or update TaskQueue rows from settings.TASK_QUEUES."""
+    for name, concurrency in settings.TASK_QUEUES.items():
+        TaskQueue.objects.update_or_create(name=name, defaults={'concurrency': concurrency})
+
+
+def release_stale_claims():
+    """
+    Put tasks claimed by a worker that died back in the queue and free the
+    slots their batches held. Slots held by live workers, including ones
+    that haven't claimed their batch yet, are left alone.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.TASK_STALE_AFTER)
+    with transaction.atomic():
+        stale = list(
+            Task.objects.select_for_update().filter(status='running', claimed_at__lt=cutoff)
+            .values_list('id', 'queue', 'claimed_by')
+        )
+        released = Task.objects.filter(id__in=[id for id, _, _ in stale]).update(status='pending', claimed_by='')
+        batches = {}
+        for _, queue, batch_id in stale:
+            batches.setdefault(queue, set()).add(batch_id)
+        for queue, batch_ids in batches.items():
+            TaskQueue.objects.filter(name=queue).update(running=Greatest(F('running') - len(batch_ids), 0))
+    return released
+
+
+def acquire_slot(queue):
+    return TaskQueue.objects.filter(name=queue, running__lt=F('concurrency')).update(running=F('running') + 1) == 1
+
+
+def release_slot(queue):
+    TaskQueue.objects.filter(name=queue, running__gt=0).update(running=F('running') - 1)
+
+
+def claim_batch(queue, batch_id):
+    """
+    Claim the oldest ready task in the queue plus, for batch tasks, more
+    ready tasks of the same name up to the task's batch_size.
+    """
+    ready = Task.objects.filter(queue=queue, status='pending', run_at__lte=timezone.now())
+    name = ready.order_by('run_at', 'id').values_list('name', flat=True).first()
+    if name is None:
+        return []
+    spec = registry.get(name)
+    batch_size = spec.batch_size if spec else 1
+    candidates = list(ready.filter(name=name).order_by('run_at', 'id').values_list('id', flat=True)[:batch_size])
+    Task.objects.filter(id__in=candidates, status='pending').update(
+        status='running', claimed_by=batch_id, claimed_at=timezone.now(), attempts=F('attempts') + 1
+    )
+    return list(Task.objects.filter(claimed_by=batch_id, status='running').order_by('run_at', 'id'))
+
+
+def _error(e):
+    return f'{type(e).__name__}: {e}'
+
+
+def run_batch(tasks):
+    """Run claimed tasks and record the outcome. Returns {status: count}."""
+    spec = registry.get(tasks[0].name)
+    failures = {}
+    if spec is None:
+        failures = {t.id: f'Unknown task {tasks[0].name!r}' for t in tasks}
+        for t in tasks:
+            t.attempts = t.max_attempts
+    elif spec.batch:
+        try:
+            failures = spec.func(tasks) or {}
+        except Exception as e:
+            logger.exception('Task batch %s failed', spec.name)
+            failures = {t.id: _error(e) for t in tasks}
+    else:
+        for t in tasks:
+            try:
+                with transaction.atomic():
+                    spec.func(**t.payload)
+            except Exception as e:
+                logger.exception('Task %s #%s failed', spec.name, t.id)
+                failures[t.id] = _error(e)
+
+    now = timezone.now()
+    results = {}
+    for t in tasks:
+        if t.id in failures:
+            t.last_error = failures[t.id]
+            if t.attempts >= t.max_attempts:
+                t.status, t.finished_at = 'failed', now
+            else:
+                t.status, t.run_at = 'pending', now + retry_delay(t.attempts)
+        else:
+            t.status, t.last_error, t.finished_at = 'done', '', now
+        t.claimed_by = ''
+        results[t.status] = results.get(t.status, 0) + 1
+    Task.objects.bulk_update(tasks, ['status', 'last_error', 'run_at', 'finished_at', 'claimed_by'])
+    return results
+
+
+def work_once(queues):
+    """
+    Run at most one batch from each queue that has a free slot.
+    Returns {status: count} for the tasks run.
+    """
+    totals = {}
+    for queue in queues:
+        if not acquire_slot(queue):
+            continue
+        try:
+            tasks = claim_batch(queue, uuid.uuid4().hex)
+            if tasks:
+                for status, count in run_batch(tasks).items():
+                    totals[status] = totals.get(status, 0) + count
+        finally:
+            release_slot(queue)
+    return totals
+
+
+def has_ready_tasks(queues):
+    return Task.objects.filter(queue__in=queues, status='pending', run_at__lte=timezone.now()).exists()
+
+
+# Order side effects
+
+
+def _orders(tasks):
+    # Order ids are unique across shards, so each shard returns its own orders
+    order_ids = [t.payload['order_id'] for t in tasks]
+    orders = {}
+    for db in all_shards():
+        orders.update(Order.objects.using(db).prefetch_related('items__product').in_bulk(order_ids))
+    return orders
+
+
+@task(queue='email', batch=True)
+def send_order_confirmation(tasks):
+    orders = _orders(tasks)
+    failures = {}
+    # One SMTP connection for the whole batch
+    with get_connection() as connection:
+        for t in tasks:
+            order = orders.get(t.payload['order_id'])
+            if order is None:
+                continue
+            message = EmailMessage(
+                subject=f'Your Plant Nursery order #{order.id}',
+                body=render_to_string('store/emails/order_confirmation.txt', {'order': order}),
+                to=[order.email],
+                connection=connection,
+            )
+            try:
+                message.send()
+            except Exception as e:
+                failures[t.id] = _error(e)
+    return failures
+
+
+@task(queue='email', batch=True, batch_size=200)
+def send_order_status_update(tasks):
+    orders = _orders(tasks)
+    failures = {}
+    with get_connection() as connection:
+        for t in tasks:
+            order = orders.get(t.payload['order_id'])
+            # Archived, or already moved on to another status
+            if order is None or order.status != t.payload['status']:
+                continue
+            message = EmailMessage(
+                subject=f'Your Plant Nursery order #{order.id} is {order.get_status_display().lower()}',
+                body=render_to_string('store/emails/order_status.txt', {'order': order}),
+                to=[order.email],
+                connection=connection,
+            )
+            try:
+                message.send()
+            except Exception as e:
+                failures[t.id] = _error(e)
+    return failures
+
+
+def stock_alert_recipients():
+    if settings.STOCK_ALERT_EMAILS:
+        return list(settings.STOCK_ALERT_EMAILS)
+    return list(User.objects.filter(is_staff=True).exclude(email='').values_list('email', flat=True))
+
+
+@task(queue='email', batch=True)
+def notify_low_stock(tasks):
+    # One digest for every product in the batch that is still low, with
+    # current stock levels
+    product_ids = {t.payload['product_id'] for t in tasks}
+    products = [
+        product for product in
+        Product.objects.filter(id__in=product_ids).select_related('category').order_by('stock', 'name')
+        if product.stock <= product.get_low_stock_threshold()
+    ]
+    recipients = stock_alert_recipients()
+    if products and recipients:
+        EmailMessage(
+            subject=f'Low stock: {len(products)} product(s)',
+            body=render_to_string('store/emails/low_stock.txt', {'products': products}),
+            to=recipients,
+        ).send()
+
+
+@task(queue='email', batch=True, max_attempts=10)
+def notify_restock(tasks):
+    # Everyone waiting for the product, over one SMTP connection. Requests
+    # are deleted as they're sent, so a retry carries on with the rest.
+    from .sitemaps import absolute
+    product_ids = {t.payload['product_id'] for t in tasks}
+    with get_connection() as connection:
+        for product in Product.objects.filter(id__in=product_ids):
+            if not product.in_stock:
+                # Sold out again before we got to it; keep the list
+                continue
+            requests = RestockRequest.objects.filter(product=product).select_related('user').order_by('id')
+            while True:
+                chunk = list(requests[:settings.RESTOCK_NOTIFY_CHUNK])
+                if not chunk:
+                    break
+                connection.send_messages([
+                    EmailMessage(
+                        subject=f'{product.name} is back in stock',
+                        body=render_to_string('store/emails/restock.txt', {
+                            'user': request.user,
+                            'product': product,
+                            'product_url': absolute(product.get_absolute_url()),
+                        }),
+                        to=[request.user.email],
+                        connection=connection,
+                    )
+                    for request in chunk if request.user.email
+                ])
+                RestockRequest.objects.filter(id__in=[request.id for request in chunk]).delete()
+
+
+@task(queue='maintenance', batch=True, batch_size=1000, max_attempts=3)
+def refresh_recommendations(tasks):
+    # Any number of queued refreshes collapse into one incremental build
+    from . import recommendations
+    recommendations.build(incremental=True)
+
+
+@task(queue='rollups', batch=True, batch_size=1000, max_attempts=10)
+def update_sales_rollups(tasks):
+    # Picks up every order whose rollup contribution is out of date, not
+    # just the ones named in the batch
+    from . import sales
+    sales.update_rollups()
+
+
+@task(queue='rollups', batch=True, batch_size=1000, max_attempts=10)
+def recount_sales_days(tasks):
+    # update_rollups() only notices orders starting or stopping to count;
+    # an edited amount or item list on a counted order needs its day rebuilt
+    from datetime import date
+    from . import sales
+    for day in sorted({date.fromisoformat(t.payload['day']) for t in tasks}):
+        sales.backfill(day, day)
+
+
+@task(max_attempts=10)
+def refund_payment(payment_id):
+    # Queued by place_order() when stock ran out while the shopper paid
+    from . import payments
+    payments.refund_payment(payment_id)
+
+
+def enqueue_order_tasks(order):
+    """Queue the side effects of a newly placed order."""
+    enqueue('send_order_confirmation', {'order_id': order.id})
+    enqueue('refresh_recommendations')
+    enqueue('update_sales_rollups')
@@ -20,4 +20,30 @@ class Wishlist(models.Model):
     created_date = models.DateTimeField(default=timezone.now)
     
     def __str__(self):
-        return f"{self.user.username}'s Wishlist"
\ No newline at end of file
+        return f"{self.user.username}'s Wishlist"
+
+
+def create_missing_profiles(users=None):
+    """
+    Bulk-create the Profile and Wishlist rows for users that don't have them
+    yet, e.g. after User.objects.bulk_create(). users is a queryset or any
+    iterable of users or user ids (default: all users). Returns the number of
+    users that were given a profile.
+    """
+    if users is None:
+        users = User.objects.all()
+    if isinstance(users, models.QuerySet):
+        user_ids = users.values_list('pk', flat=True)
+    else:
+        user_ids = [getattr(user, 'pk', user) for user in users]
+    
+    missing_profiles = User.objects.filter(pk__in=user_ids, profile__isnull=True).values_list('pk', flat=True)
+    missing_wishlists = User.objects.filter(pk__in=user_ids, wishlist__isnull=True).values_list('pk', flat=True)
+    
+    profiles = Profile.objects.bulk_create(
+        [Profile(user_id=pk) for pk in missing_profiles], batch_size=1000, ignore_conflicts=True
+    )
+    Wishlist.objects.bulk_create(
+        [Wishlist(user_id=pk) for pk in missing_wishlists], batch_size=1000, ignore_conflicts=True
+    )
+    return len(profiles)
\ No newline at end of file
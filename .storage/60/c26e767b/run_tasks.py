@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import time
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Count
+
+# store.tasks is imported lazily: worker processes may be spawned rather than
+# forked, and they have to call django.setup() before touching models.
+
+
+def worker_loop(queues, once, interval):
+    from store import tasks
+    try:
+        while True:
+            if not tasks.work_once(queues):
+                if once and not tasks.has_ready_tasks(queues):
+                    return
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connections.close_all()
+
+
+def worker_process(queues, once, interval):
+    django.setup()
+    worker_loop(queues, once, interval)
+
+
+class Command(BaseCommand):
+    help = 'Run background tasks from the database queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='Worker processes (default 2)')
+        parser.add_argument('--queues', default='', help='Comma-separated queues to serve (default: all in TASK_QUEUES)')
+        parser.add_argument('--once', action='store_true', help='Exit when no ready tasks are left instead of polling')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls when idle (default 1)')
+
+    def handle(self, *args, **options):
+        from store import tasks
+        from store.models import Task
+
+        queues = [q for q in options['queues'].split(',') if q] or list(settings.TASK_QUEUES)
+        tasks.sync_queues()
+        released = tasks.release_stale_claims()
+        if released:
+            self.stdout.write(f'Released {released} stale task(s).')
+
+        self.stdout.write(f"Serving {', '.join(queues)} with {options['processes']} process(es).")
+        start = time.perf_counter()
+        if options['processes'] == 1:
+            worker_loop(queues, options['once'], options['interval'])
+        else:
+            # Children open their own database connections
+            connections.close_all()
+            workers = [
+                multiprocessing.Process(
+                    target=worker_process,
+                    args=(queues, options['once'], options['interval']),
+                    name=f'run_tasks-{os.getpid()}-{i}',
+                )
+                for i in range(options['processes'])
+            ]
+            for worker in workers:
+                worker.start()
+            try:
+                for worker in workers:
+                    worker.join()
+            except KeyboardInterrupt:
+                for worker in workers:
+                    worker.join()
+
+        if options['once']:
+            elapsed = time.perf_counter() - start
+            counts = dict(Task.objects.filter(queue__in=queues).values_list('status').annotate(n=Count('id')))
+            summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+            self.stdout.write(self.style.SUCCESS(f'Queue drained in {elapsed:.2f}s ({summary or "no tasks"}).'))
@@ -0,0 +1,106 @@
+import argparse
+import socketserver
+import threading
+from email import message_from_bytes
+
+# Local SMTP sink for testing outgoing email without a real mail server.
+#
+#   python debug_smtp_server.py --port 1025
+#   EMAIL_HOST=127.0.0.1 EMAIL_PORT=1025 python manage.py run_tasks --once
+#
+# Speaks enough SMTP for Django's SMTP backend (EHLO/HELO, MAIL, RCPT, DATA,
+# RSET, NOOP, QUIT) and prints a line per message. The counters show whether
+# batched tasks really share a connection.
+
+stats = {'connections': 0, 'messages': 0}
+stats_lock = threading.Lock()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    quiet = False
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with stats_lock:
+            stats['connections'] += 1
+            connection = stats['connections']
+        sender, recipients, sent = None, [], 0
+        self.reply('220 localhost debug SMTP server')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command, _, argument = line.decode(errors='replace').strip().partition(' ')
+            command = command.upper()
+
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == 'HELO':
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                sender, recipients = argument.partition(':')[2].strip(), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(argument.partition(':')[2].strip())
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                sent += 1
+                with stats_lock:
+                    stats['messages'] += 1
+                    total = stats['messages']
+                if not self.quiet:
+                    message = message_from_bytes(data)
+                    print(f"[conn {connection} msg {total}] {sender} -> {', '.join(recipients)}: {message['Subject']}")
+                self.reply('250 OK: queued')
+            elif command in ('RSET', 'NOOP'):
+                if command == 'RSET':
+                    sender, recipients = None, []
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+        if not self.quiet:
+            print(f'[conn {connection}] closed after {sent} message(s)')
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line in (b'.\r\n', b'.\n'):
+                break
+            # Undo dot-stuffing
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        return b''.join(lines)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Debug SMTP server that prints received messages')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--quiet', action='store_true', help='Only print totals on exit')
+    args = parser.parse_args()
+
+    Handler.quiet = args.quiet
+    server = Server((args.host, args.port), Handler)
+    print(f'Debug SMTP server on {args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{stats['messages']} message(s) over {stats['connections']} connection(s)")
+
+
+if __name__ == '__main__':
+    main()
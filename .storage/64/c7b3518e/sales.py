@@ -0,0 +1,262 @@
+"""
+Sales rollups for the admin dashboard.
+
+DailySales holds revenue, orders and units per day. ProductSales holds the
+same per day and product, with the product's category. Reports read only
+these tables, so their cost depends on the date range and catalog size, not
+on the number of orders.
+
+The rollups are maintained incrementally. Order.counted_in_sales records
+whether an order's totals are currently included. update_rollups() picks up
+orders whose flag disagrees with their state (newly paid, cancelled, payment
+failed) through a partial index, and adds or subtracts their contribution.
+Edits that leave the flag alone (the admin changing a counted order's amount
+or items) are corrected by rebuilding the order's day with backfill(), which
+the admin queues as a recount_sales_days task. backfill() rebuilds a date range from scratch with GROUP BY queries over
+both the hot and the archived order tables.
+
+Orders are sharded by user (see sharding.py) while the rollups live in the
+default database, so both jobs go through the shards one at a time. Each
+batch commits on the shard first and then in the default database; if the
+second commit fails, the lost batch comes back with the next backfill().
+"""
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import (
+    ROLLUP_PENDING, SALE, ArchivedOrder, ArchivedOrderItem, DailySales, Order, OrderItem, Product, ProductSales,
+)
+from .sharding import all_shards
+
+
+def _categories(product_ids):
+    # Products are in the default database, not on the order's shard
+    return dict(Product.objects.filter(id__in=product_ids).values_list('id', 'category_id'))
+
+
+def _contributions(orders, using):
+    """
+    Signed totals for the given orders from one shard: +1 for orders that now
+    count as a sale, -1 for ones that no longer do.
+    """
+    signs = {order.id: 1 if order.counts_as_sale else -1 for order in orders}
+    days = {order.id: timezone.localdate(order.created_at) for order in orders}
+
+    daily = defaultdict(lambda: [Decimal('0'), 0, 0])
+    for order in orders:
+        row = daily[days[order.id]]
+        row[0] += signs[order.id] * order.total_amount
+        row[1] += signs[order.id]
+
+    products = {}
+    items = list(OrderItem.objects.using(using).filter(order_id__in=signs).values_list(
+        'order_id', 'product_id', 'price', 'quantity'
+    ))
+    categories = _categories({product_id for _, product_id, _, _ in items})
+    for order_id, product_id, price, quantity in items:
+        sign, day = signs[order_id], days[order_id]
+        daily[day][2] += sign * quantity
+        row = products.setdefault((day, product_id), [categories.get(product_id), Decimal('0'), set(), 0])
+        row[1] += sign * price * quantity
+        row[2].add(order_id)
+        row[3] += sign * quantity
+
+    # The same order can't appear with both signs, so the distinct order ids
+    # all carry the sign of their order
+    product_rows = {
+        key: (category_id, revenue, sum(signs[order_id] for order_id in order_ids), units)
+        for key, (category_id, revenue, order_ids, units) in products.items()
+    }
+    return daily, product_rows
+
+
+def _apply(daily, products):
+    existing = {row.day: row for row in DailySales.objects.select_for_update().filter(day__in=daily)}
+    created = []
+    for day, (revenue, orders, units) in daily.items():
+        row = existing.get(day)
+        if row is None:
+            row = DailySales(day=day)
+            created.append(row)
+        row.revenue += revenue
+        row.orders += orders
+        row.units += units
+    DailySales.objects.bulk_update(existing.values(), ['revenue', 'orders', 'units'])
+    DailySales.objects.bulk_create(created)
+
+    existing = {
+        (row.day, row.product_id): row
+        for row in ProductSales.objects.select_for_update().filter(
+            day__in={day for day, _ in products},
+            product_id__in={product_id for _, product_id in products},
+        )
+    }
+    updated, created = [], []
+    for (day, product_id), (category_id, revenue, orders, units) in products.items():
+        row = existing.get((day, product_id))
+        if row is None:
+            row = ProductSales(day=day, product_id=product_id, category_id=category_id)
+            created.append(row)
+        else:
+            updated.append(row)
+        row.revenue += revenue
+        row.orders += orders
+        row.units += units
+    ProductSales.objects.bulk_update(updated, ['revenue', 'orders', 'units'])
+    ProductSales.objects.bulk_create(created)
+
+
+def update_rollups(batch_size=500):
+    """Fold new and changed orders into the rollups. Returns the number of orders applied."""
+    applied = 0
+    for db in all_shards():
+        shard_orders = Order.objects.using(db)
+        while True:
+            with transaction.atomic(), transaction.atomic(using=db):
+                orders = list(shard_orders.select_for_update().filter(ROLLUP_PENDING).order_by('id')[:batch_size])
+                if not orders:
+                    break
+                _apply(*_contributions(orders, db))
+                shard_orders.filter(id__in=[o.id for o in orders if o.counts_as_sale]).update(counted_in_sales=True)
+                shard_orders.filter(id__in=[o.id for o in orders if not o.counts_as_sale]).update(counted_in_sales=False)
+            applied += len(orders)
+    return applied
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _aggregate(order_model, item_model, day, chunk_end, using):
+    """Per-day and per-(day, product) sale totals from one pair of order tables on one shard."""
+    line_total = ExpressionWrapper(F('price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2))
+    sales = order_model.objects.using(using).filter(
+        SALE, created_at__gte=_day_start(day), created_at__lt=_day_start(chunk_end)
+    )
+    items = item_model.objects.using(using).filter(order__in=sales).annotate(day=TruncDate('order__created_at'))
+
+    daily = defaultdict(lambda: [Decimal('0'), 0, 0])
+    for row in sales.annotate(day=TruncDate('created_at')).values('day').annotate(revenue=Sum('total_amount'), orders=Count('id')):
+        daily[row['day']][0] += row['revenue']
+        daily[row['day']][1] += row['orders']
+    for row in items.values('day').annotate(units=Sum('quantity')):
+        daily[row['day']][2] += row['units']
+
+    rows = list(items.values('day', 'product_id').annotate(
+        revenue=Sum(line_total), orders=Count('order_id', distinct=True), units=Sum('quantity')
+    ))
+    categories = _categories({row['product_id'] for row in rows})
+    products = {
+        (row['day'], row['product_id']): [categories.get(row['product_id']), row['revenue'], row['orders'], row['units']]
+        for row in rows
+    }
+    return daily, products
+
+
+def backfill(start=None, end=None, chunk_days=31):
+    """
+    Rebuild the rollups for orders created from start to end (inclusive
+    dates; default: all orders, including archived ones), chunk_days at a
+    time. Returns the number of days rebuilt.
+    """
+    bounds = [
+        model.objects.using(db).aggregate(first=Min('created_at'), last=Max('created_at'))
+        for model in (Order, ArchivedOrder)
+        for db in all_shards()
+    ]
+    firsts = [b['first'] for b in bounds if b['first'] is not None]
+    if not firsts:
+        return 0
+    start = start or timezone.localdate(min(firsts))
+    end = end or timezone.localdate(max(b['last'] for b in bounds if b['last'] is not None))
+
+    day = start
+    while day <= end:
+        chunk_end = min(day + timedelta(days=chunk_days), end + timedelta(days=1))
+        with transaction.atomic(), ExitStack() as shard_transactions:
+            # The chunk's orders stay locked from being counted until they
+            # are flagged, so an order paid or cancelled in between can't be
+            # flagged with a state the rollups don't reflect
+            for db in all_shards():
+                shard_transactions.enter_context(transaction.atomic(using=db))
+                list(Order.objects.using(db).select_for_update().filter(
+                    created_at__gte=_day_start(day), created_at__lt=_day_start(chunk_end)
+                ).values_list('id', flat=True))
+
+            daily, products = defaultdict(lambda: [Decimal('0'), 0, 0]), {}
+            # An order is on one shard and either hot or archived, so the
+            # parts never overlap
+            for db in all_shards():
+                for order_model, item_model in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+                    part_daily, part_products = _aggregate(order_model, item_model, day, chunk_end, db)
+                    for key, (revenue, orders, units) in part_daily.items():
+                        row = daily[key]
+                        row[0] += revenue
+                        row[1] += orders
+                        row[2] += units
+                    for key, (category_id, revenue, orders, units) in part_products.items():
+                        row = products.setdefault(key, [category_id, Decimal('0'), 0, 0])
+                        row[1] += revenue
+                        row[2] += orders
+                        row[3] += units
+
+            DailySales.objects.filter(day__gte=day, day__lt=chunk_end).delete()
+            ProductSales.objects.filter(day__gte=day, day__lt=chunk_end).delete()
+            DailySales.objects.bulk_create([
+                DailySales(day=key, revenue=revenue, orders=orders, units=units)
+                for key, (revenue, orders, units) in daily.items()
+            ])
+            ProductSales.objects.bulk_create([
+                ProductSales(
+                    day=key[0],
+                    product_id=key[1],
+                    category_id=category_id,
+                    revenue=revenue,
+                    orders=orders,
+                    units=units,
+                )
+                for key, (category_id, revenue, orders, units) in products.items()
+            ], batch_size=1000)
+
+            for db in all_shards():
+                orders = Order.objects.using(db).filter(
+                    created_at__gte=_day_start(day), created_at__lt=_day_start(chunk_end)
+                )
+                orders.filter(SALE, counted_in_sales=False).update(counted_in_sales=True)
+                orders.exclude(SALE).filter(counted_in_sales=True).update(counted_in_sales=False)
+        day = chunk_end
+    return (end - start).days + 1
+
+
+def dashboard(days=30):
+    """Report data for the last `days` days, read from the rollups only."""
+    end = timezone.localdate()
+    start = end - timedelta(days=days - 1)
+    by_day = {row.day: row for row in DailySales.objects.filter(day__gte=start, day__lte=end)}
+    daily = [by_day.get(start + timedelta(days=i)) or DailySales(day=start + timedelta(days=i)) for i in range(days)]
+
+    product_sales = ProductSales.objects.filter(day__gte=start, day__lte=end)
+    return {
+        'start': start,
+        'end': end,
+        'days': days,
+        'daily': daily,
+        'totals': {
+            'revenue': sum(row.revenue for row in daily),
+            'orders': sum(row.orders for row in daily),
+            'units': sum(row.units for row in daily),
+        },
+        'categories': product_sales.values('category__name').annotate(
+            revenue=Sum('revenue'), units=Sum('units')
+        ).exclude(revenue=0).order_by('-revenue'),
+        'top_products': product_sales.values('product__name').annotate(
+            revenue=Sum('revenue'), units=Sum('units')
+        ).exclude(revenue=0).order_by('-revenue')[:10],
+    }
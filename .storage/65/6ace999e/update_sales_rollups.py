@@ -0,0 +1,16 @@
+import time
+from django.core.management.base import BaseCommand
+from store import sales
+
+
+class Command(BaseCommand):
+    help = 'Fold new, cancelled and refunded orders into the sales rollup tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Orders applied per transaction (default 500)')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        applied = sales.update_rollups(options['batch_size'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'Applied {applied} order(s) to the sales rollups in {elapsed:.2f}s.'))
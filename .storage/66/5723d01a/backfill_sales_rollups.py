@@ -0,0 +1,19 @@
+import time
+from datetime import date
+from django.core.management.base import BaseCommand
+from store import sales
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the sales rollup tables from orders, one chunk of days at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to rebuild, YYYY-MM-DD (default: first order)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to rebuild, YYYY-MM-DD (default: last order)')
+        parser.add_argument('--chunk-days', type=int, default=31, help='Days rebuilt per transaction (default 31)')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        days = sales.backfill(options['start'], options['end'], options['chunk_days'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt sales rollups for {days} day(s) in {elapsed:.2f}s.'))
@@ -0,0 +1,75 @@
+"""
+Order archival.
+
+Delivered and cancelled orders that haven't changed for a while are moved,
+with their items, from Order/OrderItem to ArchivedOrder/ArchivedOrderItem in
+small batches. Each batch is one transaction, so an interrupted run simply
+continues where it stopped next time. Ids are preserved, and the helpers
+below let the order pages read from both tables. Archived orders stay on
+their user's shard, so a batch works within one shard.
+"""
+import heapq
+
+from django.db import transaction
+from django.http import Http404
+from django.utils import timezone
+
+from . import outbox
+from .models import ROLLUP_PENDING, ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+from .sharding import DEFAULT_DB
+
+ARCHIVABLE_STATUSES = ('delivered', 'cancelled')
+
+ORDER_FIELDS = [f.attname for f in ArchivedOrder._meta.concrete_fields if f.name != 'archived_at']
+ITEM_FIELDS = [f.attname for f in ArchivedOrderItem._meta.concrete_fields]
+
+
+def archivable(older_than, using=DEFAULT_DB):
+    cutoff = timezone.now() - older_than
+    # Orders the sales rollups haven't caught up with yet stay until they have
+    return Order.objects.using(using).filter(status__in=ARCHIVABLE_STATUSES, updated_at__lt=cutoff).exclude(ROLLUP_PENDING)
+
+
+def archive_batch(older_than, batch_size=500, using=DEFAULT_DB):
+    """Move one batch of orders on one shard to the archive. Returns the number moved."""
+    with transaction.atomic(using=using):
+        orders = list(archivable(older_than, using).select_for_update().order_by('id')[:batch_size])
+        if not orders:
+            return 0
+        order_ids = [order.id for order in orders]
+        items = list(OrderItem.objects.using(using).filter(order_id__in=order_ids))
+
+        ArchivedOrder.objects.using(using).bulk_create(
+            [ArchivedOrder(**{field: getattr(order, field) for field in ORDER_FIELDS}) for order in orders],
+            ignore_conflicts=True,
+        )
+        ArchivedOrderItem.objects.using(using).bulk_create(
+            [ArchivedOrderItem(**{field: getattr(item, field) for field in ITEM_FIELDS}) for item in items],
+            ignore_conflicts=True,
+        )
+        OrderItem.objects.using(using).filter(order_id__in=order_ids).delete()
+        # Feed consumers see 'archived' rather than 'deleted' events
+        with outbox.deletes_recorded_as('archived'):
+            Order.objects.using(using).filter(id__in=order_ids).delete()
+    return len(orders)
+
+
+def get_order_or_404(order_id, user):
+    """Look one of the user's orders up in the hot table first, then in the archive."""
+    order = Order.objects.for_user(user).filter(id=order_id).first()
+    if order is None:
+        order = ArchivedOrder.objects.for_user(user).filter(id=order_id).first()
+    if order is None:
+        raise Http404('No order matches the given query.')
+    return order
+
+
+def user_orders(user):
+    """All of the user's orders, hot and archived, newest first."""
+    return list(heapq.merge(
+        Order.objects.for_user(user).order_by('-created_at'),
+        ArchivedOrder.objects.for_user(user).order_by('-created_at'),
+        key=lambda order: order.created_at,
+        reverse=True,
+    ))
+
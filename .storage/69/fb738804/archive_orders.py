@@ -0,0 +1,34 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from store import archive, sharding
+
+
+class Command(BaseCommand):
+    help = 'Move old delivered and cancelled orders to the archive tables in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.ORDER_ARCHIVE_AFTER_DAYS,
+                            help='Archive orders not updated for this many days (default ORDER_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Orders moved per transaction (default 500)')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches (default 0)')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many batches; rerun to continue')
+
+    def handle(self, *args, **options):
+        older_than = timedelta(days=options['older_than_days'])
+        start = time.perf_counter()
+        moved = batches = 0
+        for db in sharding.all_shards():
+            while options['max_batches'] is None or batches < options['max_batches']:
+                count = archive.archive_batch(older_than, options['batch_size'], using=db)
+                if not count:
+                    break
+                moved += count
+                batches += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'Archived {moved} order(s) so far ({db})...')
+                if options['pause']:
+                    time.sleep(options['pause'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} order(s) in {batches} batch(es) in {elapsed:.2f}s.'))
@@ -0,0 +1,63 @@
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store.models import CartItem
+from store.sharding import all_shards
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned carts in small batches so the cart table is never locked for long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl-days', type=float, default=settings.CART_TTL_DAYS,
+                            help='Delete carts with nothing added for this many days (default CART_TTL_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Cart items deleted per statement (default 1000)')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches (default 0.1)')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches; the next run resumes')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        cutoff = timezone.now() - timedelta(days=options['ttl_days'])
+        start = time.perf_counter()
+        purged = batches = 0
+        users = set()
+
+        for db in all_shards():
+            # A cart expires as a whole: users who added anything recently
+            # keep their older items too. A user's cart is on one shard.
+            carts = CartItem.objects.using(db)
+            expired = carts.filter(date_added__lt=cutoff).exclude(
+                user__in=carts.filter(date_added__gte=cutoff).values('user')
+            )
+            while options['max_batches'] is None or batches < options['max_batches']:
+                # Delete by primary key so each statement stays short. The
+                # DELETE repeats the conditions: a user may have added
+                # something since the ids were read
+                rows = list(expired.values_list('id', 'user_id')[:batch_size])
+                if not rows:
+                    break
+                deleted, _ = expired.filter(id__in=[row_id for row_id, _ in rows]).delete()
+                purged += deleted
+                users.update(user_id for _, user_id in rows)
+                batches += 1
+                if len(rows) < batch_size:
+                    break
+                time.sleep(options['pause'])
+
+        elapsed = time.perf_counter() - start
+        logger.info(
+            'purge_carts: %d item(s) from %d cart(s) in %d batch(es), %.2fs',
+            purged, len(users), batches, elapsed,
+            extra={'purged_items': purged, 'purged_carts': len(users), 'batches': batches, 'seconds': elapsed},
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {purged} cart item(s) from {len(users)} abandoned cart(s) in {batches} batch(es) in {elapsed:.2f}s.'
+        ))
@@ -0,0 +1,216 @@
+"""
+Search suggestions from an in-process prefix index.
+
+Every product and category name is indexed under each of its word suffixes
+("snake plant" and "plant" for "Snake Plant") in a sorted list, so a prefix
+lookup is two bisects plus a scan of the matching range, without touching the
+database. Matches are ranked by popularity (order lines per product; a
+category scores the sum of its products).
+
+The index is built on first use and kept current:
+- saves and deletes in this process update it immediately (signals below)
+- every TYPEAHEAD_SYNC_SECONDS a background thread applies products changed
+  by other processes (by updated_at)
+- every TYPEAHEAD_REBUILD_SECONDS it is rebuilt from scratch, which also picks
+  up deletions elsewhere and fresh popularity counts
+"""
+import bisect
+import heapq
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
+
+from .models import Category, OrderItem, Product
+from .sharding import all_shards
+
+MAX_RESULTS = 20
+_MAX_MEMO = 2000
+
+
+def normalize(text):
+    # Case- and accent-insensitive, with single spaces
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.casefold().split())
+
+
+def terms(name):
+    words = normalize(name).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.keys = []      # sorted search terms
+        self.refs = []      # (type, id) for each key
+        self.entries = {}   # (type, id) -> suggestion dict
+        self.memo = {}      # (prefix, limit) -> results, cleared on every change
+        self.lock = threading.RLock()
+
+    def load(self, entries):
+        """Replace the contents with {ref: entry}."""
+        pairs = sorted((term, ref) for ref, entry in entries.items() for term in terms(entry['name']))
+        with self.lock:
+            self.keys = [term for term, _ in pairs]
+            self.refs = [ref for _, ref in pairs]
+            self.entries = dict(entries)
+            self.memo = {}
+
+    def add(self, ref, entry):
+        with self.lock:
+            self.remove(ref)
+            self.entries[ref] = entry
+            for term in terms(entry['name']):
+                i = bisect.bisect_left(self.keys, term)
+                self.keys.insert(i, term)
+                self.refs.insert(i, ref)
+            self.memo = {}
+
+    def remove(self, ref):
+        with self.lock:
+            entry = self.entries.pop(ref, None)
+            if entry is None:
+                return
+            for term in terms(entry['name']):
+                i = bisect.bisect_left(self.keys, term)
+                while i < len(self.keys) and self.keys[i] == term:
+                    if self.refs[i] == ref:
+                        del self.keys[i]
+                        del self.refs[i]
+                        break
+                    i += 1
+            self.memo = {}
+
+    def search(self, prefix, limit=8):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self.lock:
+            results = self.memo.get((prefix, limit))
+            if results is None:
+                lo = bisect.bisect_left(self.keys, prefix)
+                hi = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo)
+                matches = (self.entries[ref] for ref in set(self.refs[lo:hi]))
+                results = heapq.nlargest(limit, matches, key=lambda e: (e['score'], -len(e['name'])))
+                if len(self.memo) >= _MAX_MEMO:
+                    self.memo.clear()
+                self.memo[(prefix, limit)] = results
+            return results
+
+
+def product_entry(product_id, name, slug, score):
+    return {'type': 'product', 'name': name, 'url': reverse('product-detail', kwargs={'slug': slug}), 'score': score}
+
+
+def category_entry(name, slug, score):
+    return {'type': 'category', 'name': name, 'url': reverse('category-products', kwargs={'category_slug': slug}), 'score': score}
+
+
+index = PrefixIndex()
+_state = {'built_at': None, 'synced_at': 0.0, 'watermark': None, 'refreshing': False}
+_state_lock = threading.Lock()
+
+
+def build():
+    popularity = {}
+    for db in all_shards():
+        counts = OrderItem.objects.using(db).values('product').annotate(n=Count('id')).values_list('product', 'n')
+        for product_id, n in counts:
+            popularity[product_id] = popularity.get(product_id, 0) + n
+    products = list(Product.objects.values_list('id', 'name', 'slug', 'category_id', 'updated_at'))
+    category_scores = {}
+    entries = {}
+    for product_id, name, slug, category_id, _ in products:
+        score = popularity.get(product_id, 0)
+        category_scores[category_id] = category_scores.get(category_id, 0) + score
+        entries[('product', product_id)] = product_entry(product_id, name, slug, score)
+    for category_id, name, slug in Category.objects.values_list('id', 'name', 'slug'):
+        entries[('category', category_id)] = category_entry(name, slug, category_scores.get(category_id, 0))
+
+    index.load(entries)
+    now = time.monotonic()
+    _state.update(
+        built_at=now,
+        synced_at=now,
+        watermark=max((p[4] for p in products), default=None),
+    )
+    return len(entries)
+
+
+def sync():
+    """Apply products changed since the last build or sync."""
+    changed = Product.objects.values_list('id', 'name', 'slug', 'updated_at')
+    if _state['watermark'] is not None:
+        changed = changed.filter(updated_at__gt=_state['watermark'])
+    watermark = _state['watermark']
+    for product_id, name, slug, updated_at in changed:
+        old = index.entries.get(('product', product_id))
+        index.add(('product', product_id), product_entry(product_id, name, slug, old['score'] if old else 0))
+        watermark = max(watermark, updated_at) if watermark else updated_at
+    _state.update(synced_at=time.monotonic(), watermark=watermark)
+
+
+def _refresh():
+    try:
+        if time.monotonic() - _state['built_at'] >= settings.TYPEAHEAD_REBUILD_SECONDS:
+            build()
+        else:
+            sync()
+    finally:
+        _state['refreshing'] = False
+        close_old_connections()
+
+
+def _ensure_fresh():
+    if _state['built_at'] is None:
+        with _state_lock:
+            if _state['built_at'] is None:
+                build()
+        return
+    if time.monotonic() - _state['synced_at'] < settings.TYPEAHEAD_SYNC_SECONDS:
+        return
+    with _state_lock:
+        if _state['refreshing']:
+            return
+        _state['refreshing'] = True
+    # Requests keep answering from the current index while it refreshes
+    threading.Thread(target=_refresh, name='typeahead-refresh', daemon=True).start()
+
+
+def suggest(query, limit=8):
+    _ensure_fresh()
+    return [
+        {'type': entry['type'], 'name': entry['name'], 'url': entry['url']}
+        for entry in index.search(query, min(limit, MAX_RESULTS))
+    ]
+
+
+@receiver(post_save, sender=Product, dispatch_uid='typeahead_product_saved')
+def product_saved(sender, instance, **kwargs):
+    if _state['built_at'] is not None:
+        old = index.entries.get(('product', instance.id))
+        index.add(('product', instance.id), product_entry(instance.id, instance.name, instance.slug, old['score'] if old else 0))
+
+
+@receiver(post_delete, sender=Product, dispatch_uid='typeahead_product_deleted')
+def product_deleted(sender, instance, **kwargs):
+    index.remove(('product', instance.id))
+
+
+@receiver(post_save, sender=Category, dispatch_uid='typeahead_category_saved')
+def category_saved(sender, instance, **kwargs):
+    if _state['built_at'] is not None:
+        old = index.entries.get(('category', instance.id))
+        index.add(('category', instance.id), category_entry(instance.name, instance.slug, old['score'] if old else 0))
+
+
+@receiver(post_delete, sender=Category, dispatch_uid='typeahead_category_deleted')
+def category_deleted(sender, instance, **kwargs):
+    index.remove(('category', instance.id))
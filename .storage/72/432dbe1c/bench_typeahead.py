@@ -0,0 +1,63 @@
+import os
+import statistics
+import sys
+import time
+import django
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plant_nursery.settings')
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+django.setup()
+
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from store import api, typeahead
+from store.models import Category, Product
+
+# Latency of the typeahead suggestions endpoint once the index is built.
+#
+#   python bench_typeahead.py [rounds]
+#
+# Queries are every 1-4 character prefix of each product and category word,
+# as typed. Reports the index build time, then per-request latency of the
+# api.suggest view and the number of database queries it made (should be 0).
+# Needs the sample data (python sample_data.py).
+
+
+def prefixes():
+    names = list(Product.objects.values_list('name', flat=True)) + list(Category.objects.values_list('name', flat=True))
+    words = {word for name in names for word in name.lower().split()}
+    return sorted({word[:n] for word in words for n in range(1, 5)})
+
+
+def bench(rounds):
+    queries = prefixes()
+    factory = RequestFactory()
+    requests = [factory.get('/api/v1/suggest/', {'q': q}) for q in queries]
+
+    start = time.perf_counter()
+    entries = typeahead.build()
+    print(f"index:    {entries} entries, {len(typeahead.index.keys)} terms, built in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    timings = []
+    with CaptureQueriesContext(connection) as captured:
+        for _ in range(rounds):
+            # Clear the memo so every round searches the index itself
+            typeahead.index.memo = {}
+            for request in requests:
+                t0 = time.perf_counter()
+                api.suggest(request)
+                timings.append(time.perf_counter() - t0)
+
+    timings.sort()
+    print(f"requests: {len(timings)} ({len(queries)} prefixes x {rounds} rounds)")
+    print(f"p50:      {statistics.median(timings) * 1e6:.0f}us")
+    print(f"p95:      {timings[int(len(timings) * 0.95)] * 1e6:.0f}us")
+    print(f"p99:      {timings[int(len(timings) * 0.99)] * 1e6:.0f}us")
+    print(f"max:      {timings[-1] * 1e6:.0f}us")
+    print(f"queries:  {len(captured.captured_queries)}")
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,45 @@
+"""
+Catalog version.
+
+A token in the shared cache that changes whenever a product or category is
+saved or deleted. Caches of catalog data (search.py, page_cache.py) tag
+their entries with it and drop them when it changes. For the invalidation to
+reach every process, the default cache must be shared between them (Redis,
+Memcached); with the local-memory cache each process only sees its own
+edits.
+"""
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Category, Product
+
+VERSION_KEY = 'catalog:version'
+
+
+def catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # add() so that processes starting together agree on one token
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    # A fresh random token, so a version evicted from the cache and recreated
+    # can never match entries tagged with an older one
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+@receiver(post_save, sender=Product, dispatch_uid='catalog_product_saved')
+@receiver(post_delete, sender=Product, dispatch_uid='catalog_product_deleted')
+@receiver(post_save, sender=Category, dispatch_uid='catalog_category_saved')
+@receiver(post_delete, sender=Category, dispatch_uid='catalog_category_deleted')
+def catalog_changed(sender, **kwargs):
+    # After commit, or another request could cache the old rows under the
+    # new version
+    transaction.on_commit(bump_catalog_version)
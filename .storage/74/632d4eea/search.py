@@ -0,0 +1,211 @@
+"""
+Product search with a result cache.
+
+Queries are normalized (case, whitespace, plural endings) so "Succulents ",
+"succulent" and "SUCCULENTS" share one cache entry and one set of results.
+A product matches when each word of the normalized query, or its plural,
+appears in its name, description or category name, so "snake-plant" finds
+"Snake Plant" and "lily" finds "Peace Lilies".
+The cache keeps, per normalized query and category, the number of matches
+and the ordered product ids of each page that has been requested. A cache hit
+costs one primary-key lookup for the page's products instead of the
+icontains scans and count, or none when the products are in the catalog
+snapshot (catalog_snapshot.py).
+
+The cache lives in each process as an LRU bounded by entry count and by
+approximate size, so broad queries with long id lists make room for several
+narrow ones. Entries are dropped as soon as the catalog version (catalog.py)
+changes. That version lives in Django's cache, so the result cache is only
+used with a shared one (settings.SHARED_CACHE); with a per-process cache, a
+change made by another worker or a management command would never reach it.
+"""
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+
+from . import catalog_snapshot
+from .catalog import catalog_version
+from .models import Product
+
+
+def stem(word):
+    # Plural endings only; enough to fold "succulents" into "succulent"
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('sses', 'shes', 'ches', 'xes', 'zes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def normalize_query(query):
+    words = re.findall(r'\w+', query.casefold())
+    return ' '.join(stem(word) for word in words)
+
+
+class LRUCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.version = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def check_version(self, version):
+        with self.lock:
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, version):
+        size = _size(key) + _size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            # Computed against a catalog that has changed since
+            if version != self.version:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+def _size(value):
+    # Approximate: the container plus what it holds, one level deep
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+result_cache = LRUCache(settings.SEARCH_CACHE_MAX_ENTRIES, settings.SEARCH_CACHE_MAX_BYTES)
+
+
+def cache_stats():
+    return result_cache.stats()
+
+
+def word_forms(word):
+    # What stem() may have folded into word, as far as icontains can't
+    # already find it: "lily" isn't part of "lilies", "plant" is of "plants"
+    forms = [word]
+    if len(word) > 2 and word.endswith('y'):
+        forms.append(word[:-1] + 'ies')
+    return forms
+
+
+def search_queryset(query, category=None):
+    """Products matching a normalized query: every word, in any of the fields."""
+    queryset = Product.objects.all()
+    if category is not None:
+        queryset = queryset.filter(category=category)
+    for word in query.split():
+        matches = Q()
+        for form in word_forms(word):
+            matches |= (
+                Q(name__icontains=form) |
+                Q(description__icontains=form) |
+                Q(category__name__icontains=form)
+            )
+        queryset = queryset.filter(matches)
+    return queryset
+
+
+class SearchResults:
+    """
+    The products matching a search, as a sequence Paginator can page
+    through: count() and slicing are answered from the result cache, and only
+    the products on the requested page are loaded.
+    """
+
+    def __init__(self, query, category=None):
+        self.query = normalize_query(query)
+        self.category = category
+        self.category_id = category.id if category is not None else None
+        self.cached = settings.SHARED_CACHE
+        if self.cached:
+            self.version = catalog_version()
+            result_cache.check_version(self.version)
+
+    def _get(self, key):
+        return result_cache.get(key) if self.cached else None
+
+    def _set(self, key, value):
+        if self.cached:
+            result_cache.set(key, value, self.version)
+
+    def count(self):
+        if not self.query:
+            return 0
+        key = ('count', self.query, self.category_id)
+        total = self._get(key)
+        if total is None:
+            total = search_queryset(self.query, self.category).count()
+            self._set(key, total)
+        return total
+
+    def __len__(self):
+        return self.count()
+
+    def ids(self, start, stop):
+        if not self.query:
+            return ()
+        key = ('page', self.query, self.category_id, start, stop)
+        ids = self._get(key)
+        if ids is None:
+            ids = tuple(search_queryset(self.query, self.category).values_list('id', flat=True)[start:stop])
+            self._set(key, ids)
+        return ids
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError('SearchResults only supports simple slices')
+        ids = self.ids(index.start or 0, index.stop)
+        snapshot = catalog_snapshot.current()
+        products = snapshot.products_by_id(ids) if snapshot is not None else {}
+        missing = [product_id for product_id in ids if product_id not in products]
+        if missing:
+            products.update(Product.objects.in_bulk(missing))
+        # Products deleted since the ids were cached are skipped
+        return [products[product_id] for product_id in ids if product_id in products]
@@ -0,0 +1,221 @@
+"""
+Full-page cache for the catalog pages.
+
+The home, product list and product detail pages are rendered the same for
+every visitor. The parts that depend on the user are "holes" (see the hole
+and csrf_hole template tags): the login/cart links, flashed messages, the
+wishlist and restock buttons and CSRF tokens. A page ships with the
+anonymous version of each hole. main.js then fills them from one request to /fragments/. With
+PAGE_CACHE_ESI set, the page carries <esi:include> tags instead, for an edge
+proxy to fill from /fragments/<name>/.
+
+Because the pages never read the session, they carry no Vary: Cookie and
+can be cached for everyone:
+
+- in Django's cache, keyed by URL, the catalog version and the catalog
+  snapshot, so a product or category change makes every cached page stale at
+  once, and so does a new snapshot once the process maps it. Only with a
+  shared cache (settings.SHARED_CACHE): the catalog version lives in the
+  cache, and a worker with its own copy would never see another worker's
+  changes
+- by a shared reverse proxy, for PAGE_CACHE_SHARED_MAX_AGE seconds
+  (s-maxage); browsers always revalidate with the ETag
+
+Fragment responses are private and never cached.
+"""
+import hashlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, set_response_etag
+from django.utils.html import format_html
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_safe
+
+from . import catalog_snapshot
+from .catalog import catalog_version
+from .models import RestockRequest, WishlistItem
+
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def _product_id(params):
+    try:
+        return int(params.get('product', ''))
+    except ValueError:
+        raise Http404('No product given')
+
+
+def wishlist_context(user, params):
+    product_id = _product_id(params)
+    in_wishlist = user.is_authenticated and WishlistItem.objects.filter(
+        wishlist__user=user, product_id=product_id
+    ).exists()
+    return {'product_id': product_id, 'in_wishlist': in_wishlist}
+
+
+def restock_context(user, params):
+    product_id = _product_id(params)
+    requested = user.is_authenticated and RestockRequest.objects.filter(user=user, product_id=product_id).exists()
+    return {'product_id': product_id, 'requested': requested}
+
+
+# Hole name -> (template, extra context builder)
+HOLES = {
+    'nav_user': ('store/fragments/nav_user.html', None),
+    'footer_links': ('store/fragments/footer_links.html', None),
+    'messages': ('store/fragments/messages.html', None),
+    'wishlist_button': ('store/fragments/wishlist_button.html', wishlist_context),
+    'restock_button': ('store/fragments/restock_button.html', restock_context),
+}
+
+
+def render_hole(name, params, request=None):
+    """
+    Render a hole for the user of `request`, or for an anonymous visitor
+    without pending messages when there is no request (the version baked
+    into cached pages).
+    """
+    template, build_context = HOLES[name]
+    user = request.user if request is not None else AnonymousUser()
+    context = build_context(user, params) if build_context else {}
+    if request is None:
+        context.update(user=user, messages=[])
+    return render_to_string(template, context, request=request)
+
+
+def esi_include(name, query=''):
+    src = reverse('page-fragment', args=[name]) + (f'?{query}' if query else '')
+    return format_html('<esi:include src="{}" />', src)
+
+
+def csrf_input(request):
+    """
+    The CSRF token field for a form. Cached pages get a blank one for the
+    visitor's browser to fill in, or an edge-side include.
+    """
+    if not is_cached_page(request):
+        return format_html('<input type="hidden" name="csrfmiddlewaretoken" value="{}">', get_token(request))
+    if settings.PAGE_CACHE_ESI:
+        return esi_include('csrf_token')
+    return format_html('<input type="hidden" name="csrfmiddlewaretoken" value="" data-csrf-hole>')
+
+
+@never_cache
+@require_safe
+def fragments(request):
+    """The holes named in ?hole= for the current user, plus a CSRF token, as JSON."""
+    holes = {}
+    for name in request.GET.getlist('hole'):
+        if name not in HOLES:
+            continue
+        try:
+            holes[name] = render_hole(name, request.GET, request)
+        except Http404:
+            # e.g. a button hole without its product; the page keeps the
+            # anonymous version of that one
+            continue
+    return JsonResponse({
+        'holes': holes,
+        'csrf_token': get_token(request),
+    })
+
+
+@never_cache
+@require_safe
+def fragment(request, name):
+    """One hole as HTML, for edge-side includes."""
+    if name == 'csrf_token':
+        html = format_html('<input type="hidden" name="csrfmiddlewaretoken" value="{}">', get_token(request))
+    elif name in HOLES:
+        html = render_hole(name, request.GET, request)
+    else:
+        raise Http404('No such fragment')
+    return HttpResponse(html)
+
+
+def is_cached_page(request):
+    return getattr(request, 'full_page_cache', False)
+
+
+def page_key(request):
+    url = hashlib.sha1(request.build_absolute_uri().encode()).hexdigest()
+    # Pages rendered from an older snapshot after the catalog changed
+    # mustn't outlive it
+    snapshot = catalog_snapshot.current()
+    return f'page:{catalog_version()}:{snapshot.token if snapshot else "db"}:{url}'
+
+
+def _cached_response(request, entry):
+    headers = entry['headers']
+    response = get_conditional_response(request, etag=headers.get('ETag'))
+    if response is None:
+        response = HttpResponse(entry['content'])
+    for header, value in headers.items():
+        if header != 'Content-Type' or response.status_code == 200:
+            response[header] = value
+    return response
+
+
+def _lookup(request):
+    """Returns (key to store the response under, cached response)."""
+    if not settings.SHARED_CACHE or request.method not in ('GET', 'HEAD'):
+        return None, None
+    key = page_key(request)
+    entry = cache.get(key)
+    if entry is None:
+        # HEAD responses have no body worth keeping
+        return (key if request.method == 'GET' else None), None
+    response = _cached_response(request, entry)
+    response['X-Page-Cache'] = 'hit'
+    return None, _public(response)
+
+
+def _store(key, response):
+    if key is not None and response.status_code == 200 and not response.streaming:
+        if hasattr(response, 'render'):
+            # A TemplateResponse from the class-based views
+            response.render()
+        if not response.has_header('ETag'):
+            set_response_etag(response)
+        cache.set(key, {
+            'content': response.content,
+            'headers': {h: response[h] for h in CACHED_HEADERS if response.has_header(h)},
+        }, settings.PAGE_CACHE_TIMEOUT)
+        response['X-Page-Cache'] = 'miss'
+    return _public(response)
+
+
+def _public(response):
+    if response.status_code in (200, 304):
+        patch_cache_control(response, public=True, max_age=0, s_maxage=settings.PAGE_CACHE_SHARED_MAX_AGE)
+    return response
+
+
+def full_page_cache(view):
+    """Serve a catalog view from the page cache. Works for sync and async views."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            key, response = await sync_to_async(_lookup)(request)
+            if response is not None:
+                return response
+            request.full_page_cache = True
+            response = await view(request, *args, **kwargs)
+            return await sync_to_async(_store)(key, response)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key, response = _lookup(request)
+            if response is not None:
+                return response
+            request.full_page_cache = True
+            return _store(key, view(request, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,44 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html
+from django.utils.http import urlencode
+
+from store.cards import render_cards
+from store.page_cache import csrf_input, esi_include, is_cached_page, render_hole
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def hole(context, name, **params):
+    """
+    A user-specific region. On pages served through the page cache it
+    renders the anonymous version, which main.js replaces with the visitor's
+    own, or an edge-side include. Elsewhere it renders for the current user.
+    """
+    request = context.get('request')
+    if not is_cached_page(request):
+        return render_hole(name, params, request)
+
+    query = urlencode({key: value for key, value in params.items() if value is not None})
+    if settings.PAGE_CACHE_ESI:
+        return esi_include(name, query)
+    return format_html(
+        '<div data-hole="{}" data-hole-params="{}" style="display: contents">{}</div>',
+        name, query, render_hole(name, params),
+    )
+
+
+@register.simple_tag(takes_context=True)
+def csrf_hole(context):
+    """{% csrf_token %} that cached pages leave for the visitor's browser to fill in."""
+    return csrf_input(context.get('request'))
+
+
+@register.simple_tag(takes_context=True)
+def product_cards(context, products, variant='grid'):
+    """
+    [(product, card HTML)] from the card cache (see store/cards.py), e.g.
+    {% product_cards products 'grid' as cards %}
+    """
+    return render_cards(products, variant, context.get('request'))
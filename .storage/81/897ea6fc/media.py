@@ -0,0 +1,191 @@
+"""
+Serving uploaded media (product photos) in production.
+
+serve() checks the request against the file's validators (an ETag and
+Last-Modified from the file's mtime and size, in the same format nginx
+uses) and then hands the bytes off without reading them in Python. How it
+does that depends on MEDIA_SERVE_MODE:
+
+- 'x-accel': an X-Accel-Redirect to an internal nginx location
+- 'x-sendfile': an X-Sendfile header (Apache mod_xsendfile, lighttpd)
+- 'file': a FileResponse that the WSGI server sends through
+  wsgi.file_wrapper, which gunicorn implements with os.sendfile()
+
+The front server answers Range requests itself in the first two modes.
+serve() handles them in 'file' mode, for a single range.
+
+Uploads are stored under content-addressed names (photo.<hash>.jpg, see
+ContentAddressedStorage), so their URLs never change meaning and can be
+cached for a year. Other files get MEDIA_CACHE_MAX_AGE and must be
+revalidated.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+BLOCK_SIZE = 64 * 1024
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names every upload after its content, e.g.
+    products/fern.3f9a0c1b2d4e.jpg. Uploading the same bytes twice reuses
+    the stored file.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        root, ext = os.path.splitext(name)
+        suffix = f'.{digest.hexdigest()[:12]}{ext}'
+        # Shorten the original name rather than let get_available_name()
+        # cut into the hash
+        excess = len(root) + len(suffix) - max_length if max_length else 0
+        if excess > 0:
+            dir_name, stem = os.path.split(root)
+            if excess >= len(stem):
+                raise SuspiciousFileOperation(
+                    f'{name!r} does not fit in {max_length} characters with its content hash.'
+                )
+            root = os.path.join(dir_name, stem[:-excess])
+        name = root + suffix
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+class RangeFile:
+    """
+    A window of an open file. The underlying file is positioned at the start
+    of the range, so servers that use fileno() with sendfile() send from
+    there (bounded by Content-Length), and read() stops at the end.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Returns (start, end) for a single byte range, None when the header
+    should be ignored (absent, malformed or several ranges), or raises
+    ValueError when the range can't be satisfied.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip()) if header else None
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+        if int(last) == 0:
+            raise ValueError('Empty suffix range')
+    if start >= size:
+        raise ValueError('Range starts after the end of the file')
+    return start, end
+
+
+def _range_applies(request, etag, mtime):
+    # A client holding an outdated copy asks for the whole file via If-Range
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == mtime
+
+
+def _file_response(request, path, size, content_type, etag, mtime):
+    byte_range = None
+    if _range_applies(request, etag, mtime):
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), content_type=content_type, status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    response.block_size = BLOCK_SIZE
+    return response
+
+
+@require_safe
+def serve(request, path):
+    fullpath = safe_join(settings.MEDIA_ROOT, path)
+    try:
+        st = os.stat(fullpath)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('No such file')
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404('No such file')
+
+    mtime = int(st.st_mtime)
+    etag = f'"{mtime:x}-{st.st_size:x}"'
+    response = get_conditional_response(request, etag=etag, last_modified=mtime)
+    if response is None:
+        content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+        mode = settings.MEDIA_SERVE_MODE
+        if mode == 'x-accel':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_LOCATION + quote(path)
+        elif mode == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = fullpath
+        else:
+            response = _file_response(request, fullpath, st.st_size, content_type, etag, mtime)
+
+    if response.status_code in (200, 206, 304):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(mtime)
+        response['Accept-Ranges'] = 'bytes'
+        if HASHED_NAME.search(path):
+            patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+        else:
+            patch_cache_control(response, public=True, max_age=settings.MEDIA_CACHE_MAX_AGE)
+    return response
@@ -0,0 +1,164 @@
+"""
+Sitemaps for search engines, written as static files.
+
+Products are split into shards by id range, SITEMAP_SHARD_SIZE (at most
+50,000, the sitemap protocol's limit) ids per shard, so a product always
+lands in the same shard. Each shard is a gzipped file,
+SITEMAP_ROOT/products-<n>.xml.gz, with the product URLs and their updated_at
+as lastmod. Categories get one file of their own. SITEMAP_ROOT/sitemap.xml
+is the index.
+
+manifest.json records each shard's product count and newest updated_at. A
+rebuild compares those with a single GROUP BY over the products. It only
+rewrites shards where something was added, edited or deleted. Shards are
+streamed from the database with iterator() and written to a temporary file
+that replaces the old one, so crawlers never see a partial file.
+"""
+import gzip
+import json
+import os
+from datetime import datetime, timezone as dt_timezone
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.db.models import BigIntegerField, Count, ExpressionWrapper, F, Max
+from django.urls import reverse
+
+from .models import Category, Product
+
+MAX_URLS = 50000
+XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def shard_size():
+    return min(settings.SITEMAP_SHARD_SIZE, MAX_URLS)
+
+
+def shard_name(shard):
+    return f'products-{shard:04d}.xml.gz'
+
+
+def lastmod(value):
+    return value.astimezone(dt_timezone.utc).replace(microsecond=0).isoformat().replace('+00:00', 'Z')
+
+
+def absolute(url):
+    return settings.SITEMAP_BASE_URL.rstrip('/') + url
+
+
+def sitemap_url(name):
+    return absolute(settings.SITEMAP_URL + name)
+
+
+def _write(name, lines, compress=True):
+    """Write lines to SITEMAP_ROOT/name atomically."""
+    path = os.path.join(settings.SITEMAP_ROOT, name)
+    tmp = f'{path}.tmp'
+    opener = gzip.open if compress else open
+    with opener(tmp, 'wt', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line)
+    os.replace(tmp, path)
+
+
+def _urlset(rows):
+    yield f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{XMLNS}">\n'
+    for url, modified in rows:
+        line = f'<url><loc>{escape(absolute(url))}</loc>'
+        if modified is not None:
+            line += f'<lastmod>{lastmod(modified)}</lastmod>'
+        yield line + '</url>\n'
+    yield '</urlset>\n'
+
+
+def shard_state():
+    """{shard: {'count': ..., 'lastmod': ...}} for every non-empty shard, from one query."""
+    shard = ExpressionWrapper((F('id') - 1) / shard_size(), output_field=BigIntegerField())
+    rows = (
+        Product.objects.order_by().annotate(shard=shard)
+        .values('shard').annotate(count=Count('id'), lastmod=Max('updated_at'))
+    )
+    # Full precision, so an edit in the same second as the last build still counts
+    return {row['shard']: {'count': row['count'], 'lastmod': row['lastmod'].isoformat()} for row in rows}
+
+
+def write_shard(shard):
+    size = shard_size()
+    products = (
+        Product.objects.filter(id__gt=shard * size, id__lte=(shard + 1) * size)
+        .order_by('id').values_list('slug', 'updated_at')
+    )
+    rows = (
+        (reverse('product-detail', kwargs={'slug': slug}), updated_at)
+        for slug, updated_at in products.iterator(chunk_size=2000)
+    )
+    _write(shard_name(shard), _urlset(rows))
+
+
+def write_categories():
+    categories = Category.objects.order_by('name').annotate(lastmod=Max('products__updated_at'))
+    rows = (
+        (reverse('category-products', kwargs={'category_slug': slug}), modified)
+        for slug, modified in categories.values_list('slug', 'lastmod').iterator()
+    )
+    _write('categories.xml.gz', _urlset(rows))
+
+
+def write_index(state):
+    def lines():
+        yield f'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{XMLNS}">\n'
+        yield f'<sitemap><loc>{escape(sitemap_url("categories.xml.gz"))}</loc></sitemap>\n'
+        for shard in sorted(state):
+            yield (
+                f'<sitemap><loc>{escape(sitemap_url(shard_name(shard)))}</loc>'
+                f'<lastmod>{lastmod(datetime.fromisoformat(state[shard]["lastmod"]))}</lastmod></sitemap>\n'
+            )
+        yield '</sitemapindex>\n'
+    _write('sitemap.xml', lines(), compress=False)
+
+
+def _manifest_path():
+    return os.path.join(settings.SITEMAP_ROOT, 'manifest.json')
+
+
+def load_manifest():
+    try:
+        with open(_manifest_path()) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'shard_size': None, 'shards': {}}
+    manifest['shards'] = {int(shard): state for shard, state in manifest['shards'].items()}
+    return manifest
+
+
+def build(full=False):
+    """
+    Bring the sitemap files up to date. Returns (shards written, shards
+    removed, shards unchanged).
+    """
+    os.makedirs(settings.SITEMAP_ROOT, exist_ok=True)
+    manifest = load_manifest()
+    if manifest['shard_size'] != shard_size():
+        full = True
+    state = shard_state()
+    previous = {} if full else manifest['shards']
+
+    changed = [shard for shard in sorted(state) if previous.get(shard) != state[shard]]
+    removed = [shard for shard in manifest['shards'] if shard not in state]
+    for shard in changed:
+        write_shard(shard)
+    for shard in removed:
+        try:
+            os.remove(os.path.join(settings.SITEMAP_ROOT, shard_name(shard)))
+        except FileNotFoundError:
+            pass
+
+    # Both are small: categories are few, and the index has one line per shard
+    write_categories()
+    write_index(state)
+
+    tmp = f'{_manifest_path()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'shard_size': shard_size(), 'shards': state}, f)
+    os.replace(tmp, _manifest_path())
+    return len(changed), len(removed), len(state) - len(changed)
@@ -0,0 +1,20 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from store import sitemaps
+
+
+class Command(BaseCommand):
+    help = 'Write the gzipped sitemap files, rewriting only the product shards that changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rewrite every shard, changed or not')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        written, removed, unchanged = sitemaps.build(full=options['full'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Sitemaps in {settings.SITEMAP_ROOT}: {written} shard(s) written, {removed} removed, '
+            f'{unchanged} unchanged in {elapsed:.2f}s.'
+        ))
@@ -0,0 +1,256 @@
+"""
+Horizontal sharding of cart and order data by user.
+
+CartItem, Order, OrderItem and the archived order tables live in the
+databases listed in SHARD_DATABASES. Everything else (users, the catalog,
+tasks, rollups) stays in 'default', which is also the first shard, so a
+single-database install runs unchanged. All of a user's rows sit on one
+shard, so a shopper's requests only ever touch that shard.
+
+UserShard is the directory of which shard holds each user's data. A user
+gets a shard on first use by rendezvous hashing over SHARD_DATABASES. Adding
+a shard therefore only reassigns about 1/N of the users, and the
+rebalance_shards command moves their rows. Lookups are cached for
+SHARD_DIRECTORY_TIMEOUT seconds, in each process unless the cache is shared,
+so after a move other processes may look on the old shard for that long.
+Placing an order can't afford that; it reads the directory itself with
+locked_shard_for_user().
+
+ShardRouter sends queries about one user, cart item or order to its
+shard, and queries on every other model to 'default'. Code that reads
+across users (reports, maintenance jobs, the admin) loops over all_shards().
+
+Each shard hands out ids from its own range, SHARD_ID_SPAN apart. The
+range is reserved after migrate. Ids are then unique across shards, and
+rows keep them when a user's data moves.
+"""
+import hashlib
+import heapq
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models.signals import post_delete, post_migrate
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB = 'default'
+SHARDED_MODELS = {
+    'store.cartitem', 'store.order', 'store.orderitem', 'store.archivedorder', 'store.archivedorderitem',
+}
+# On every shard, each holding its own rows (see outbox.py)
+PER_SHARD_MODELS = {'store.outboxevent'}
+SHARD_ID_SPAN = 10 ** 12
+
+
+def all_shards():
+    return list(settings.SHARD_DATABASES)
+
+
+def is_sharded(model_or_instance):
+    return model_or_instance._meta.label_lower in SHARDED_MODELS
+
+
+def home_shard(user_id, shards=None):
+    """The shard rendezvous hashing picks for a user."""
+    return max(
+        shards or all_shards(),
+        key=lambda db: hashlib.blake2b(f'{db}:{user_id}'.encode(), digest_size=8).digest(),
+    )
+
+
+def _directory_key(user_id):
+    return f'shard:user:{user_id}'
+
+
+def shard_for_user(user_id):
+    """The database holding the user's cart and orders, assigned on first use."""
+    from .models import UserShard
+    key = _directory_key(user_id)
+    db = cache.get(key)
+    if db is None:
+        db = UserShard.objects.filter(user_id=user_id).values_list('shard', flat=True).first()
+        if db is None:
+            db = UserShard.objects.get_or_create(user_id=user_id, defaults={'shard': home_shard(user_id)})[0].shard
+        cache.set(key, db, settings.SHARD_DIRECTORY_TIMEOUT)
+    return db
+
+
+def locked_shard_for_user(user_id):
+    """
+    shard_for_user() read from the directory rather than the cache, with the
+    user's entry locked until the transaction on 'default' ends, so a move
+    of the user waits until then.
+    """
+    from .models import UserShard
+    db = UserShard.objects.select_for_update().filter(user_id=user_id).values_list('shard', flat=True).first()
+    if db is None:
+        return shard_for_user(user_id)
+    cache.set(_directory_key(user_id), db, settings.SHARD_DIRECTORY_TIMEOUT)
+    return db
+
+
+class UserShardedManager(models.Manager):
+    """Manager for sharded models with a user foreign key."""
+
+    def for_user(self, user):
+        """The user's rows, read from and written to the user's shard."""
+        user_id = getattr(user, 'pk', user)
+        return self.using(shard_for_user(user_id)).filter(user_id=user_id)
+
+
+def merged(queryset, key, reverse=False):
+    """
+    Scatter-gather: run an ordered queryset on every shard and merge the
+    results into one stream, ordered by key.
+    """
+    return heapq.merge(*(queryset.using(db) for db in all_shards()), key=key, reverse=reverse)
+
+
+class ShardRouter:
+    """
+    Routes the sharded models by the user the query is about, and every other
+    model to 'default'. Queries with no instance to go by get no answer from
+    the router, so they go to 'default'. On a sharded install, where 'default'
+    only holds shard 0, those should use .using() or for_user() instead.
+    """
+
+    def _shard_of(self, instance):
+        if isinstance(instance, User):
+            return shard_for_user(instance.pk)
+        if not is_sharded(instance):
+            return None
+        if instance._state.db and not instance._state.adding:
+            return instance._state.db
+        user_id = getattr(instance, 'user_id', None)
+        if user_id is not None:
+            return shard_for_user(user_id)
+        # Order items belong wherever their order is
+        order = instance._meta.get_field('order').get_cached_value(instance, None)
+        return self._shard_of(order) if order is not None else None
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded(model):
+            return DEFAULT_DB
+        instance = hints.get('instance')
+        return self._shard_of(instance) if instance is not None else None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(obj1) and is_sharded(obj2):
+            return obj1._state.db is None or obj2._state.db is None or obj1._state.db == obj2._state.db
+        if is_sharded(obj1) or is_sharded(obj2):
+            # Users and products live in 'default', referenced without constraints
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name is None:
+            return None
+        label = f'{app_label}.{model_name}'
+        if label in SHARDED_MODELS or label in PER_SHARD_MODELS:
+            return db in settings.SHARD_DATABASES
+        return db == DEFAULT_DB
+
+
+@receiver(post_migrate)
+def reserve_id_range(sender, using, **kwargs):
+    """Start shard n's id sequences at n * SHARD_ID_SPAN."""
+    if sender.name != 'store' or using not in settings.SHARD_DATABASES:
+        return
+    start = settings.SHARD_DATABASES.index(using) * SHARD_ID_SPAN
+    if not start:
+        return
+    from .models import CartItem, Order, OrderItem
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for model in (CartItem, Order, OrderItem):
+            table = model._meta.db_table
+            if connection.vendor == 'sqlite':
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+                elif row[0] < start:
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+            elif connection.vendor == 'postgresql':
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    f"GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)})))",
+                    [table, start],
+                )
+            elif connection.vendor == 'mysql':
+                # MySQL never lowers AUTO_INCREMENT below the current maximum
+                cursor.execute(f'ALTER TABLE {connection.ops.quote_name(table)} AUTO_INCREMENT = {start + 1}')
+            else:
+                logger.warning('Cannot reserve an id range for %s on %s (%s)', table, using, connection.vendor)
+
+
+def _copy(rows, using):
+    # raw=True keeps auto_now/auto_now_add timestamps as they are
+    for row in rows:
+        row.save_base(using=using, raw=True, force_insert=True)
+
+
+def move_user(user_id, target, sources=None):
+    """
+    Move all of a user's cart and order rows to the target shard and point
+    the directory at it. Rows are collected from every other shard, so
+    strays written through a stale directory entry are picked up too.
+    Returns the number of rows moved.
+    """
+    from .models import ArchivedOrder, ArchivedOrderItem, CartItem, Order, OrderItem, UserShard
+    moved = 0
+    with transaction.atomic(using=DEFAULT_DB):
+        entry, _ = UserShard.objects.select_for_update().get_or_create(user_id=user_id, defaults={'shard': target})
+        for source in sources or all_shards():
+            if source == target:
+                continue
+            with transaction.atomic(using=target), transaction.atomic(using=source):
+                orders = list(Order.objects.using(source).filter(user_id=user_id))
+                archived = list(ArchivedOrder.objects.using(source).filter(user_id=user_id))
+                # Parents before children on insert, children first on delete
+                tables = [
+                    (CartItem, list(CartItem.objects.using(source).filter(user_id=user_id))),
+                    (Order, orders),
+                    (OrderItem, list(OrderItem.objects.using(source).filter(order__in=[o.id for o in orders]))),
+                    (ArchivedOrder, archived),
+                    (ArchivedOrderItem, list(
+                        ArchivedOrderItem.objects.using(source).filter(order__in=[o.id for o in archived])
+                    )),
+                ]
+                for model, rows in tables:
+                    _copy(rows, target)
+                    moved += len(rows)
+                for model, rows in reversed(tables):
+                    if rows:
+                        model._base_manager.using(source).filter(id__in=[row.id for row in rows]).delete()
+        if entry.shard != target:
+            entry.shard = target
+            entry.save(update_fields=['shard'])
+        transaction.on_commit(lambda: cache.delete(_directory_key(user_id)), using=DEFAULT_DB)
+    return moved
+
+
+# Users and products are in 'default', so deleting one can't cascade to the
+# shards through the database; these receivers do it instead
+
+
+@receiver(post_delete, sender=User)
+def delete_user_data(sender, instance, **kwargs):
+    from .models import ArchivedOrder, CartItem, Order
+    for db in all_shards():
+        for model in (CartItem, Order, ArchivedOrder):
+            model.objects.using(db).filter(user_id=instance.pk).delete()
+
+
+@receiver(post_delete, sender='store.Product')
+def delete_product_data(sender, instance, **kwargs):
+    from .models import ArchivedOrderItem, CartItem, OrderItem
+    for db in all_shards():
+        for model in (CartItem, OrderItem, ArchivedOrderItem):
+            model.objects.using(db).filter(product_id=instance.pk).delete()
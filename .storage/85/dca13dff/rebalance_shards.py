@@ -0,0 +1,62 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from store import sharding
+from store.models import ArchivedOrder, CartItem, Order, UserShard
+
+
+class Command(BaseCommand):
+    help = "Move users' carts and orders to the shard SHARD_DATABASES assigns them, one user per transaction"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drain', action='append', default=[], metavar='DATABASE',
+                            help='Also move everything off this database (a shard being retired); repeatable')
+        parser.add_argument('--max-users', type=int, default=None,
+                            help='Stop after moving this many users; the next run resumes')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between users (default 0)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would move')
+
+    def handle(self, *args, **options):
+        for db in options['drain']:
+            if db not in connections.databases:
+                raise CommandError(f'Unknown database {db!r}')
+        shards = sharding.all_shards()
+        sources = shards + [db for db in options['drain'] if db not in shards]
+        start = time.perf_counter()
+
+        # Where each user's rows are now, including users the directory
+        # doesn't know about yet and stray rows on the wrong shard
+        located = {}
+        for db in sources:
+            for model in (CartItem, Order, ArchivedOrder):
+                for user_id in model.objects.using(db).order_by().values_list('user_id', flat=True).distinct():
+                    located.setdefault(user_id, set()).add(db)
+        directory = dict(UserShard.objects.values_list('user_id', 'shard'))
+
+        pending = []
+        for user_id in sorted(set(located) | set(directory)):
+            target = sharding.home_shard(user_id, shards)
+            if directory.get(user_id) != target or located.get(user_id, set()) - {target}:
+                pending.append((user_id, target))
+
+        if options['dry_run']:
+            for user_id, target in pending:
+                found = ', '.join(sorted(located.get(user_id, ()))) or 'no rows'
+                self.stdout.write(f'User {user_id}: {directory.get(user_id, "unassigned")} ({found}) -> {target}')
+            self.stdout.write(self.style.SUCCESS(f'{len(pending)} user(s) would move.'))
+            return
+
+        users = rows = 0
+        for user_id, target in pending:
+            if options['max_users'] is not None and users >= options['max_users']:
+                break
+            rows += sharding.move_user(user_id, target, sources)
+            users += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f'User {user_id} -> {target}')
+            if options['pause']:
+                time.sleep(options['pause'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {users} user(s) ({rows} row(s)) in {elapsed:.2f}s; {len(pending) - users} left.'
+        ))
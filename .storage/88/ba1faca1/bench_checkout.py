@@ -0,0 +1,259 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import django
+
+# Checkout under contention: many shoppers racing for the last units of one
+# low-stock product.
+#
+#   python bench_checkout.py --shoppers 200 --stock 20 --workers 32
+#   POSTGRES_DB=plant_nursery python bench_checkout.py --shoppers 200 --stock 20
+#
+# Serves the app from a threaded WSGI server in this process and starts
+# fake_payment_server.py in a background thread (unless STRIPE_API_BASE is
+# already set). Every shopper runs add-to-cart -> create_payment ->
+# payment_success over HTTP at the same time. Reports throughput, latency
+# percentiles per step, time spent in locking statements (SELECT ... FOR
+# UPDATE and writes, where lock waits show up) and whether stock stayed
+# consistent: initial - units sold == final stock, and nothing oversold.
+# Shoppers who lose the race after paying get a cancelled order and a
+# refund. Exits with status 1 if anything was oversold.
+#
+# Uses the MD5 hasher for the shoppers. The product, users, orders and tasks
+# created by the run are deleted afterwards.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--shoppers', type=int, default=200)
+parser.add_argument('--stock', type=int, default=20, help='Units of the product at the start')
+parser.add_argument('--workers', type=int, default=32, help='Shoppers checking out at once')
+parser.add_argument('--latency', type=float, default=50, help='Payment provider latency in ms')
+parser.add_argument('--port', type=int, default=12112, help='Port for the fake payment provider')
+args = parser.parse_args()
+
+if 'STRIPE_API_BASE' not in os.environ:
+    import fake_payment_server
+    from http.server import ThreadingHTTPServer
+    fake_payment_server.Handler.latency = args.latency / 1000
+    provider = ThreadingHTTPServer(('127.0.0.1', args.port), fake_payment_server.Handler)
+    provider.daemon_threads = True
+    threading.Thread(target=provider.serve_forever, daemon=True).start()
+    os.environ['STRIPE_API_BASE'] = f'http://127.0.0.1:{args.port}'
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plant_nursery.settings')
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models import Sum
+from django.test import Client
+from django.test.utils import override_settings
+from store.models import Category, OrderItem, Product, Task
+from store.sharding import all_shards
+
+PREFIX = 'bench_checkout_'
+SHIPPING = {
+    'full_name': 'Bench Shopper',
+    'email': 'bench@example.com',
+    'address': '1 Greenhouse Lane',
+    'city': 'Springfield',
+    'state': 'OR',
+    'zip_code': '97477',
+    'phone': '555-0100',
+}
+
+lock_times = []
+lock_times_lock = threading.Lock()
+
+
+def time_locking_statements(execute, sql, params, many, context):
+    statement = sql.lstrip().upper()
+    if not statement.startswith(('UPDATE', 'INSERT', 'DELETE')) and 'FOR UPDATE' not in statement:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        with lock_times_lock:
+            lock_times.append(time.perf_counter() - start)
+
+
+def instrument(sender, connection, **kwargs):
+    # Server threads reconnect for every request
+    if time_locking_statements not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_locking_statements)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler)
+    server.set_app(WSGIHandler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+opener = urllib.request.build_opener(NoRedirects)
+
+
+class Shopper:
+    """One logged-in browser: keeps its cookies and sends the CSRF token."""
+
+    def __init__(self, base_url, cookies):
+        self.base_url = base_url
+        self.cookies = dict(cookies)
+
+    def request(self, method, path, form=None, json_body=None):
+        headers = {'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items())}
+        body = None
+        if json_body is not None:
+            body, headers['Content-Type'] = json.dumps(json_body).encode(), 'application/json'
+        elif form is not None:
+            body, headers['Content-Type'] = urllib.parse.urlencode(form).encode(), 'application/x-www-form-urlencoded'
+        if method == 'POST':
+            headers['X-CSRFToken'] = self.cookies.get(settings.CSRF_COOKIE_NAME, '')
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            response = opener.open(request)
+        except urllib.error.HTTPError as e:
+            response = e
+        with response:
+            for header in response.headers.get_all('Set-Cookie') or []:
+                name, _, rest = header.partition('=')
+                self.cookies[name.strip()] = rest.split(';', 1)[0]
+            return response.status, response.headers.get('Location', ''), response.read()
+
+
+def checkout(shopper, product_id):
+    """Returns (outcome, {step: seconds})."""
+    timings = {}
+
+    def step(name, *request_args, **request_kwargs):
+        start = time.perf_counter()
+        result = shopper.request(*request_args, **request_kwargs)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    status, _, _ = step('add-to-cart', 'GET', f'/add-to-cart/{product_id}/')
+    if status != 302:
+        return 'error', timings
+    status, _, body = step('create-payment', 'POST', '/create-payment/', json_body={'shipping': SHIPPING})
+    if status == 409:
+        return 'refused', timings
+    if status != 200:
+        return 'error', timings
+    payment_id = json.loads(body)['clientSecret'].split('_secret_')[0]
+    status, location, _ = step('payment-success', 'POST', '/payment-success/', form={
+        'payment_intent_id': payment_id, **SHIPPING,
+    })
+    if status != 302:
+        return 'error', timings
+    # Sold out while paying: back to the cart, which still has the product
+    return ('ordered' if '/order-complete/' in location else 'sold out'), timings
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return '-'
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))] * 1000
+    return f'p50 {pick(0.5):7.1f} ms   p95 {pick(0.95):7.1f} ms   p99 {pick(0.99):7.1f} ms'
+
+
+def units_sold(product_id):
+    return sum(
+        OrderItem.objects.using(db).filter(product_id=product_id).exclude(order__status='cancelled').aggregate(units=Sum('quantity'))['units'] or 0
+        for db in all_shards()
+    )
+
+
+def bench():
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['127.0.0.1']
+    category, _ = Category.objects.get_or_create(slug='bench-checkout', defaults={'name': 'Bench checkout'})
+    product = Product.objects.create(
+        category=category, name='Bench Last Units', slug='bench-last-units',
+        description='Contended product', price='9.99', stock=args.stock, available=True,
+    )
+    base_url = start_server()
+    connection_created.connect(instrument)
+    # Refused checkouts (409) are expected here, not worth a warning each
+    logging.getLogger('django.request').setLevel(logging.ERROR)
+
+    shoppers = []
+    for i in range(args.shoppers):
+        user = User.objects.create_user(f'{PREFIX}{i}', f'{PREFIX}{i}@example.com', 'Bench-pass-123')
+        client = Client()
+        client.force_login(user)
+        shopper = Shopper(base_url, {name: morsel.value for name, morsel in client.cookies.items()})
+        # Picks up a CSRF cookie, like the page the shopper came from would
+        shopper.request('GET', '/fragments/')
+        shoppers.append(shopper)
+    last_task = Task.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    del lock_times[:]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(lambda shopper: checkout(shopper, product.id), shoppers))
+    elapsed = time.perf_counter() - start
+
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    product.refresh_from_db()
+    sold = units_sold(product.id)
+
+    print(f"{connection.vendor}, {args.shoppers} shoppers, {args.workers} at once, stock {args.stock}, "
+          f"provider latency {args.latency:.0f} ms")
+    print(f"{'throughput':<16} {args.shoppers / elapsed:8.1f} checkouts/s ({elapsed:.2f}s)")
+    for name in ('add-to-cart', 'create-payment', 'payment-success'):
+        print(f"{name:<16} {percentiles([timings[name] for _, timings in results if name in timings])}")
+    print(f"{'whole flow':<16} {percentiles([sum(timings.values()) for _, timings in results])}")
+    print(f"{'lock statements':<16} {percentiles(lock_times)}   {len(lock_times)} statements, "
+          f"{sum(lock_times):.2f}s in total")
+    print(f"{'outcomes':<16} " + ', '.join(f'{outcome} {n}' for outcome, n in sorted(outcomes.items())))
+    refunds = Task.objects.filter(id__gt=last_task, name='refund_payment').count()
+    oversold = max(0, sold - args.stock)
+    consistent = args.stock - sold == product.stock and not oversold
+    print(f"{'stock':<16} initial {args.stock}, sold {sold}, final {product.stock}, "
+          f"oversold {oversold}, refunds queued {refunds}, {'consistent' if consistent else 'INCONSISTENT'}")
+    return last_task, product, category, consistent
+
+
+if __name__ == '__main__':
+    User.objects.filter(username__startswith=PREFIX).delete()
+    Product.objects.filter(slug='bench-last-units').delete()
+    last_task, product, category, consistent = 0, None, None, False
+    try:
+        with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+            last_task, product, category, consistent = bench()
+    finally:
+        connection_created.disconnect(instrument)
+        User.objects.filter(username__startswith=PREFIX).delete()
+        Product.objects.filter(slug='bench-last-units').delete()
+        Category.objects.filter(slug='bench-checkout').delete()
+        if last_task:
+            Task.objects.filter(id__gt=last_task).delete()
+    if not consistent:
+        sys.exit(1)
@@ -0,0 +1,74 @@
+"""
+Bulk order status changes.
+
+transition() moves a selection of orders to a new status with one UPDATE per
+status the orders are currently in. Only moves allowed by
+Order.STATUS_TRANSITIONS are made. Orders that can't make the move are
+counted and left alone. Customers hear about shipped, delivered and
+cancelled orders through one send_order_status_update task per order, all
+inserted together and emailed in batches by the worker. The admin actions
+and the update_order_status command both use it.
+"""
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Order
+from .tasks import enqueue, enqueue_many
+
+NOTIFY_STATUSES = ('shipped', 'delivered', 'cancelled')
+
+
+def can_transition(current, status):
+    return status in Order.STATUS_TRANSITIONS.get(current, ())
+
+
+def status_counts(queryset):
+    """{status: number of orders} for the selection."""
+    return dict(queryset.order_by().values_list('status').annotate(count=Count('id')))
+
+
+def transition(queryset, status, notify=True):
+    """
+    Move the orders in queryset, all on one database, to status.
+    Returns (moved, skipped), where skipped is {current status: count} for
+    the orders that couldn't move. Orders already in status are neither.
+    """
+    if status not in dict(Order.STATUS_CHOICES):
+        raise ValueError(f'Unknown order status {status!r}')
+    using = queryset.db
+    moved, skipped = 0, {}
+    now = timezone.now()
+    # Tasks are in the default database, orders on their shard; the shard
+    # commits first, so notifications never go out for a change rolled back
+    with transaction.atomic(), transaction.atomic(using=using):
+        for current, count in status_counts(queryset).items():
+            if current == status:
+                continue
+            if not can_transition(current, status):
+                skipped[current] = count
+                continue
+            group = queryset.filter(status=current)
+            order_ids = []
+            if notify and status in NOTIFY_STATUSES:
+                order_ids = list(group.select_for_update().order_by().values_list('id', flat=True))
+                # Exactly the orders that will be notified, locked above
+                group = Order.objects.using(using).filter(id__in=order_ids)
+            moved += group.update(status=status, updated_at=now)
+            if order_ids:
+                enqueue_many('send_order_status_update', [
+                    {'order_id': order_id, 'status': status} for order_id in order_ids
+                ])
+        if moved:
+            # Cancelling takes orders out of the sales figures
+            enqueue('update_sales_rollups')
+    return moved, skipped
+
+
+def describe_skipped(skipped, status):
+    """'3 delivered and 1 cancelled order(s) can't become shipped', or ''."""
+    if not skipped:
+        return ''
+    parts = [f'{count} {current}' for current, count in sorted(skipped.items())]
+    listed = ', '.join(parts[:-1]) + ' and ' + parts[-1] if len(parts) > 1 else parts[0]
+    return f"{listed} order(s) can't become {status}"
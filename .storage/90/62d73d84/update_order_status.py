@@ -0,0 +1,73 @@
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store import order_status, sharding
+from store.models import Order
+
+STATUSES = [status for status, label in Order.STATUS_CHOICES]
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, dt_time.min))
+
+
+class Command(BaseCommand):
+    help = 'Move orders to a new status in bulk, one UPDATE per current status and shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('status', choices=STATUSES, help='Status to move the orders to')
+        parser.add_argument('--from', dest='from_status', action='append', choices=STATUSES, default=[],
+                            help='Only orders currently in this status; repeatable')
+        parser.add_argument('--created-from', type=date.fromisoformat,
+                            help='Only orders placed on or after this day, YYYY-MM-DD')
+        parser.add_argument('--created-to', type=date.fromisoformat,
+                            help='Only orders placed on or before this day, YYYY-MM-DD')
+        parser.add_argument('--id', dest='ids', action='append', type=int, default=[],
+                            help='Only this order; repeatable')
+        parser.add_argument('--no-notify', action='store_true', help="Don't email the customers")
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+
+    def selection(self, db, options):
+        orders = Order.objects.using(db)
+        if options['from_status']:
+            orders = orders.filter(status__in=options['from_status'])
+        if options['created_from']:
+            orders = orders.filter(created_at__gte=day_start(options['created_from']))
+        if options['created_to']:
+            orders = orders.filter(created_at__lt=day_start(options['created_to'] + timedelta(days=1)))
+        if options['ids']:
+            orders = orders.filter(id__in=options['ids'])
+        return orders
+
+    def handle(self, *args, **options):
+        status = options['status']
+        start = time.perf_counter()
+        moved, skipped = 0, {}
+        for db in sharding.all_shards():
+            orders = self.selection(db, options)
+            if options['dry_run']:
+                for current, count in order_status.status_counts(orders).items():
+                    if current == status:
+                        continue
+                    if order_status.can_transition(current, status):
+                        moved += count
+                    else:
+                        skipped[current] = skipped.get(current, 0) + count
+                continue
+            count, shard_skipped = order_status.transition(orders, status, notify=not options['no_notify'])
+            moved += count
+            for current, n in shard_skipped.items():
+                skipped[current] = skipped.get(current, 0) + n
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{db}: {count} order(s) moved')
+        elapsed = time.perf_counter() - start
+
+        if skipped:
+            self.stdout.write(self.style.WARNING(order_status.describe_skipped(skipped, status) + '.'))
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'{moved} order(s) would move to {status}.'))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {moved} order(s) to {status} in {elapsed:.2f}s ({moved / elapsed if elapsed else 0:.0f} orders/s).'
+        ))
@@ -0,0 +1,71 @@
+"""
+Low-stock and restock alerts.
+
+Stock is checked where it changes, never by scanning the product table:
+place_order() calls stock_changed() for the products in the order, and
+saving a Product (the admin, imports) does it through post_save.
+
+- Low stock: a product at or below its threshold (its own, else its
+  category's, else LOW_STOCK_THRESHOLD) is alerted once. A conditional
+  UPDATE on low_stock_alerted lets only one of several concurrent orders
+  queue the alert, and the flag is cleared once stock is back above the
+  threshold. Alerts wait STOCK_ALERT_DIGEST_DELAY seconds before they go
+  out, so the ones raised close together share a digest (notify_low_stock).
+- Restock: when a product that couldn't be bought can be again,
+  notify_restock emails everyone on its restock list and clears the list.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Product
+from .tasks import enqueue_many
+
+
+def stock_changed(products, restocked=()):
+    """
+    Queue alerts for products whose stock just changed, loaded with their
+    current stock. restocked are the ids of those that went from
+    unavailable to buyable. Returns the ids alerted for low stock.
+    """
+    low, recovered = [], []
+    for product in products:
+        if product.stock <= product.get_low_stock_threshold():
+            if not product.low_stock_alerted:
+                low.append(product.id)
+        elif product.low_stock_alerted:
+            recovered.append(product.id)
+
+    alerted = [
+        product_id for product_id in low
+        if Product.objects.filter(id=product_id, low_stock_alerted=False).update(low_stock_alerted=True)
+    ]
+    if recovered:
+        Product.objects.filter(id__in=recovered).update(low_stock_alerted=False)
+    for product in products:
+        if product.id in alerted:
+            product.low_stock_alerted = True
+        elif product.id in recovered:
+            product.low_stock_alerted = False
+
+    if alerted:
+        enqueue_many(
+            'notify_low_stock',
+            [{'product_id': product_id} for product_id in alerted],
+            delay=timedelta(seconds=settings.STOCK_ALERT_DIGEST_DELAY),
+        )
+    if restocked:
+        enqueue_many('notify_restock', [{'product_id': product_id} for product_id in restocked])
+    return alerted
+
+
+@receiver(post_save, sender=Product, dispatch_uid='stock_alerts_product_saved')
+def product_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not {'stock', 'available', 'low_stock_threshold'} & set(update_fields)):
+        return
+    was_in_stock = getattr(instance, '_loaded_in_stock', None)
+    restocked = [instance.id] if was_in_stock is False and instance.in_stock else []
+    stock_changed([instance], restocked)
+    instance._loaded_in_stock = instance.in_stock
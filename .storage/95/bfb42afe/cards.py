@@ -0,0 +1,65 @@
+"""
+Cached product cards.
+
+The home page, product list, related products and the wishlist all show
+products as the same card. Each card is rendered once per product version
+and cached under the product's id and updated_at, so an edit or a sale
+simply makes new keys. A page fetches all of its cards with one get_many()
+and only renders the ones missing.
+
+The cached HTML is the same for every visitor. It has two slots that are
+filled per request: the CSRF token of the add-to-cart form (see
+page_cache.csrf_input) and, on the wishlist, the visitor's own buttons.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .page_cache import csrf_input
+
+CARD_TEMPLATE = 'store/fragments/product_card.html'
+VARIANTS = ('grid', 'related', 'wishlist')
+CSRF_SLOT = '<!--card:csrf-->'
+USER_SLOT = '<!--card:user-->'
+
+
+def card_key(product, variant):
+    return f'card:{variant}:{product.id}:{product.updated_at.timestamp()}'
+
+
+def render_card(product, variant):
+    return render_to_string(CARD_TEMPLATE, {
+        'product': product,
+        'variant': variant,
+        'csrf_slot': mark_safe(CSRF_SLOT),
+        'user_slot': mark_safe(USER_SLOT),
+    })
+
+
+def render_cards(products, variant, request=None, user_html=None):
+    """
+    [(product, card HTML)] for the products, in order. user_html is
+    {product id: HTML} for the user slot.
+    """
+    if variant not in VARIANTS:
+        raise ValueError(f'Unknown card variant {variant!r}')
+    products = list(products)
+    keys = {product.id: card_key(product, variant) for product in products}
+    cards = cache.get_many(list(keys.values()))
+    missing = {}
+    for product in products:
+        key = keys[product.id]
+        if key not in cards:
+            cards[key] = missing[key] = render_card(product, variant)
+    if missing:
+        cache.set_many(missing, settings.CARD_CACHE_TIMEOUT)
+
+    csrf = csrf_input(request) if request is not None else ''
+    user_html = user_html or {}
+    return [
+        (product, mark_safe(
+            cards[keys[product.id]].replace(CSRF_SLOT, csrf).replace(USER_SLOT, user_html.get(product.id, ''))
+        ))
+        for product in products
+    ]
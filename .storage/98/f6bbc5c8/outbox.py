@@ -0,0 +1,237 @@
+"""
+Transactional outbox: a change feed of products, categories and orders.
+
+Every change to an outbox model writes an OutboxEvent row in the same
+transaction and on the same database as the change itself, so the feed
+never shows a change that was rolled back and never misses one that
+committed. That covers save() (including raw saves from loaddata and shard
+moves), delete() and cascades, and QuerySet.update(), bulk_update() and
+bulk_create(), none of which send post_save.
+
+Events get their sequence number when they are read rather than when they
+are written. Ids are handed out at insert, but transactions commit in any
+order, so a reader going by id could pass over a row that commits later.
+assign_sequences() numbers committed events after the highest sequence so
+far. Sequences therefore only grow in the order events became visible, and
+"everything after my checkpoint" is exact. Orders are sharded, so each
+database has its own feed and sequence.
+
+Consumers are named and keep a checkpoint per database (OutboxConsumer).
+consume() hands them new events in batches and moves the checkpoint after
+each batch, so delivery is at least once. A consumer starts from the end
+of the feed: build the derived data in full once, then follow the feed.
+compact() deletes events every consumer has read, and any older than
+OUTBOX_RETENTION. A consumer that hasn't read those is marked as having
+missed events and must rebuild and reset().
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import F, Max, Min
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .sharding import DEFAULT_DB, all_shards
+
+SEQUENCE_BATCH = 5000
+UPDATE_BATCH = 1000
+
+# The action deletes are recorded with; see deletes_recorded_as()
+_delete_action = ContextVar('outbox_delete_action', default='deleted')
+
+
+class OutboxGap(Exception):
+    """Events the consumer hadn't read were compacted away; rebuild and reset()."""
+
+
+def record(model, object_ids, action, fields=None, using=DEFAULT_DB):
+    from .models import OutboxEvent
+    topic = model._meta.label_lower
+    OutboxEvent.objects.using(using).bulk_create([
+        OutboxEvent(topic=topic, object_id=str(object_id), action=action, fields=sorted(fields) if fields else None)
+        for object_id in object_ids
+    ], batch_size=1000)
+
+
+class OutboxQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # bulk_update() goes through here too
+        with transaction.atomic(using=self.db, savepoint=False):
+            # Update exactly the rows recorded: the filter could match more
+            # rows by the time the UPDATE runs
+            object_ids = list(self.select_for_update(of=('self',)).values_list('pk', flat=True))
+            rows = self.model._base_manager.using(self.db)
+            count = 0
+            for start in range(0, len(object_ids), UPDATE_BATCH):
+                count += rows.filter(pk__in=object_ids[start:start + UPDATE_BATCH]).update(**kwargs)
+            record(self.model, object_ids, 'updated', kwargs, using=self.db)
+        return count
+
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False, **kwargs):
+        with transaction.atomic(using=self.db, savepoint=False):
+            if ignore_conflicts:
+                # No pks come back then, so the rows inserted can't be told
+                # from the ones skipped; insert one at a time instead
+                objs, created = list(objs), []
+                for obj in objs:
+                    try:
+                        with transaction.atomic(using=self.db):
+                            super().bulk_create([obj], **kwargs)
+                    except IntegrityError:
+                        continue
+                    created.append(obj)
+            else:
+                objs = created = super().bulk_create(objs, batch_size=batch_size, **kwargs)
+            record(self.model, [obj.pk for obj in created if obj.pk is not None], 'saved', using=self.db)
+        return objs
+
+
+OutboxManager = models.Manager.from_queryset(OutboxQuerySet)
+
+
+class OutboxMixin:
+    """For models whose changes go to the outbox; use with OutboxManager."""
+
+    def save_base(self, raw=False, force_insert=False, force_update=False, using=None, update_fields=None):
+        using = using or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            super().save_base(raw, force_insert, force_update, using, update_fields)
+            record(self.__class__, [self.pk], 'saved', update_fields, using=using)
+
+
+@receiver(post_delete, sender='store.Category', dispatch_uid='outbox_category_deleted')
+@receiver(post_delete, sender='store.Product', dispatch_uid='outbox_product_deleted')
+@receiver(post_delete, sender='store.Order', dispatch_uid='outbox_order_deleted')
+def outbox_deleted(sender, instance, using, **kwargs):
+    # Deletions, cascades included, send post_delete inside their transaction
+    record(sender, [instance.pk], _delete_action.get(), using=using)
+
+
+@contextmanager
+def deletes_recorded_as(action):
+    """
+    Record the deletes in the block as `action` instead of 'deleted', for
+    rows that move elsewhere rather than go away (e.g. 'archived').
+    """
+    token = _delete_action.set(action)
+    try:
+        yield
+    finally:
+        _delete_action.reset(token)
+
+
+def assign_sequences(using):
+    """Number committed events that have no sequence yet. Returns how many were numbered."""
+    from .models import OutboxEvent
+    events = OutboxEvent.objects.using(using)
+    try:
+        with transaction.atomic(using=using):
+            # Locked, so a concurrent call waits and then skips these
+            pending = list(
+                events.filter(sequence__isnull=True).select_for_update().order_by('id')
+                .values_list('id', flat=True)[:SEQUENCE_BATCH]
+            )
+            if not pending:
+                return 0
+            last = events.aggregate(last=Max('sequence'))['last'] or 0
+            # Gaps are fine; the order is what matters
+            return events.filter(id__in=pending).update(sequence=F('id') - pending[0] + last + 1)
+    except IntegrityError:
+        # Lost a race with another call numbering the same range; it's done
+        return 0
+
+
+def latest_sequence(using):
+    from .models import OutboxEvent
+    while assign_sequences(using):
+        pass
+    return OutboxEvent.objects.using(using).aggregate(last=Max('sequence'))['last'] or 0
+
+
+def consumer(name, using=DEFAULT_DB):
+    """The consumer's checkpoint on one database, created at the end of the feed."""
+    from .models import OutboxConsumer
+    checkpoint = OutboxConsumer.objects.filter(name=name, database=using).first()
+    if checkpoint is None:
+        checkpoint, _ = OutboxConsumer.objects.get_or_create(
+            name=name, database=using, defaults={'position': latest_sequence(using)}
+        )
+    return checkpoint
+
+
+def read(name, using=DEFAULT_DB, limit=500, topics=None):
+    """The next events for the consumer, oldest first. Doesn't move the checkpoint."""
+    from .models import OutboxEvent
+    checkpoint = consumer(name, using)
+    if checkpoint.missed_events:
+        raise OutboxGap(f'Consumer {name!r} missed compacted events on {using!r}')
+    assign_sequences(using)
+    events = OutboxEvent.objects.using(using).filter(sequence__gt=checkpoint.position)
+    if topics:
+        events = events.filter(topic__in=topics)
+    return list(events.order_by('sequence')[:limit])
+
+
+def checkpoint(name, position, using=DEFAULT_DB):
+    from .models import OutboxConsumer
+    OutboxConsumer.objects.filter(name=name, database=using, position__lt=position).update(
+        position=position, updated_at=timezone.now()
+    )
+
+
+def consume(name, handler, using=None, topics=None, batch_size=500):
+    """
+    Call handler(events) with each batch of new events, on one database or
+    all of them, and checkpoint after each batch. Returns the number handled.
+    """
+    databases = [using] if using else all_shards()
+    for db in databases:
+        # A new consumer starts at the end of every feed at the same time
+        consumer(name, db)
+    handled = 0
+    for db in databases:
+        while True:
+            events = read(name, db, batch_size, topics)
+            if not events:
+                break
+            handler(events)
+            checkpoint(name, events[-1].sequence, db)
+            handled += len(events)
+            if len(events) < batch_size:
+                break
+    return handled
+
+
+def reset(name, using=DEFAULT_DB):
+    """After a full rebuild: follow the feed from its current end."""
+    from .models import OutboxConsumer
+    OutboxConsumer.objects.update_or_create(
+        name=name, database=using,
+        defaults={'position': latest_sequence(using), 'missed_events': False, 'updated_at': timezone.now()},
+    )
+
+
+def compact(using=DEFAULT_DB):
+    """
+    Delete the events every consumer has read, and the ones older than
+    OUTBOX_RETENTION. Returns the number deleted.
+    """
+    from .models import OutboxConsumer, OutboxEvent
+    # The latest event always stays: new sequences continue from it
+    events = OutboxEvent.objects.using(using).filter(sequence__lt=latest_sequence(using))
+    checkpoints = OutboxConsumer.objects.filter(database=using)
+    deleted = 0
+    read_by_all = checkpoints.aggregate(position=Min('position'))['position']
+    if read_by_all is not None:
+        deleted += events.filter(sequence__lte=read_by_all).delete()[0]
+
+    expired = events.filter(created_at__lt=timezone.now() - timedelta(seconds=settings.OUTBOX_RETENTION))
+    horizon = expired.aggregate(last=Max('sequence'))['last']
+    if horizon is not None:
+        checkpoints.filter(position__lt=horizon).update(missed_events=True)
+        deleted += expired.delete()[0]
+    return deleted
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from store import outbox, sharding
+from store.models import OutboxConsumer, OutboxEvent
+
+
+class Command(BaseCommand):
+    help = 'Delete outbox events every consumer has read, or older than OUTBOX_RETENTION, and show consumer lag'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        deleted = 0
+        for db in sharding.all_shards():
+            deleted += outbox.compact(db)
+            latest = outbox.latest_sequence(db)
+            left = OutboxEvent.objects.using(db).count()
+            self.stdout.write(f'{db}: {left} event(s) kept, latest #{latest}')
+            for checkpoint in OutboxConsumer.objects.filter(database=db).order_by('name'):
+                behind = OutboxEvent.objects.using(db).filter(sequence__gt=checkpoint.position).count()
+                state = 'MISSED EVENTS, rebuild and reset' if checkpoint.missed_events else f'{behind} behind'
+                self.stdout.write(f'  {checkpoint.name}: at #{checkpoint.position}, {state}')
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'Compacted {deleted} outbox event(s) in {elapsed:.2f}s.'))